@@ -0,0 +1,97 @@
+import os
+import click
+from app import db
+from app.models.file import File
+from app.models.user import User
+from app.utils.blobs import collect_garbage, dedup_enabled, store_blob
+from app.utils.filesystem import recalculate_storage_usage
+from app.utils.search import create_search_index
+from app.utils.storage import sharded_layout, stored_path, migrate_user_to_sharded, migrate_user_to_tree
+from app.utils.sync import synchronize_database_with_filesystem
+from app.utils.tiering import move_tiers
+from app.utils.uploads import sweep_expired_upload_sessions
+
+def register_commands(app):
+    """Register the maintenance commands available through ``flask <command>``"""
+
+    @app.cli.command('recalculate-storage')
+    @click.option('--username', default=None, help='Only repair the counter of this user.')
+    def recalculate_storage(username):
+        """Recompute stored storage usage counters from the file table."""
+        user_id = None
+        if username:
+            user = User.query.filter_by(username=username).first()
+            if not user:
+                raise click.ClickException(f'User {username} not found')
+            user_id = user.id
+        recalculate_storage_usage(user_id)
+        for user in User.query.order_by(User.username).all():
+            if user_id is None or user.id == user_id:
+                click.echo(f'{user.username}: {user.storage_used} bytes')
+
+    @app.cli.command('sweep-uploads')
+    def sweep_uploads():
+        """Delete expired resumable upload sessions and their partial data."""
+        sweep_expired_upload_sessions()
+
+    @app.cli.command('sync-filesystem')
+    def sync_filesystem():
+        """Sync file and folder rows with the upload folder in the foreground."""
+        status = synchronize_database_with_filesystem(app)
+        click.echo(f"{status['scanned']} of {status['directories']} directories listed "
+                   f"for {status['users_done']} users")
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index():
+        """Recreate the file name search index from the file and folder tables."""
+        with db.engine.begin() as connection:
+            available = create_search_index(connection)
+        app.extensions['search_index'] = available
+        if not available:
+            raise click.ClickException('This SQLite build has no FTS5 trigram tokenizer; search scans names instead')
+        click.echo('Search index rebuilt')
+
+    @app.cli.command('store-blobs')
+    def store_blobs():
+        """Move files stored before DEDUP_STORAGE was enabled into the blob store."""
+        if not dedup_enabled():
+            raise click.ClickException('DEDUP_STORAGE is not enabled')
+        stored = 0
+        for user in User.query.order_by(User.username).all():
+            rows = File.query.filter(File.owner_id == user.id, File.sha256.is_(None)).with_entities(
+                File.id, File.name, File.storage_key
+            ).all()
+            for file in rows:
+                path = stored_path(user.username, file)
+                sha256 = store_blob(path) if os.path.isfile(path) else None
+                if sha256:
+                    File.query.filter_by(id=file.id).update({File.sha256: sha256}, synchronize_session=False)
+                    stored += 1
+                    if stored % 1000 == 0:
+                        db.session.commit()
+            db.session.commit()
+        click.echo(f'{stored} files stored')
+
+    @app.cli.command('collect-blobs')
+    def collect_blobs():
+        """Delete blobs that no file links to any more."""
+        stats = collect_garbage()
+        click.echo(f"{stats['removed']} blobs removed, {stats['bytes_freed']} bytes freed, {stats['blobs']} in use")
+
+    @app.cli.command('migrate-layout')
+    @click.option('--batch-size', default=1000, show_default=True, help='Files moved per committed batch.')
+    def migrate_layout(batch_size):
+        """Move every file into the configured STORAGE_LAYOUT; safe to interrupt and run again."""
+        migrate = migrate_user_to_sharded if sharded_layout() else migrate_user_to_tree
+        for user in User.query.order_by(User.username).all():
+            moved = migrate(user.id, user.username, batch_size)
+            click.echo(f'{user.username}: {moved} files moved')
+
+    @app.cli.command('move-tiers')
+    def move_tiers_command():
+        """Run the storage tier mover once in the foreground."""
+        stats = move_tiers()
+        if stats is None:
+            raise click.ClickException('No STORAGE_TIERS configured, or the mover is running in another process')
+        click.echo(f"{stats['promoted']} files promoted, {stats['demoted']} demoted, "
+                   f"{stats['collected']} orphaned tier files removed, {stats['errors']} errors")
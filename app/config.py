@@ -5,4 +5,46 @@ class Config:
     SECRET_KEY = secrets.token_hex(16)
     SQLALCHEMY_DATABASE_URI = 'sqlite:///database.db'
     UPLOAD_FOLDER = os.path.abspath('uploads')
-    SQLALCHEMY_TRACK_MODIFICATIONS = False 
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    LISTING_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memory bound for cached directory listings
+    UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes copied per write when streaming uploads to disk
+    UPLOAD_SESSION_TTL = 24 * 60 * 60  # Seconds an idle resumable upload is kept
+    UPLOAD_SWEEP_INTERVAL = 60 * 60  # Seconds between sweeps of expired upload sessions
+    ARCHIVE_COMPRESS_LEVEL = 6  # zlib level for deflated entries in bulk download archives
+    ARCHIVE_COMPRESS_WORKERS = min(4, os.cpu_count() or 1)  # Threads compressing each bulk download archive
+    ARCHIVE_CACHE_FOLDER = None  # Where shared-folder archives are cached; defaults to UPLOAD_FOLDER/.cache/archives
+    ARCHIVE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Disk budget for cached shared-folder archives
+    PREVIEW_CACHE_FOLDER = None  # Where rendered previews are cached; defaults to UPLOAD_FOLDER/.cache/previews
+    PREVIEW_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Disk budget for cached previews
+    PREVIEW_WORKERS = min(2, os.cpu_count() or 1)  # Processes rendering previews; 0 renders inside the request
+    PREVIEW_WAIT = 0.5  # Seconds a request waits for a new preview before answering with a placeholder
+    THUMBNAIL_SIZE = 256  # Longest side of image thumbnails, in pixels
+    TEXT_PREVIEW_BYTES = 4096  # Bytes read from the start of a text file for its preview
+    TEXT_PREVIEW_LINES = 20  # Lines shown in a text file preview
+    DEDUP_STORAGE = False  # Store each distinct file content once, as hard links into BLOB_FOLDER
+    BLOB_FOLDER = None  # Content-addressed blob store for DEDUP_STORAGE; defaults to UPLOAD_FOLDER/.blobs, same filesystem only
+    BLOB_GC_INTERVAL = 6 * 60 * 60  # Seconds between sweeps for blobs no file links to
+    STORAGE_LAYOUT = 'tree'  # 'tree' mirrors each user's folders on disk; 'sharded' keeps bytes in OBJECT_FOLDER and folders only in the database
+    OBJECT_FOLDER = None  # Hash-sharded object store of the sharded layout; defaults to UPLOAD_FOLDER/.objects, same filesystem only
+    STORAGE_TIERS = []  # Capacity tier directories, fastest first; files left unread move there behind a symlink
+    TIER_DEMOTE_AFTER = 30 * 24 * 60 * 60  # Seconds unread before a file moves to the first capacity tier; twice that for the second, ...
+    TIER_MIN_SIZE = 1024 * 1024  # Smaller files always stay on the fast tier
+    TIER_MOVE_INTERVAL = 15 * 60  # Seconds between runs of the tier mover, which also promotes files read again
+    TIER_MOVE_BATCH = 1000  # Files promoted, and demoted per tier, in one run of the mover
+    SEARCH_RESULT_LIMIT = 100  # Default page size of search results
+    SEARCH_COUNT_LIMIT = 1000  # Matches counted exactly before a search total becomes a lower bound
+    JOB_WORKERS = 2  # Threads running queued copies, moves and deletes; 0 runs every operation inside its request
+    JOB_INLINE_MAX_FILES = 200  # Operations on more files than this are queued as background jobs
+    JOB_POLL_INTERVAL = 5  # Seconds between job queue polls when no job has been queued here
+    JOB_STALE_AFTER = 5 * 60  # Seconds without a heartbeat before a running job is taken over by another worker
+    JOB_MAX_ATTEMPTS = 3  # Claims of an interrupted job before it is marked failed
+    USAGE_CACHE_TTL = 60  # Seconds the admin dashboard reuses its per-user storage usage snapshot
+    LARGEST_FOLDERS_LIMIT = 10  # Top-level folders listed by size on the admin dashboard
+    ADMIN_USERS_PER_PAGE = 50  # Users per page of the admin dashboard's user table
+    METRICS_INTERVAL = 5  # Seconds between system metric samples for the admin dashboard
+    METRICS_HISTORY = 720  # Samples kept per worker; an hour at the default interval
+    SYNC_BATCH_SIZE = 1000  # Row changes committed per transaction by the filesystem sync
+    STARTUP_SYNC_GRACE = 10 * 60  # Seconds after a finished sync during which booting workers skip their own
+    FILESYSTEM_WATCHER = False  # Watch UPLOAD_FOLDER with inotify and apply outside changes as they happen
+    WATCHER_DEBOUNCE = 2.0  # Seconds of quiet before queued filesystem events are applied
+    WATCHER_RESCAN_INTERVAL = 15 * 60  # Seconds between full incremental rescans when inotify is unavailable
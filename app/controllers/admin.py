@@ -1,14 +1,17 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app, jsonify
 from werkzeug.security import generate_password_hash
+from sqlalchemy.orm import joinedload
 from app import db
 from app.models.user import User
 from app.models.role import Role
-from app.models.file import File
-from app.models.folder import Folder
 from app.models.activity_log import ActivityLog
 from app.utils.decorators import admin_required
-from app.utils.filesystem import ensure_user_folder, delete_user_folder
-import psutil
+from app.utils.filesystem import ensure_user_folder, subtree_totals
+from app.utils.jobs import enqueue_job
+from app.utils.operations import delete_user_data
+from app.utils.listing_cache import get_listing_cache
+from app.utils.metrics import get_metrics_sampler
+from app.utils.usage import usage_snapshot
 import os
 from datetime import datetime, timedelta, timezone
 
@@ -17,22 +20,19 @@ admin = Blueprint('admin', __name__)
 @admin.route('/admin')
 @admin_required
 def admin_dashboard():
-    users = User.query.all()
-    user_storage = {}
-    total_storage = 0
-    
-    for user in users:
-        user_files = File.query.filter_by(owner_id=user.id).all()
-        storage = sum(file.size for file in user_files)
-        user_storage[user.id] = storage
-        total_storage += storage
+    # Totals come from a cached aggregate snapshot; only one page of users is loaded
+    usage = usage_snapshot()
+    page = request.args.get('page', 1, type=int)
+    users = User.query.options(joinedload(User.role_info)).order_by(User.username).paginate(
+        page=page, per_page=current_app.config['ADMIN_USERS_PER_PAGE'], error_out=False
+    )
+    user_storage = {user.id: user.storage_used or 0 for user in users.items}
+    total_storage = usage['total_bytes']
     
-    active_users = len(users)
+    active_users = users.total
     
-    # System health metrics
-    cpu_percent = psutil.cpu_percent(interval=1)
-    memory = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
+    # System health metrics, as last sampled in the background
+    metrics = get_metrics_sampler().latest()
     
     # Recent activity logs
     recent_logs = ActivityLog.query.order_by(ActivityLog.timestamp.desc()).limit(10).all()
@@ -45,17 +45,42 @@ def admin_dashboard():
     ).count()
     
     return render_template('admin_dashboard.html',
-                         users=users,
+                         users=users.items,
+                         pagination=users,
+                         usage=usage,
                          user_storage=user_storage,
                          total_storage=total_storage,
                          active_users=active_users,
                          username=db.session.get(User, session['user_id']).username,
-                         cpu_percent=cpu_percent,
-                         memory_percent=memory.percent,
-                         disk_percent=disk.percent,
+                         cpu_percent=metrics['cpu_percent'],
+                         memory_percent=metrics['memory_percent'],
+                         disk_percent=metrics['disk_percent'],
+                         metrics_interval=current_app.config['METRICS_INTERVAL'],
                          recent_logs=recent_logs,
                          active_sessions=active_sessions)
 
+@admin.route('/admin/api/listing-cache')
+@admin_required
+def listing_cache_stats():
+    """Hit/miss counters of the directory listing cache in this worker"""
+    return jsonify(get_listing_cache().stats())
+
+@admin.route('/admin/api/metrics')
+@admin_required
+def metrics_history():
+    """System metric samples of this worker, oldest first; ``limit`` returns only the latest ones"""
+    limit = request.args.get('limit', type=int)
+    return jsonify({
+        'interval': current_app.config['METRICS_INTERVAL'],
+        'samples': get_metrics_sampler().history(limit if limit and limit > 0 else None)
+    })
+
+@admin.route('/admin/api/usage')
+@admin_required
+def storage_usage():
+    """Per-user file counts and sizes and the largest folders; ``refresh=1`` bypasses the cache"""
+    return jsonify(usage_snapshot(refresh=request.args.get('refresh') == '1'))
+
 @admin.route('/admin/add_user', methods=['POST'])
 @admin_required
 def add_user():
@@ -147,13 +172,14 @@ def delete_user(user_id):
         flash('Cannot delete admin user')
         return redirect(url_for('admin.admin_dashboard'))
     
-    delete_user_folder(current_app, user.username)
-    
-    File.query.filter_by(owner_id=user_id).delete()
-    Folder.query.filter_by(owner_id=user_id).delete()
+    files_total, bytes_total = subtree_totals(user_id, '')
+    if current_app.config['JOB_WORKERS'] and files_total > current_app.config['JOB_INLINE_MAX_FILES']:
+        enqueue_job('delete_user', session.get('user_id'), files_total, bytes_total,
+                    user_id=user_id, username=user.username)
+        flash('Deleting user in the background')
+        return redirect(url_for('admin.admin_dashboard'))
     
-    db.session.delete(user)
-    db.session.commit()
+    delete_user_data(user_id, user.username)
     
     flash('User deleted successfully')
     return redirect(url_for('admin.admin_dashboard'))
\ No newline at end of file
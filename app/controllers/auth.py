@@ -3,7 +3,6 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from app import db
 from app.models.user import User
 from app.models.role import Role
-from app.models.file import File
 from app.utils.filesystem import ensure_user_folder
 
 auth = Blueprint('auth', __name__)
@@ -82,9 +81,8 @@ def profile():
     user_id = session['user_id']
     current_user = db.session.get(User, user_id)
     
-    # Calculate storage usage
-    user_files = File.query.filter_by(owner_id=user_id).all()
-    storage_used = sum(file.size for file in user_files)
+    # Storage usage is kept up to date by every write path
+    storage_used = current_user.storage_used or 0
     
     # Calculate percentage for progress bar
     storage_percent = 0
@@ -1,20 +1,59 @@
+import hashlib
 import os
 from datetime import datetime
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, send_file, current_app, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app, jsonify, Response, abort
 from werkzeug.utils import secure_filename
 from app import db
 from app.models.user import User
 from app.models.file import File
 from app.models.folder import Folder
 from app.models.shared_link import SharedLink
+from app.models.upload_session import UploadSession
+from app.models.job import Job
 from app.utils.setup_wizard import setup_required
-from sqlalchemy import func
-import zipfile
-import tempfile
 import json
-from app.utils.filesystem import check_user_quota
+from app.utils.filesystem import (
+    reconcile_directory,
+    real_location,
+    adjust_storage_used,
+    subtree_totals,
+    get_remaining_quota,
+    save_upload_stream,
+    iter_archive_entries,
+    QuotaExceededError
+)
+from app.utils.blobs import dedup_enabled, store_blob
+from app.utils.jobs import JOB_KINDS, enqueue_job
+from app.utils.operations import DestinationExistsError
+from app.utils.http import send_file_ranges
+from app.utils.previews import preview_kind, preview_response
+from app.utils.search import search, decode_search_cursor
+from app.utils.listing import SORT_FIELDS, decode_cursor, sort_listing, paginate_listing
+from app.utils.listing_cache import list_directory, invalidate_listing, remember_listing_ids
+from app.utils.storage import (
+    sharded_layout,
+    storage_target,
+    locate_file,
+    item_exists,
+    folder_exists,
+    list_stored_directory,
+    iter_stored_entries
+)
+from app.utils.tiering import record_access
+from app.utils.zipstream import stream_zip
+from app.utils.uploads import (
+    create_part_file,
+    write_chunk,
+    record_received_range,
+    discard_upload_session,
+    get_part_path,
+    secure_relative_path
+)
+from app.utils.watcher import app_write
 
 file_manager = Blueprint('file_manager', __name__)
+# Templates use it to decide which files get a preview
+file_manager.add_app_template_global(preview_kind)
 
 @file_manager.route('/')
 def index():
@@ -37,49 +76,15 @@ def browse(path):
     
     full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, path)
     
-    if not os.path.exists(full_path):
+    if not (folder_exists(user_id, path) if sharded_layout() else os.path.exists(full_path)):
         flash('Path not found')
         return redirect(url_for('file_manager.browse', path=''))
         
-    items = []
-    for item in os.listdir(full_path):
-        item_path = os.path.join(full_path, item)
-        is_file = os.path.isfile(item_path)
-        
-        item_size = os.path.getsize(item_path) if is_file else 0
-        item_created = datetime.fromtimestamp(os.path.getctime(item_path))
-        
-        # Get database ID for file/folder
-        db_item = None
-        relative_path = os.path.join(path, item) if path else item
-        if is_file:
-            db_item = File.query.filter_by(name=relative_path, owner_id=user_id).first()
-            if not db_item:
-                # Create file record if it doesn't exist
-                db_item = File(name=relative_path, size=item_size, owner_id=user_id)
-                db.session.add(db_item)
-                db.session.commit()  # Commit to get the ID
-        else:
-            db_item = Folder.query.filter_by(name=relative_path, owner_id=user_id).first()
-            if not db_item:
-                # Create folder record if it doesn't exist
-                db_item = Folder(name=relative_path, owner_id=user_id)
-                db.session.add(db_item)
-                db.session.commit()  # Commit to get the ID
-        
-        items.append({
-            'name': item,
-            'is_file': is_file,
-            'size': item_size,
-            'created_at': item_created,
-            'path': relative_path,
-            'id': db_item.id if db_item else None,
-            'folder_id': db_item.id if not is_file else None  # Add folder_id for folders
-        })
-    
-    # Commit any pending changes
-    if db.session.dirty:
-        db.session.commit()
+    # Stat every entry once (or reuse a still-valid cached scan), then resolve
+    # database ids for entries that have none yet in a constant number of queries.
+    # The sharded layout has no directories to scan; its rows come with ids.
+    items = list_stored_directory(user_id, path) if sharded_layout() else list_directory(user_id, path, full_path)
+    remember_listing_ids(user_id, path, reconcile_directory(user_id, path, [item for item in items if 'id' not in item]))
     
     items.sort(key=lambda x: (x['is_file'], x['name'].lower()))
     
@@ -107,6 +112,60 @@ def browse(path):
                          is_admin=is_admin,
                          shared_links=shared_links)
 
+@file_manager.route('/api/browse/', defaults={'path': ''})
+@file_manager.route('/api/browse/<path:path>')
+def browse_api(path):
+    """Return one cursor-paginated page of a directory listing as JSON"""
+    if 'user_id' not in session:
+        return {'status': 'error', 'message': 'Not logged in'}, 401
+        
+    user_id = session['user_id']
+    user = db.session.get(User, user_id)
+    
+    sort = request.args.get('sort', 'name')
+    order = request.args.get('order', 'asc')
+    if sort not in SORT_FIELDS or order not in ('asc', 'desc'):
+        return {'status': 'error', 'message': 'Invalid sort parameters'}, 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    after = None
+    if request.args.get('cursor'):
+        after = decode_cursor(request.args['cursor'], sort)
+        if after is None:
+            return {'status': 'error', 'message': 'Invalid cursor'}, 400
+    
+    if sharded_layout():
+        if not folder_exists(user_id, path):
+            return {'status': 'error', 'message': 'Path not found'}, 404
+        items = list_stored_directory(user_id, path)
+    else:
+        user_root = os.path.realpath(os.path.join(current_app.config['UPLOAD_FOLDER'], user.username))
+        full_path = os.path.realpath(os.path.join(user_root, path))
+        if not (full_path == user_root or full_path.startswith(user_root + os.sep)) or not os.path.isdir(full_path):
+            return {'status': 'error', 'message': 'Path not found'}, 404
+        items = list_directory(user_id, path, full_path)
+    
+    items = sort_listing(items, sort, order == 'desc')
+    page, next_cursor = paginate_listing(items, sort, order == 'desc', after, limit)
+    
+    # Only the entries on this page need database ids
+    remember_listing_ids(user_id, path, reconcile_directory(user_id, path, [item for item in page if 'id' not in item]))
+    
+    return {
+        'status': 'success',
+        'path': path,
+        'total': len(items),
+        'next_cursor': next_cursor,
+        'items': [{
+            'name': item['name'],
+            'path': item['path'],
+            'is_file': item['is_file'],
+            'size': item['size'],
+            'created_at': item['created_at'].isoformat(),
+            'id': item['id'],
+            'folder_id': item['folder_id']
+        } for item in page]
+    }
+
 @file_manager.route('/browse/upload/', defaults={'path': ''}, methods=['GET', 'POST'])
 @file_manager.route('/browse/upload/<path:path>', methods=['GET', 'POST'])
 def upload(path):
@@ -116,81 +175,261 @@ def upload(path):
     user_id = session['user_id']
     user = db.session.get(User, user_id)
     
-    if 'file' in request.files:
-        files = request.files.getlist('file')
-        for file in files:
-            if file.filename:
-                # Check for empty file
-                if not file.read():
-                    file.seek(0)
-                    flash('File cannot be empty')
-                    return render_template('folder_view.html',
-                                         items=[],
-                                         breadcrumbs=[],
-                                         current_path=path,
-                                         username=user.username,
-                                         is_admin=user.role_info.name == 'admin',
-                                         shared_links=[])
-
-                # Reset file pointer after checking
-                file.seek(0)
-
-                # Validate filename
-                if '@' in file.filename or '#' in file.filename or '$' in file.filename or '%' in file.filename:
-                    flash('Invalid filename')
-                    return render_template('folder_view.html',
-                                         items=[],
-                                         breadcrumbs=[],
-                                         current_path=path,
-                                         username=user.username,
-                                         is_admin=user.role_info.name == 'admin',
-                                         shared_links=[])
+    with app_write(user_id, path):
+        if 'file' in request.files:
+            files = request.files.getlist('file')
+            for file in files:
+                if file.filename:
+                    # Validate filename
+                    secure_path = secure_relative_path(file.filename)
+                    if (not secure_path or '@' in file.filename or '#' in file.filename or '$' in file.filename
+                            or '%' in file.filename):
+                        flash('Invalid filename')
+                        return render_template('folder_view.html',
+                                             items=[],
+                                             breadcrumbs=[],
+                                             current_path=path,
+                                             username=user.username,
+                                             is_admin=user.role_info.name == 'admin',
+                                             shared_links=[])
                 
-                # Check file size against quota
-                file_size = len(file.read())
-                file.seek(0)  # Reset file pointer after reading
+                    # Database paths are relative to the user's root, not to the current folder
+                    secure_path = os.path.join(path.strip('/'), secure_path) if path.strip('/') else secure_path
+                    existing_file = File.query.filter_by(name=secure_path, owner_id=user_id).first()
+                    file_path, storage_key = storage_target(user.username, secure_path, existing_file)
                 
-                if not check_user_quota(user_id, file_size):
-                    flash('Storage quota exceeded')
-                    return redirect(url_for('file_manager.browse', path=path))
+                    # Overwriting a file frees the space it used
+                    remaining = get_remaining_quota(user_id)
+                    if remaining is not None and existing_file:
+                        remaining += existing_file.size or 0
                 
-                relative_path = file.filename.replace('\\', '/')
-                secure_path = '/'.join(secure_filename(part) for part in relative_path.split('/'))
-                file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, path, secure_path)
+                    # Stream to disk in chunks, enforcing the quota as the data arrives
+                    hasher = hashlib.sha256() if dedup_enabled() else None
+                    try:
+                        file_size = save_upload_stream(file.stream, file_path, remaining,
+                                                       current_app.config['UPLOAD_CHUNK_SIZE'], hasher)
+                    except QuotaExceededError:
+                        db.session.commit()  # Keep the files of this request that did fit
+                        invalidate_listing(user_id, path)
+                        flash('Storage quota exceeded')
+                        return redirect(url_for('file_manager.browse', path=path))
                 
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                file.save(file_path)
+                    if not file_size:
+                        db.session.commit()
+                        invalidate_listing(user_id, path)
+                        flash('File cannot be empty')
+                        return render_template('folder_view.html',
+                                             items=[],
+                                             breadcrumbs=[],
+                                             current_path=path,
+                                             username=user.username,
+                                             is_admin=user.role_info.name == 'admin',
+                                             shared_links=[])
+                    sha256 = store_blob(file_path, hasher.hexdigest()) if hasher else None
                 
-                current_path = ''
-                path_parts = os.path.dirname(secure_path).split('/')
-                for part in path_parts:
-                    if part:
-                        current_path = os.path.join(current_path, part) if current_path else part
-                        if not Folder.query.filter_by(name=current_path, owner_id=user_id).first():
-                            new_folder = Folder(name=current_path, owner_id=user_id)
-                            db.session.add(new_folder)
+                    current_path = ''
+                    path_parts = os.path.dirname(secure_path).split('/')
+                    for part in path_parts:
+                        if part:
+                            current_path = os.path.join(current_path, part) if current_path else part
+                            if not Folder.query.filter_by(name=current_path, owner_id=user_id).first():
+                                new_folder = Folder(name=current_path, owner_id=user_id)
+                                db.session.add(new_folder)
                 
-                file_size = os.path.getsize(file_path)
-                new_file = File(name=secure_path, size=file_size, owner_id=user_id)
-                db.session.add(new_file)
+                    if existing_file:
+                        # Re-uploading a path overwrites the file on disk, so update its record
+                        adjust_storage_used(user_id, file_size - (existing_file.size or 0))
+                        existing_file.size = file_size
+                        existing_file.sha256 = sha256
+                        existing_file.tier = 0
+                    else:
+                        new_file = File(name=secure_path, size=file_size, owner_id=user_id, sha256=sha256,
+                                        storage_key=storage_key)
+                        db.session.add(new_file)
+                        adjust_storage_used(user_id, file_size)
                 
-        db.session.commit()
-    
-    elif 'folder_name' in request.form:
-        folder_name = request.form['folder_name']
-        if folder_name:
-            folder_name = secure_filename(folder_name)
-            folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, path, folder_name)
+            db.session.commit()
+            invalidate_listing(user_id, path)
+    
+        elif 'folder_name' in request.form:
+            folder_name = request.form['folder_name']
+            if folder_name:
+                folder_name = secure_filename(folder_name)
+                folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, path, folder_name)
+                relative_path = os.path.join(path, folder_name) if path else folder_name
             
-            if not os.path.exists(folder_path):
-                os.makedirs(folder_path)
+                if not item_exists(user_id, user.username, relative_path):
+                    # Folders of the sharded layout are only rows
+                    if not sharded_layout():
+                        os.makedirs(folder_path)
                 
-                new_folder = Folder(name=folder_name, owner_id=user_id)
-                db.session.add(new_folder)
-                db.session.commit()
+                    if not Folder.query.filter_by(name=relative_path, owner_id=user_id).first():
+                        new_folder = Folder(name=relative_path, owner_id=user_id)
+                        db.session.add(new_folder)
+                        db.session.commit()
+                    invalidate_listing(user_id, path)
     
     return redirect(url_for('file_manager.browse', path=path))
 
+def _get_upload_session(upload_id):
+    """Return the caller's live upload session, or None"""
+    upload = db.session.get(UploadSession, upload_id)
+    if not upload or upload.owner_id != session['user_id'] or upload.is_expired:
+        return None
+    return upload
+
+def _upload_status(upload):
+    return {
+        'status': 'success',
+        'upload_id': upload.id,
+        'path': upload.path,
+        'size': upload.size,
+        'offset': upload.offset,
+        'received': upload.received,
+        'ranges': upload.received_ranges,
+        'complete': upload.is_complete,
+        'expires_at': upload.expires_at.isoformat()
+    }, 200, {'Upload-Offset': str(upload.offset), 'Upload-Length': str(upload.size), 'Cache-Control': 'no-store'}
+
+@file_manager.route('/api/uploads', methods=['POST'])
+def create_upload_session():
+    """Start a resumable upload: announce the destination and total size"""
+    if 'user_id' not in session:
+        return {'status': 'error', 'message': 'Not logged in'}, 401
+        
+    user_id = session['user_id']
+    data = request.get_json(silent=True) or {}
+    filename = (data.get('filename') or '').replace('\\', '/')
+    folder = secure_relative_path(data.get('path') or '')
+    size = data.get('size')
+    
+    if not filename or not isinstance(size, int) or size <= 0:
+        return {'status': 'error', 'message': 'A filename and a positive size are required'}, 400
+    if '@' in filename or '#' in filename or '$' in filename or '%' in filename:
+        return {'status': 'error', 'message': 'Invalid filename'}, 400
+    
+    secure_path = secure_relative_path(filename)
+    if not secure_path or filename.endswith('/'):
+        return {'status': 'error', 'message': 'Invalid filename'}, 400
+    if folder:
+        secure_path = f'{folder}/{secure_path}'
+    
+    remaining = get_remaining_quota(user_id)
+    if remaining is not None:
+        existing_file = File.query.filter_by(name=secure_path, owner_id=user_id).first()
+        if size > remaining + ((existing_file.size or 0) if existing_file else 0):
+            return {'status': 'error', 'message': 'Storage quota exceeded'}, 413
+    
+    upload = UploadSession(owner_id=user_id, path=secure_path, size=size)
+    upload.touch(current_app.config['UPLOAD_SESSION_TTL'])
+    create_part_file(upload.id, size)
+    db.session.add(upload)
+    db.session.commit()
+    
+    body, _, headers = _upload_status(upload)
+    headers['Location'] = url_for('file_manager.upload_session_status', upload_id=upload.id)
+    return body, 201, headers
+
+@file_manager.route('/api/uploads/<upload_id>', methods=['GET', 'HEAD'])
+def upload_session_status(upload_id):
+    """Report how much of an upload has arrived so a client can resume"""
+    if 'user_id' not in session:
+        return {'status': 'error', 'message': 'Not logged in'}, 401
+    upload = _get_upload_session(upload_id)
+    if not upload:
+        return {'status': 'error', 'message': 'Upload not found'}, 404
+    return _upload_status(upload)
+
+@file_manager.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Write the request body at the byte offset given in the Upload-Offset header"""
+    if 'user_id' not in session:
+        return {'status': 'error', 'message': 'Not logged in'}, 401
+    upload = _get_upload_session(upload_id)
+    if not upload:
+        return {'status': 'error', 'message': 'Upload not found'}, 404
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return {'status': 'error', 'message': 'Upload-Offset header required'}, 400
+    if offset < 0 or offset >= upload.size:
+        return {'status': 'error', 'message': 'Offset outside of the upload'}, 416
+    
+    written = write_chunk(upload.id, request.stream, offset, upload.size - offset,
+                          current_app.config['UPLOAD_CHUNK_SIZE'])
+    if written is None:
+        return {'status': 'error', 'message': 'Chunk extends past the announced size'}, 413
+    
+    upload.touch(current_app.config['UPLOAD_SESSION_TTL'])
+    db.session.commit()
+    if written:
+        upload = record_received_range(upload.id, offset, offset + written)
+        if not upload:
+            return {'status': 'error', 'message': 'Upload not found'}, 404
+    return _upload_status(upload)
+
+@file_manager.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Move a completely received upload into place and record it"""
+    if 'user_id' not in session:
+        return {'status': 'error', 'message': 'Not logged in'}, 401
+        
+    user_id = session['user_id']
+    user = db.session.get(User, user_id)
+    upload = _get_upload_session(upload_id)
+    if not upload:
+        return {'status': 'error', 'message': 'Upload not found'}, 404
+    if not upload.is_complete:
+        body, _, headers = _upload_status(upload)
+        body.update({'status': 'error', 'message': 'Upload is incomplete'})
+        return body, 409, headers
+    
+    existing_file = File.query.filter_by(name=upload.path, owner_id=user_id).first()
+    old_size = (existing_file.size or 0) if existing_file else 0
+    remaining = get_remaining_quota(user_id, exclude_upload=upload.id)
+    if remaining is not None and upload.size > remaining + old_size:
+        return {'status': 'error', 'message': 'Storage quota exceeded'}, 413
+    
+    with app_write(user_id, upload.path):
+        file_path, storage_key = storage_target(user.username, upload.path, existing_file)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(get_part_path(upload.id), file_path)
+        sha256 = store_blob(file_path) if dedup_enabled() else None
+    
+        current_path = ''
+        for part in os.path.dirname(upload.path).split('/'):
+            if part:
+                current_path = os.path.join(current_path, part) if current_path else part
+                if not Folder.query.filter_by(name=current_path, owner_id=user_id).first():
+                    db.session.add(Folder(name=current_path, owner_id=user_id))
+    
+        if existing_file:
+            existing_file.size = upload.size
+            existing_file.sha256 = sha256
+            existing_file.tier = 0
+        else:
+            existing_file = File(name=upload.path, size=upload.size, owner_id=user_id, sha256=sha256,
+                                 storage_key=storage_key)
+            db.session.add(existing_file)
+        adjust_storage_used(user_id, upload.size - old_size)
+        db.session.delete(upload)
+        db.session.commit()
+        invalidate_listing(user_id, os.path.dirname(upload.path))
+    
+    return {'status': 'success', 'path': existing_file.name, 'id': existing_file.id, 'size': existing_file.size}
+
+@file_manager.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    """Abort an upload and discard the data received so far"""
+    if 'user_id' not in session:
+        return {'status': 'error', 'message': 'Not logged in'}, 401
+    upload = _get_upload_session(upload_id)
+    if not upload:
+        return {'status': 'error', 'message': 'Upload not found'}, 404
+    discard_upload_session(upload)
+    return {'status': 'success'}
+
 @file_manager.route('/browse/delete/<path:path>', methods=['POST'])
 def delete_item(path):
     if 'user_id' not in session:
@@ -199,25 +438,19 @@ def delete_item(path):
     user_id = session['user_id']
     user = db.session.get(User, user_id)
     
-    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, path)
-    if not os.path.exists(file_path):
+    if not item_exists(user_id, user.username, path):
         flash('Item not found')
         return redirect(url_for('file_manager.browse', path=os.path.dirname(path)))
     
     try:
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-            file_name = os.path.basename(path)
-            File.query.filter_by(name=file_name, owner_id=user_id).delete()
+        path = path.strip('/')
+        job, _ = _run_or_queue('delete', user_id, path, username=user.username, path=path)
+        if job:
+            flash('Deleting in the background')
         else:
-            import shutil
-            shutil.rmtree(file_path)
-            folder_name = os.path.basename(path)
-            Folder.query.filter_by(name=folder_name, owner_id=user_id).delete()
-        
-        db.session.commit()
-        flash('Item deleted successfully')
+            flash('Item deleted successfully')
     except Exception as e:
+        db.session.rollback()
         flash('Error deleting item: ' + str(e))
     
     return redirect(url_for('file_manager.browse', path=os.path.dirname(path)))
@@ -230,75 +463,38 @@ def download_file(path):
     user_id = session['user_id']
     user = db.session.get(User, user_id)
     
-    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, path)
-    if os.path.exists(file_path) and os.path.isfile(file_path):
-        return send_file(file_path, as_attachment=True)
+    file_path = locate_file(user_id, user.username, path)
+    if file_path:
+        record_access(user_id, path)
+        return send_file_ranges(file_path, download_name=os.path.basename(path))
     else:
         flash('File not found')
         return redirect(url_for('file_manager.browse', path=os.path.dirname(path)))
 
-@file_manager.route('/browse/copy', methods=['POST'])
-def copy_item():
+@file_manager.route('/browse/preview/<path:path>')
+def preview_file(path):
     if 'user_id' not in session:
-        return {'status': 'error', 'message': 'Not logged in'}, 401
-        
+        return redirect(url_for('auth.login'))
+
     user_id = session['user_id']
     user = db.session.get(User, user_id)
-    
-    source_path = request.form.get('source_path')
-    destination_path = request.form.get('destination_path')
-    is_file = request.form.get('is_file') == 'true'
-    
-    if not source_path or not destination_path:
-        return {'status': 'error', 'message': 'Missing parameters'}, 400
-    
-    source_full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, source_path)
-    destination_full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, destination_path.strip('/'), os.path.basename(source_path))
-    
-    try:
-        if is_file:
-            import shutil
-            os.makedirs(os.path.dirname(destination_full_path), exist_ok=True)
-            shutil.copy2(source_full_path, destination_full_path)
-            
-            # Create new file record
-            file_size = os.path.getsize(destination_full_path)
-            relative_path = os.path.join(destination_path.strip('/'), os.path.basename(source_path))
-            new_file = File(name=relative_path, size=file_size, owner_id=user_id)
-            db.session.add(new_file)
-        else:
-            import shutil
-            shutil.copytree(source_full_path, destination_full_path)
-            
-            # Create new folder record
-            relative_path = os.path.join(destination_path.strip('/'), os.path.basename(source_path))
-            new_folder = Folder(name=relative_path, owner_id=user_id)
-            db.session.add(new_folder)
-            
-            # Create records for all files in the folder
-            for root, dirs, files in os.walk(destination_full_path):
-                relative_root = os.path.relpath(root, os.path.join(current_app.config['UPLOAD_FOLDER'], user.username))
-                
-                for dir_name in dirs:
-                    folder_path = os.path.join(relative_root, dir_name)
-                    if not Folder.query.filter_by(name=folder_path, owner_id=user_id).first():
-                        new_folder = Folder(name=folder_path, owner_id=user_id)
-                        db.session.add(new_folder)
-                
-                for file_name in files:
-                    file_path = os.path.join(relative_root, file_name)
-                    if not File.query.filter_by(name=file_path, owner_id=user_id).first():
-                        file_size = os.path.getsize(os.path.join(root, file_name))
-                        new_file = File(name=file_path, size=file_size, owner_id=user_id)
-                        db.session.add(new_file)
-        
-        db.session.commit()
-        return {'status': 'success'}
-    except Exception as e:
-        return {'status': 'error', 'message': str(e)}, 500
+
+    file_path = locate_file(user_id, user.username, path)
+    response = preview_response(file_path, path) if file_path else None
+    if response is None:
+        abort(404)
+    return response
+
+@file_manager.route('/browse/copy', methods=['POST'])
+def copy_item():
+    return _transfer_item('copy')
 
 @file_manager.route('/browse/move', methods=['POST'])
 def move_item():
+    return _transfer_item('move')
+
+def _transfer_item(kind):
+    """Copy or move the posted item, answering 202 with a job when it is queued"""
     if 'user_id' not in session:
         return {'status': 'error', 'message': 'Not logged in'}, 401
         
@@ -312,100 +508,114 @@ def move_item():
     if not source_path or not destination_path:
         return {'status': 'error', 'message': 'Missing parameters'}, 400
     
-    source_full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, source_path)
-    destination_full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, destination_path.strip('/'), os.path.basename(source_path))
+    if not item_exists(user_id, user.username, source_path):
+        return {'status': 'error', 'message': 'Item not found'}, 404
     
     try:
-        import shutil
-        os.makedirs(os.path.dirname(destination_full_path), exist_ok=True)
-        shutil.move(source_full_path, destination_full_path)
-        
-        if is_file:
-            # Update file record
-            file = File.query.filter_by(name=source_path, owner_id=user_id).first()
-            if file:
-                file.name = os.path.join(destination_path.strip('/'), os.path.basename(source_path))
-        else:
-            # Update folder record and all contained files/folders
-            folder = Folder.query.filter_by(name=source_path, owner_id=user_id).first()
-            if folder:
-                folder.name = os.path.join(destination_path.strip('/'), os.path.basename(source_path))
-            
-            # Update paths for all files and folders inside
-            old_prefix = source_path + '/'
-            new_prefix = os.path.join(destination_path.strip('/'), os.path.basename(source_path)) + '/'
-            
-            File.query.filter(
-                File.owner_id == user_id,
-                File.name.startswith(old_prefix)
-            ).update(
-                {File.name: func.concat(new_prefix, func.substr(File.name, len(old_prefix) + 1))},
-                synchronize_session=False
-            )
-            
-            Folder.query.filter(
-                Folder.owner_id == user_id,
-                Folder.name.startswith(old_prefix)
-            ).update(
-                {Folder.name: func.concat(new_prefix, func.substr(Folder.name, len(old_prefix) + 1))},
-                synchronize_session=False
-            )
-        
-        db.session.commit()
-        return {'status': 'success'}
+        job, result = _run_or_queue(kind, user_id, source_path, username=user.username, source_path=source_path,
+                                    destination_path=destination_path, is_file=is_file)
+        if job:
+            return {'status': 'queued', 'job_id': job.id,
+                    'job_url': url_for('file_manager.job_status', job_id=job.id)}, 202
+        return {'status': 'success', **result}
+    except DestinationExistsError as e:
+        db.session.rollback()
+        return {'status': 'error', 'message': str(e)}, 409
     except Exception as e:
+        db.session.rollback()
         return {'status': 'error', 'message': str(e)}, 500
 
+def _run_or_queue(kind, user_id, subtree, **params):
+    """Run an operation on ``subtree`` now, or queue it when it covers more than JOB_INLINE_MAX_FILES files.
+
+    Returns ``(job, None)`` for a queued operation and ``(None, result)`` for one that ran.
+    """
+    files_total, bytes_total = subtree_totals(user_id, subtree)
+    if current_app.config['JOB_WORKERS'] and files_total > current_app.config['JOB_INLINE_MAX_FILES']:
+        return enqueue_job(kind, user_id, files_total, bytes_total, user_id=user_id, **params), None
+    return None, JOB_KINDS[kind](user_id=user_id, **params)
+
+@file_manager.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    if 'user_id' not in session:
+        return {'status': 'error', 'message': 'Not logged in'}, 401
+    
+    job = db.session.get(Job, job_id)
+    if not job or job.owner_id != session['user_id']:
+        return {'status': 'error', 'message': 'Job not found'}, 404
+    return {'status': 'success', 'job': job.to_dict()}
+
+def _parse_search_filters(args):
+    """Read the search filters from the query string; raises ValueError on a malformed value"""
+    filters = {}
+    file_type = args.get('type')
+    if file_type:
+        if file_type not in ('file', 'folder'):
+            raise ValueError('type must be file or folder')
+        filters['type'] = file_type
+    extensions = [ext.strip().lstrip('.').lower() for ext in args.get('ext', '').split(',')]
+    if any(extensions):
+        filters['extensions'] = [ext for ext in extensions if ext]
+    for key in ('min_size', 'max_size'):
+        if args.get(key):
+            filters[key] = int(args[key])
+    for key in ('created_after', 'created_before'):
+        if args.get(key):
+            filters[key] = datetime.fromisoformat(args[key])
+    return filters
+
 @file_manager.route('/search')
 def search_items():
+    """Return one page of the entries matching the query and filters as JSON"""
     if 'user_id' not in session:
         return {'status': 'error', 'message': 'Not logged in'}, 401
         
     user_id = session['user_id']
     query = request.args.get('q', '').strip()
     
-    if not query:
+    try:
+        filters = _parse_search_filters(request.args)
+    except ValueError as e:
+        return {'status': 'error', 'message': f'Invalid search filter: {e}'}, 400
+    if not query and not filters:
         return {'status': 'error', 'message': 'No search query provided'}, 400
-    
-    # Search in both files and folders using database queries
-    files = File.query.filter(
-        File.owner_id == user_id,
-        File.name.ilike(f'%{query}%')
-    ).all()
-    
-    folders = Folder.query.filter(
-        Folder.owner_id == user_id,
-        Folder.name.ilike(f'%{query}%')
-    ).all()
-    
+    limit = min(max(request.args.get('limit', current_app.config['SEARCH_RESULT_LIMIT'], type=int), 1), 1000)
+    after = None
+    if request.args.get('cursor'):
+        after = decode_search_cursor(request.args['cursor'])
+        if after is None:
+            return {'status': 'error', 'message': 'Invalid cursor'}, 400
+    
+    ranked, next_cursor, total, total_exact = search(
+        user_id, query, filters, after, limit, current_app.config['SEARCH_COUNT_LIMIT']
+    )
+    file_ids = [item_id for is_file, item_id in ranked if is_file]
+    folder_ids = [item_id for is_file, item_id in ranked if not is_file]
+    files = {f.id: f for f in File.query.filter(File.id.in_(file_ids))} if file_ids else {}
+    folders = {f.id: f for f in Folder.query.filter(Folder.id.in_(folder_ids))} if folder_ids else {}
+    
+    # Results keep the search ranking: name prefix matches first, then by relevance
     results = []
-    
-    # Process files
-    for file in files:
-        results.append({
-            'name': os.path.basename(file.name),
-            'path': file.name,
-            'is_file': True,
-            'size': file.size,
-            'created_at': file.created_at.isoformat(),
-            'id': file.id
-        })
-    
-    # Process folders
-    for folder in folders:
+    for is_file, item_id in ranked:
+        item = (files if is_file else folders).get(item_id)
+        if item is None:
+            continue
         results.append({
-            'name': os.path.basename(folder.name),
-            'path': folder.name,
-            'is_file': False,
-            'size': 0,
-            'created_at': folder.created_at.isoformat(),
-            'id': folder.id
+            'name': item.basename,
+            'path': item.name,
+            'is_file': is_file,
+            'size': item.size if is_file else 0,
+            'created_at': item.created_at.isoformat(),
+            'id': item.id
         })
     
-    # Sort results - folders first, then files
-    results.sort(key=lambda x: (x['is_file'], x['name'].lower()))
-    
-    return {'status': 'success', 'results': results}
+    return {
+        'status': 'success',
+        'results': results,
+        'next_cursor': next_cursor,
+        'total': total,
+        'total_exact': total_exact
+    }
 
 @file_manager.route('/browse/folders')
 def get_folders():
@@ -415,6 +625,10 @@ def get_folders():
     user_id = session['user_id']
     user = db.session.get(User, user_id)
     
+    if sharded_layout():
+        folders = [{'path': name} for name, in Folder.query.filter_by(owner_id=user_id).with_entities(Folder.name)]
+        return {'status': 'success', 'folders': folders}
+    
     folders = []
     root_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username)
     
@@ -442,48 +656,38 @@ def bulk_download():
     if not items:
         return jsonify({'status': 'error', 'message': 'No items selected'}), 400
     
-    # Create a temporary zip file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as temp_file:
-        with zipfile.ZipFile(temp_file.name, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for item in items:
-                item_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username, item['path'])
-                
-                if item['type'] == 'file':
-                    # Handle single file
-                    if os.path.exists(item_path) and os.path.isfile(item_path):
-                        # Add file to zip with its relative path
-                        zipf.write(item_path, item['path'])
-                else:
-                    # Handle folder and its contents
-                    if os.path.exists(item_path) and os.path.isdir(item_path):
-                        for root, dirs, files in os.walk(item_path):
-                            # Calculate the relative path within the user's directory
-                            rel_start = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username)
-                            rel_path = os.path.relpath(root, rel_start)
-                            
-                            # Add all files in this directory to the zip
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                # The arcname will preserve the directory structure
-                                arc_name = os.path.join(rel_path, file)
-                                zipf.write(file_path, arc_name)
-                            
-                            # Add empty directories
-                            for dir in dirs:
-                                dir_path = os.path.join(root, dir)
-                                # Create an empty directory in the zip
-                                dir_rel_path = os.path.relpath(dir_path, rel_start)
-                                # Ensure the directory ends with a slash
-                                if not dir_rel_path.endswith('/'):
-                                    dir_rel_path += '/'
-                                zipinfo = zipfile.ZipInfo(dir_rel_path)
-                                zipf.writestr(zipinfo, '')
-                
-    # Return the path to the zip file
+    user_root = os.path.join(current_app.config['UPLOAD_FOLDER'], user.username)
+    real_root = os.path.realpath(user_root)
+    sharded = sharded_layout()
+
+    def archive_entries():
+        for item in items:
+            item_path = os.path.join(user_root, item['path'])
+            real_path = real_location(item_path)
+            if real_path != real_root and not real_path.startswith(real_root + os.sep):
+                continue
+            if item['type'] == 'file':
+                if sharded:
+                    item_path = locate_file(user_id, user.username, item['path'])
+                if item_path and os.path.isfile(item_path):
+                    yield item['path'], item_path
+            elif sharded:
+                yield from iter_stored_entries(user_id, user.username, item['path'])
+            elif os.path.isdir(item_path):
+                # Folder contents keep their path relative to the user's directory
+                yield from iter_archive_entries(item_path, user_root)
+
+    entries = archive_entries()
+    if sharded:
+        # Stored files are located through the database, so they are listed before the response starts
+        entries = list(entries)
+    
+    # The archive is generated while it is sent, so nothing is staged on disk
     zip_filename = f'bulk_download_{datetime.now().strftime("%Y%m%d_%H%M%S")}.zip'
-    return send_file(
-        temp_file.name,
-        as_attachment=True,
-        download_name=zip_filename,
+    response = Response(
+        stream_zip(entries, current_app.config['ARCHIVE_COMPRESS_LEVEL'],
+                   workers=current_app.config['ARCHIVE_COMPRESS_WORKERS']),
         mimetype='application/zip'
-    )
\ No newline at end of file
+    )
+    response.headers.set('Content-Disposition', 'attachment', filename=zip_filename)
+    return response
\ No newline at end of file
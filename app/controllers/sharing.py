@@ -1,14 +1,19 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, send_file, session, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, session, current_app, Response
 from app import db
 from app.models.file import File
 from app.models.folder import Folder
 from app.models.shared_link import SharedLink
 from app.models.user import User
 from app.utils.decorators import login_required
+from app.utils.filesystem import iter_archive_entries, real_location, subtree_condition
+from app.utils.storage import sharded_layout, stored_path, folder_exists, list_stored_directory, iter_stored_entries
+from app.utils.http import send_file_ranges
+from app.utils.previews import preview_response
+from app.utils.tiering import record_access
+from app.utils.zipstream import stream_zip, manifest_fingerprint
 from datetime import datetime, timedelta
 import os
-import zipfile
-import tempfile
+import posixpath
 
 sharing = Blueprint('sharing', __name__)
 
@@ -280,7 +285,7 @@ def view_shared(token, subpath=''):
                 file = child_share.file
                 if file:
                     items.append({
-                        'name': os.path.basename(file.name),
+                        'name': file.basename,
                         'full_path': file.name.replace('\\', '/'),
                         'size': file.size,
                         'created_at': file.created_at,
@@ -308,7 +313,13 @@ def view_shared(token, subpath=''):
                         # Add subpath if provided
                         current_path = os.path.join(base_folder_path, os.path.relpath(subpath, folder.name))
                         
-                        if os.path.exists(current_path) and current_path.startswith(os.path.join(current_app.config['UPLOAD_FOLDER'], owner.username)):
+                        if sharded_layout():
+                            # Folders are only rows; list the requested one if it is inside the share
+                            directory = posixpath.normpath(subpath.replace('\\', '/'))
+                            if directory == folder.name or directory.startswith(folder.name + '/'):
+                                for stored in list_stored_directory(folder.owner_id, directory):
+                                    items.append(dict(stored, full_path=stored['path'], share_token=child_share.token))
+                        elif os.path.exists(current_path) and current_path.startswith(os.path.join(current_app.config['UPLOAD_FOLDER'], owner.username)):
                             # List contents of current directory
                             for entry in os.scandir(current_path):
                                 entry_path = os.path.join(subpath, entry.name)
@@ -338,7 +349,7 @@ def view_shared(token, subpath=''):
                     else:
                         # Just add the folder itself
                         items.append({
-                            'name': os.path.basename(folder.name),
+                            'name': folder.basename,
                             'full_path': folder.name.replace('\\', '/'),
                             'size': 0,
                             'created_at': folder.created_at,
@@ -400,14 +411,24 @@ def view_shared(token, subpath=''):
         # Add subpath if provided
         current_path = os.path.join(base_folder_path, subpath) if subpath else base_folder_path
         
-        if not os.path.exists(current_path) or not current_path.startswith(os.path.join(current_app.config['UPLOAD_FOLDER'], owner.username)):
-            abort(404)
-            
         items = []
         current_folder = subpath.replace('\\', '/') if subpath else ''
         
+        if sharded_layout():
+            # Folders are only rows; entry paths stay relative to the shared base
+            directory = posixpath.normpath(posixpath.join(folder_path, current_folder))
+            if not (directory == folder_path or directory.startswith(folder_path + '/')) or not folder_exists(item.owner_id, directory):
+                abort(404)
+            entries = []
+            for stored in list_stored_directory(item.owner_id, directory):
+                items.append(dict(stored, full_path=posixpath.relpath(stored['path'], folder_path)))
+        elif not os.path.exists(current_path) or not current_path.startswith(os.path.join(current_app.config['UPLOAD_FOLDER'], owner.username)):
+            abort(404)
+        else:
+            entries = os.scandir(current_path)
+        
         # List contents of current directory
-        for entry in os.scandir(current_path):
+        for entry in entries:
             entry_path = os.path.relpath(entry.path, base_folder_path)
             is_file = entry.is_file()
             
@@ -429,6 +450,7 @@ def view_shared(token, subpath=''):
                     'full_path': entry_path.replace('\\', '/'),
                     'size': entry.stat().st_size,
                     'created_at': datetime.fromtimestamp(entry.stat().st_ctime),
+                    'mtime_ns': entry.stat().st_mtime_ns,
                     'is_file': True,
                     'id': db_item.id
                 })
@@ -470,9 +492,8 @@ def view_shared(token, subpath=''):
         username=db.session.get(User, session.get('user_id')).username if 'user_id' in session else None
     )
 
-@sharing.route('/shared/<token>/download')
-@sharing.route('/shared/<token>/download/<path:path>')
-def download_shared(token, path=''):
+def _shared_file(token, path):
+    """Resolve a file of a share to ``(owner, name, stored path, download name)``, aborting with 404"""
     share = SharedLink.query.filter_by(token=token).first()
     if not share or not share.is_valid:
         abort(404)
@@ -496,7 +517,9 @@ def download_shared(token, path=''):
         if not owner:
             abort(404)
             
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], owner.username, file.name)
+        file_path = stored_path(owner.username, file)
+        download_name = file.basename
+        name = file.name
     else:
         folder = share.folder
         if not folder:
@@ -514,17 +537,46 @@ def download_shared(token, path=''):
         base_folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], owner.username, folder_path)
         requested_path = path.replace('\\', '/').lstrip('/')
         file_path = os.path.join(base_folder_path, requested_path)
+        download_name = os.path.basename(requested_path)
+        name = posixpath.normpath(posixpath.join(folder_path, requested_path))
         
-        # Security check - make sure the file is within the shared folder
-        real_base = os.path.realpath(base_folder_path)
-        real_file = os.path.realpath(file_path)
-        if not os.path.exists(real_file) or not real_file.startswith(real_base):
-            abort(404)
+        if sharded_layout():
+            # Only files inside the shared folder's rows can be reached
+            file = File.query.filter(
+                File.owner_id == folder.owner_id,
+                File.name == name,
+                subtree_condition(File.name, folder_path)
+            ).first()
+            if not file:
+                abort(404)
+            file_path = stored_path(owner.username, file)
+        else:
+            # Security check - make sure the file is within the shared folder
+            real_base = os.path.realpath(base_folder_path)
+            real_file = real_location(file_path)
+            if not os.path.exists(real_file) or not real_file.startswith(real_base + os.sep):
+                abort(404)
+    
+    if not os.path.isfile(file_path):
+        abort(404)
     
-    if not os.path.exists(file_path):
+    return owner, name, file_path, download_name
+
+@sharing.route('/shared/<token>/download')
+@sharing.route('/shared/<token>/download/<path:path>')
+def download_shared(token, path=''):
+    owner, name, file_path, download_name = _shared_file(token, path)
+    record_access(owner.id, name)
+    return send_file_ranges(file_path, download_name=download_name)
+
+@sharing.route('/shared/<token>/preview')
+@sharing.route('/shared/<token>/preview/<path:path>')
+def preview_shared(token, path=''):
+    _, _, file_path, download_name = _shared_file(token, path)
+    response = preview_response(file_path, download_name)
+    if response is None:
         abort(404)
-        
-    return send_file(file_path, as_attachment=True)
+    return response
 
 @sharing.route('/api/shares/<token>', methods=['GET'])
 @login_required
@@ -589,49 +641,68 @@ def bulk_download():
     else:
         child_shares = [share]
     
-    # Create a temporary directory to store the files
-    temp_dir = tempfile.mkdtemp()
-    
-    # Create a zip file
-    zip_path = os.path.join(temp_dir, 'bulk_download.zip')
-    with zipfile.ZipFile(zip_path, 'w') as zip_file:
-        for child_share in child_shares:
-            if child_share.file_id:
-                file = child_share.file
-                if file:
-                    owner = db.session.get(User, file.owner_id)
-                    if owner:
-                        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], owner.username, file.name)
-                        # Only include files in the current folder for bulk shares
-                        if share.is_bulk_parent:
-                            file_relative_path = file.name.replace('\\', '/')
-                            if current_folder and not file_relative_path.startswith(current_folder):
-                                continue
-                            zip_name = os.path.basename(file.name)
-                        else:
-                            zip_name = os.path.basename(file.name)
-                        zip_file.write(file_path, zip_name)
-            elif child_share.folder_id:
-                folder = child_share.folder
-                if folder:
-                    owner = db.session.get(User, folder.owner_id)
-                    if owner:
-                        folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], owner.username, folder.name)
-                        # If current_folder is specified, adjust the base path
+    # The archive's manifest is listed up front, since the cache key depends on it
+    entries = []
+    for child_share in child_shares:
+        if child_share.file_id:
+            file = child_share.file
+            if file:
+                owner = db.session.get(User, file.owner_id)
+                if owner:
+                    file_path = stored_path(owner.username, file)
+                    # Only include files in the current folder for bulk shares
+                    if share.is_bulk_parent:
+                        file_relative_path = file.name.replace('\\', '/')
+                        if current_folder and not file_relative_path.startswith(current_folder):
+                            continue
+                    entries.append((os.path.basename(file.name), file_path))
+        elif child_share.folder_id:
+            folder = child_share.folder
+            if folder:
+                owner = db.session.get(User, folder.owner_id)
+                if owner:
+                    if sharded_layout():
+                        directory = folder.name
                         if current_folder:
-                            current_path = os.path.join(folder_path, current_folder)
-                            if os.path.exists(current_path) and current_path.startswith(folder_path):
-                                folder_path = current_path
-                        
-                        for root, dirs, files in os.walk(folder_path):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                # Create relative path for the zip file
-                                zip_name = os.path.relpath(file_path, folder_path)
-                                zip_file.write(file_path, zip_name)
-    
-    # Return the zip file
-    return send_file(zip_path, as_attachment=True)
+                            requested = posixpath.normpath(posixpath.join(folder.name, current_folder))
+                            if requested.startswith(folder.name + '/'):
+                                directory = requested
+                        entries.extend(iter_stored_entries(folder.owner_id, owner.username, directory, directory,
+                                                           include_dirs=False))
+                        continue
+                    folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], owner.username, folder.name)
+                    # If current_folder is specified, adjust the base path
+                    if current_folder:
+                        current_path = os.path.join(folder_path, current_folder)
+                        real_base = os.path.realpath(folder_path)
+                        if os.path.exists(current_path) and os.path.realpath(current_path).startswith(real_base + os.sep):
+                            folder_path = current_path
+                    entries.extend(iter_archive_entries(folder_path, folder_path, include_dirs=False))
+
+    # Popular shares are downloaded over and over, so archives are cached
+    # under a key that changes whenever a shared file does
+    level = current_app.config['ARCHIVE_COMPRESS_LEVEL']
+    workers = current_app.config['ARCHIVE_COMPRESS_WORKERS']
+    cache = current_app.extensions['archive_cache']
+    fingerprint, total_size = manifest_fingerprint(entries)
+    if total_size > cache.max_bytes:
+        # Caching would evict everything else and still hold a whole copy on disk
+        response = Response(stream_zip(entries, level, workers=workers), mimetype='application/zip')
+        response.headers.set('Content-Disposition', 'attachment', filename='bulk_download.zip')
+        return response
+
+    cache_key = f'{token}\0{current_folder}\0{level}\0{fingerprint}'
+    cached_path = cache.lookup(cache_key)
+    if cached_path:
+        return send_file_ranges(cached_path, download_name='bulk_download.zip', mimetype='application/zip',
+                                checksum=os.path.basename(cached_path))
+
+    response = Response(
+        cache.get_or_build(cache_key, lambda: stream_zip(entries, level, workers=workers)),
+        mimetype='application/zip'
+    )
+    response.headers.set('Content-Disposition', 'attachment', filename='bulk_download.zip')
+    return response
 
 @sharing.route('/get_user_shares', methods=['GET'])
 @login_required
@@ -0,0 +1,19 @@
+from flask import Blueprint, current_app, jsonify
+from app.utils.sync import read_sync_status
+
+status = Blueprint('status', __name__)
+
+@status.route('/status/sync')
+def sync_status():
+    """Progress of the background filesystem sync, for deploy scripts and readiness probes"""
+    sync = read_sync_status(current_app)
+    return jsonify({
+        'ready': sync.get('state') == 'done',
+        'state': sync.get('state'),
+        'started_at': sync.get('started_at'),
+        'finished_at': sync.get('finished_at'),
+        'users_total': sync.get('users_total'),
+        'users_done': sync.get('users_done'),
+        'directories': sync.get('directories'),
+        'directories_listed': sync.get('scanned')
+    })
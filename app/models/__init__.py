@@ -3,5 +3,8 @@ from app.models.role import Role
 from app.models.file import File
 from app.models.folder import Folder
 from app.models.shared_link import SharedLink
+from app.models.upload_session import UploadSession
+from app.models.directory_state import DirectoryState
+from app.models.job import Job
 
-__all__ = ['User', 'Role', 'File', 'Folder', 'SharedLink'] 
\ No newline at end of file
+__all__ = ['User', 'Role', 'File', 'Folder', 'SharedLink', 'UploadSession', 'DirectoryState', 'Job'] 
\ No newline at end of file
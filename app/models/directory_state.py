@@ -0,0 +1,14 @@
+from app import db
+
+class DirectoryState(db.Model):
+    """Directory mtime and inode as of the last filesystem sync"""
+    __tablename__ = 'directory_state'
+    __table_args__ = (
+        db.Index('ix_directory_state_owner_path', 'owner_id', 'path', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    path = db.Column(db.String(1024), nullable=False)  # Relative to the owner's root, '' for the root itself
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    inode = db.Column(db.BigInteger, nullable=False)
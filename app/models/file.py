@@ -1,11 +1,48 @@
+import posixpath
 from datetime import datetime
+from sqlalchemy.orm import validates
 from app import db
 
+def split_path(name):
+    """Return the basename, extension and parent_path stored alongside a relative path"""
+    parent_path, basename = posixpath.split(name)
+    extension = posixpath.splitext(basename)[1][1:].lower()
+    return {'basename': basename, 'extension': extension, 'parent_path': parent_path}
+
+def path_default(key):
+    """Column default deriving ``key`` from the row's name, for inserts that only set name"""
+    def default(context):
+        return split_path(context.get_current_parameters()['name'])[key]
+    return default
+
 class File(db.Model):
+    __table_args__ = (
+        db.Index('ix_file_owner_name', 'owner_id', 'name', unique=True),
+        db.Index('ix_file_owner_parent', 'owner_id', 'parent_path', 'basename'),
+        db.Index('ix_file_owner_extension', 'owner_id', 'extension'),
+        db.Index('ix_file_sha256', 'sha256'),
+        db.Index('ix_file_storage_key', 'storage_key'),
+        db.Index('ix_file_tier_access', 'tier', 'last_accessed_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
+    # Derived from name, so listings and extension searches can use indexes
+    basename = db.Column(db.String(150), nullable=False, default=path_default('basename'))
+    extension = db.Column(db.String(32), nullable=False, default=path_default('extension'))
+    parent_path = db.Column(db.String(150), nullable=False, default=path_default('parent_path'))
     size = db.Column(db.Integer, default=0)
+    sha256 = db.Column(db.String(64), nullable=True)  # Blob holding the bytes when DEDUP_STORAGE is on
+    storage_key = db.Column(db.String(64), nullable=True)  # Object holding the bytes in the sharded layout; None for the tree
     created_at = db.Column(db.DateTime, default=datetime.now())
+    last_accessed_at = db.Column(db.DateTime, nullable=True)  # Last download, recorded at most hourly
+    tier = db.Column(db.Integer, nullable=False, default=0)  # 0 for the fast tier, n for STORAGE_TIERS[n - 1]
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     view_access = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
-    full_access = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
\ No newline at end of file
+    full_access = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+
+    @validates('name')
+    def _update_path_columns(self, key, name):
+        for column, value in split_path(name).items():
+            setattr(self, column, value)
+        return name
\ No newline at end of file
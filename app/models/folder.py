@@ -1,12 +1,29 @@
 from datetime import datetime
+from sqlalchemy.orm import validates
 from app import db
+from app.models.file import split_path, path_default
 
 class Folder(db.Model):
+    __table_args__ = (
+        db.Index('ix_folder_owner_name', 'owner_id', 'name', unique=True),
+        db.Index('ix_folder_owner_parent', 'owner_id', 'parent_path', 'basename'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
+    # Derived from name, so listings can use an index
+    basename = db.Column(db.String(150), nullable=False, default=path_default('basename'))
+    parent_path = db.Column(db.String(150), nullable=False, default=path_default('parent_path'))
     size = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.now())
     parent_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     view_access = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
-    full_access = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
\ No newline at end of file
+    full_access = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+
+    @validates('name')
+    def _update_path_columns(self, key, name):
+        split = split_path(name)
+        self.basename = split['basename']
+        self.parent_path = split['parent_path']
+        return name
\ No newline at end of file
@@ -0,0 +1,52 @@
+from datetime import datetime
+import json
+import secrets
+from app import db
+
+class Job(db.Model):
+    """A long-running file operation queued for the background workers"""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_state_created', 'state', 'created_at'),
+    )
+
+    id = db.Column(db.String(64), primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)  # copy, move, delete or delete_user
+    owner_id = db.Column(db.Integer, nullable=True, index=True)  # Requesting user; no foreign key, deleted users' jobs outlive them
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON arguments of the operation
+    state = db.Column(db.String(16), nullable=False, default='queued')  # queued, running, done or failed
+    files_total = db.Column(db.Integer, nullable=False, default=0)
+    files_done = db.Column(db.Integer, nullable=False, default=0)
+    bytes_total = db.Column(db.BigInteger, nullable=False, default=0)
+    bytes_done = db.Column(db.BigInteger, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # Times a worker has claimed the job
+    result = db.Column(db.Text, nullable=True)  # JSON summary once done
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # Refreshed while a worker runs the job
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __init__(self, **kwargs):
+        super(Job, self).__init__(**kwargs)
+        if not self.id:
+            self.id = secrets.token_urlsafe(16)
+
+    @property
+    def arguments(self):
+        return json.loads(self.params or '{}')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'files_total': self.files_total,
+            'files_done': self.files_done,
+            'bytes_total': self.bytes_total,
+            'bytes_done': self.bytes_done,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
\ No newline at end of file
@@ -7,11 +7,11 @@ class SharedLink(db.Model):
     token = db.Column(db.String(64), unique=True, nullable=False)
     file_id = db.Column(db.Integer, db.ForeignKey('file.id'), nullable=True)
     folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
-    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
     expires_at = db.Column(db.DateTime, nullable=True)
     is_active = db.Column(db.Boolean, default=True)
-    bulk_share_id = db.Column(db.String(64), nullable=True)  # Used to group bulk shares together
+    bulk_share_id = db.Column(db.String(64), nullable=True, index=True)  # Used to group bulk shares together
     is_bulk_parent = db.Column(db.Boolean, default=False)  # Indicates if this is the main share for a bulk share
     name = db.Column(db.String(255), nullable=True)  # Name for virtual folders in bulk shares
     description = db.Column(db.String(500), nullable=True)
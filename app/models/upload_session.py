@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+import json
+import secrets
+from app import db
+
+class UploadSession(db.Model):
+    __tablename__ = 'upload_sessions'
+
+    id = db.Column(db.String(64), primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    path = db.Column(db.String(1024), nullable=False)  # Destination path relative to the owner's root
+    size = db.Column(db.BigInteger, nullable=False)  # Total bytes announced by the client
+    received = db.Column(db.BigInteger, nullable=False, default=0)  # Bytes written so far
+    ranges = db.Column(db.Text, nullable=False, default='[]')  # JSON list of merged [start, end) byte ranges
+    version = db.Column(db.Integer, nullable=False, default=0)  # Bumped on every update for optimistic locking
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @staticmethod
+    def generate_id():
+        return secrets.token_urlsafe(24)
+
+    def __init__(self, **kwargs):
+        super(UploadSession, self).__init__(**kwargs)
+        if not self.id:
+            self.id = self.generate_id()
+
+    @property
+    def received_ranges(self):
+        return [tuple(byte_range) for byte_range in json.loads(self.ranges or '[]')]
+
+    @property
+    def offset(self):
+        """End of the contiguous prefix received so far, where a sequential client resumes"""
+        ranges = self.received_ranges
+        return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+    @property
+    def is_complete(self):
+        return self.received >= self.size
+
+    @property
+    def is_expired(self):
+        return datetime.now() > self.expires_at
+
+    def touch(self, ttl_seconds):
+        self.expires_at = datetime.now() + timedelta(seconds=ttl_seconds)
@@ -10,4 +10,5 @@ class User(db.Model):
     password = db.Column(db.String(150), nullable=False)
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
-    storage_quota = db.Column(db.BigInteger, nullable=True)  # Can be null for unlimited storage
\ No newline at end of file
+    storage_quota = db.Column(db.BigInteger, nullable=True)  # Can be null for unlimited storage
+    storage_used = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')  # Bytes used, kept up to date by every write path
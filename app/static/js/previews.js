@@ -0,0 +1,62 @@
+// Previews are rendered lazily: the server answers 202 with a placeholder
+// until a preview is ready, so keep asking for a little while
+const PREVIEW_RETRIES = 10;
+
+function fetchPreview(url, attempt = 0) {
+    return fetch(url, { credentials: 'same-origin' }).then(response => {
+        if (response.status === 202 && attempt < PREVIEW_RETRIES) {
+            const delay = (parseInt(response.headers.get('Retry-After'), 10) || 1) * 1000;
+            return new Promise(resolve => setTimeout(resolve, delay))
+                .then(() => fetchPreview(url, attempt + 1));
+        }
+        return response.status === 200 ? response : null;
+    });
+}
+
+function loadThumbnails() {
+    document.querySelectorAll('img[data-preview-src]').forEach(image => {
+        fetchPreview(image.dataset.previewSrc).then(response => response && response.blob()).then(blob => {
+            if (!blob) {
+                return;
+            }
+            image.src = URL.createObjectURL(blob);
+            image.hidden = false;
+            // The icon stands in until the thumbnail arrives
+            const icon = image.previousElementSibling;
+            if (icon && icon.tagName === 'I') {
+                icon.hidden = true;
+            }
+        }).catch(() => {});
+    });
+}
+
+// Text previews are only fetched when the pointer first rests on the file
+function attachTextPreviews() {
+    document.querySelectorAll('[data-text-preview]').forEach(element => {
+        element.addEventListener('mouseenter', () => {
+            fetchPreview(element.dataset.textPreview).then(response => response && response.text()).then(text => {
+                if (text) {
+                    element.title = text;
+                }
+            }).catch(() => {});
+        }, { once: true });
+    });
+}
+
+// A single shared file shows its text preview right away
+function loadInlineTextPreviews() {
+    document.querySelectorAll('[data-text-preview-inline]').forEach(element => {
+        fetchPreview(element.dataset.textPreviewInline).then(response => response && response.text()).then(text => {
+            if (text) {
+                element.textContent = text;
+                element.hidden = false;
+            }
+        }).catch(() => {});
+    });
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    loadThumbnails();
+    attachTextPreviews();
+    loadInlineTextPreviews();
+});
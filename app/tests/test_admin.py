@@ -1,4 +1,5 @@
 import pytest
+from app.models.file import File
 from app.models.user import User
 from app.models.role import Role
 from werkzeug.security import generate_password_hash
@@ -185,4 +186,39 @@ def test_delete_user(admin_client, app):
     # Verify user was deleted from database
     with app.app_context():
         user = db.session.get(User, user_id)
-        assert user is None
\ No newline at end of file
+        assert user is None
+
+def test_metrics_are_sampled_in_the_background(admin_client, app):
+    """Test that the dashboard shows the latest sample and the API serves the sample history"""
+    sampler = app.extensions['metrics_sampler']
+    assert admin_client.get('/admin').status_code == 200
+    assert len(sampler.history()) == 1
+
+    admin_client.get('/admin/api/metrics')
+    sampler.sample()
+    samples = admin_client.get('/admin/api/metrics').get_json()['samples']
+    assert len(samples) == 2
+    assert {'cpu_percent', 'memory_percent', 'disk_percent', 'requests_per_second'} <= set(samples[-1])
+    assert samples[-1]['requests_per_second'] > 0
+    assert len(admin_client.get('/admin/api/metrics?limit=1').get_json()['samples']) == 1
+
+
+def test_usage_snapshot_groups_files_by_user_and_folder(admin_client, app):
+    """Test that storage usage is aggregated per user and per top-level folder"""
+    with app.app_context():
+        admin_id = User.query.filter_by(username='adminuser').one().id
+        db.session.add_all([
+            File(name='photos/a.jpg', size=100, owner_id=admin_id),
+            File(name='photos/2024/b.jpg', size=50, owner_id=admin_id),
+            File(name='notes.txt', size=7, owner_id=admin_id)
+        ])
+        db.session.commit()
+
+    usage = admin_client.get('/admin/api/usage?refresh=1').get_json()
+    assert usage['users'][str(admin_id)] == {'files': 3, 'bytes': 157}
+    assert usage['total_bytes'] == 157
+    assert usage['largest_folders'][0] == {'username': 'adminuser', 'path': 'photos', 'files': 2, 'bytes': 150}
+
+    response = admin_client.get('/admin?page=2')
+    assert response.status_code == 200
+    assert b'photos' in response.data
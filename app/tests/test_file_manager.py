@@ -1,4 +1,7 @@
+import base64
 import os
+import sys
+import zipfile
 import pytest
 from io import BytesIO
 from app.models.file import File
@@ -182,6 +185,49 @@ def test_file_download(authenticated_client, app, test_user):
         assert response.status_code == 200
         assert response.data == b'test download content'
 
+def test_file_download_ranges(authenticated_client, app, test_user):
+    """Test range requests and conditional GETs on file downloads"""
+    authenticated_client.post(
+        '/browse/upload/',
+        data={'file': (BytesIO(b'0123456789abcdef'), 'ranges.txt')},
+        content_type='multipart/form-data',
+        follow_redirects=True
+    )
+
+    response = authenticated_client.get('/browse/download/ranges.txt')
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    etag = response.headers['ETag']
+
+    response = authenticated_client.get('/browse/download/ranges.txt', headers={'Range': 'bytes=2-5'})
+    assert response.status_code == 206
+    assert response.data == b'2345'
+    assert response.headers['Content-Range'] == 'bytes 2-5/16'
+
+    response = authenticated_client.get('/browse/download/ranges.txt', headers={'Range': 'bytes=-3'})
+    assert response.status_code == 206
+    assert response.data == b'def'
+
+    response = authenticated_client.get('/browse/download/ranges.txt', headers={'Range': 'bytes=0-1,10-11'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    assert b'Content-Range: bytes 0-1/16\r\n\r\n01\r\n' in response.data
+    assert b'Content-Range: bytes 10-11/16\r\n\r\nab\r\n' in response.data
+    assert int(response.headers['Content-Length']) == len(response.data)
+
+    response = authenticated_client.get('/browse/download/ranges.txt', headers={'Range': 'bytes=100-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */16'
+
+    response = authenticated_client.get('/browse/download/ranges.txt', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    # A stale If-Range validator gets the whole file
+    response = authenticated_client.get('/browse/download/ranges.txt',
+                                        headers={'Range': 'bytes=2-5', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == b'0123456789abcdef'
+
 def test_file_deletion(authenticated_client, app, test_user):
     """Test deleting a file"""
     # First upload a file
@@ -210,4 +256,757 @@ def test_file_deletion(authenticated_client, app, test_user):
         
         # Verify file was deleted from database
         file = File.query.filter_by(id=file_id).first()
-        assert file is None
\ No newline at end of file
+        assert file is None
+
+def test_browse_reconciles_untracked_entries(authenticated_client, app, test_user):
+    """Test that browsing creates database rows for entries added outside the app"""
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        user = db.session.get(User, test_user)
+        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], user.username)
+        os.makedirs(os.path.join(user_folder, 'outside_folder'), exist_ok=True)
+        for index in range(3):
+            with open(os.path.join(user_folder, f'outside_{index}.txt'), 'wb') as f:
+                f.write(b'x' * (index + 1))
+
+    response = authenticated_client.get('/browse/')
+    assert response.status_code == 200
+    assert b'outside_0.txt' in response.data
+
+    with app.app_context():
+        assert File.query.filter_by(owner_id=test_user).count() == 3
+        assert File.query.filter_by(name='outside_2.txt', owner_id=test_user).first().size == 3
+        assert Folder.query.filter_by(name='outside_folder', owner_id=test_user).first() is not None
+
+    # A second visit must not create duplicate rows
+    authenticated_client.get('/browse/')
+    with app.app_context():
+        assert File.query.filter_by(owner_id=test_user).count() == 3
+
+
+def test_browse_api_pagination(authenticated_client, app, test_user):
+    """Test that the JSON listing pages through a directory with a cursor"""
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        user = db.session.get(User, test_user)
+        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], user.username)
+        os.makedirs(os.path.join(user_folder, 'folder'), exist_ok=True)
+        for index in range(5):
+            with open(os.path.join(user_folder, f'file_{index}.txt'), 'wb') as f:
+                f.write(b'x' * (index + 1))
+
+    names = []
+    cursor = None
+    while True:
+        query = {'limit': 2, 'sort': 'size', 'order': 'desc'}
+        if cursor:
+            query['cursor'] = cursor
+        response = authenticated_client.get('/api/browse/', query_string=query)
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['total'] == 6
+        assert all(item['id'] is not None for item in data['items'])
+        names.extend(item['name'] for item in data['items'])
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+
+    assert names == ['folder', 'file_4.txt', 'file_3.txt', 'file_2.txt', 'file_1.txt', 'file_0.txt']
+
+    response = authenticated_client.get('/api/browse/', query_string={'sort': 'colour'})
+    assert response.status_code == 400
+
+    # Malformed cursors, and ones whose key does not fit the sort, are refused rather than restarting
+    wrong_types = base64.urlsafe_b64encode(b'[true,[null,"a","a"]]').decode('ascii')
+    for bad in ('not-a-cursor', wrong_types):
+        response = authenticated_client.get('/api/browse/', query_string={'sort': 'size', 'cursor': bad})
+        assert response.status_code == 400
+
+
+def test_browse_listing_cache(authenticated_client, app, test_user):
+    """Test that repeated browsing is served from the listing cache until a mutation"""
+    authenticated_client.get('/browse/')
+    authenticated_client.get('/browse/')
+    cache = app.extensions['listing_cache']
+    assert cache.hits == 1
+
+    authenticated_client.post('/browse/upload/', data={
+        'file': (BytesIO(b'new content'), 'cached.txt')
+    }, content_type='multipart/form-data')
+
+    response = authenticated_client.get('/browse/')
+    assert b'cached.txt' in response.data
+    assert cache.invalidations >= 1
+
+    # The ids looked up for the page are kept with the cached listing
+    cached = cache.get(test_user, '', os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser'))
+    assert cached and all(item['id'] is not None for item in cached)
+
+def test_listing_cache_hands_out_copies(tmp_path):
+    """Test that changing listed items never alters the cached listing"""
+    from app.utils.listing_cache import ListingCache
+    cache = ListingCache()
+    items = [{'name': 'a.txt', 'path': 'a.txt', 'id': None}]
+    cache.put(1, '', os.stat(tmp_path).st_mtime_ns, items)
+    items[0]['id'] = 7
+
+    listed = cache.get(1, '', str(tmp_path))
+    assert listed[0]['id'] is None
+    listed[0]['id'] = 8
+    assert cache.get(1, '', str(tmp_path))[0]['id'] is None
+
+
+def test_storage_counter_tracks_uploads_and_deletes(authenticated_client, app, test_user, runner):
+    """Test that the stored storage counter follows uploads, deletes and repairs"""
+    authenticated_client.post('/browse/upload/', data={
+        'file': (BytesIO(b'12345'), 'counted.txt')
+    }, content_type='multipart/form-data')
+
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        assert db.session.get(User, test_user).storage_used == 5
+
+    authenticated_client.post('/browse/delete/counted.txt')
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        db.session.expire_all()
+        assert db.session.get(User, test_user).storage_used == 0
+
+        # Corrupt the counter and let the repair command fix it
+        user = db.session.get(User, test_user)
+        user.storage_used = 999
+        db.session.commit()
+
+    result = runner.invoke(args=['recalculate-storage', '--username', 'fileuser'])
+    assert result.exit_code == 0
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        db.session.expire_all()
+        assert db.session.get(User, test_user).storage_used == 0
+
+
+def test_resumable_upload(authenticated_client, app, test_user):
+    """Test a chunked upload sent out of order, resumed and finalized"""
+    response = authenticated_client.post('/api/uploads', json={
+        'filename': 'big.bin', 'path': 'chunks', 'size': 10
+    })
+    assert response.status_code == 201
+    upload_id = response.get_json()['upload_id']
+
+    # Second half first, as a parallel client might
+    response = authenticated_client.patch(f'/api/uploads/{upload_id}', data=b'56789',
+                                          headers={'Upload-Offset': '5'})
+    assert response.status_code == 200
+    assert response.get_json()['offset'] == 0
+
+    response = authenticated_client.get(f'/api/uploads/{upload_id}')
+    assert response.headers['Upload-Offset'] == '0'
+    assert response.get_json()['received'] == 5
+
+    response = authenticated_client.post(f'/api/uploads/{upload_id}/finalize')
+    assert response.status_code == 409
+
+    response = authenticated_client.patch(f'/api/uploads/{upload_id}', data=b'01234',
+                                          headers={'Upload-Offset': '0'})
+    assert response.get_json()['complete'] is True
+
+    response = authenticated_client.post(f'/api/uploads/{upload_id}/finalize')
+    assert response.status_code == 200
+
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        user = db.session.get(User, test_user)
+        file = File.query.filter_by(name='chunks/big.bin', owner_id=test_user).first()
+        assert file is not None and file.size == 10
+        assert user.storage_used == 10
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], user.username, 'chunks', 'big.bin'), 'rb') as f:
+            assert f.read() == b'0123456789'
+
+    assert authenticated_client.get(f'/api/uploads/{upload_id}').status_code == 404
+
+def test_upload_sessions_sanitize_paths_and_reserve_quota(authenticated_client, app, test_user):
+    """Test that upload paths never get empty segments and open sessions count against the quota"""
+    response = authenticated_client.post('/api/uploads', json={
+        'filename': 'a/../b.bin', 'path': 'x/../y', 'size': 6 * 1024 * 1024
+    })
+    assert response.status_code == 201
+    assert response.get_json()['path'] == 'x/y/a/b.bin'
+
+    # The 10MB quota is still empty, but the first session has announced 6MB of it
+    response = authenticated_client.post('/api/uploads', json={'filename': 'c.bin', 'size': 6 * 1024 * 1024})
+    assert response.status_code == 413
+    response = authenticated_client.post('/api/uploads', json={'filename': 'c.bin', 'size': 4 * 1024 * 1024})
+    assert response.status_code == 201
+    upload_id = response.get_json()['upload_id']
+
+    # A session's own reservation does not stand in the way of finalizing it
+    authenticated_client.patch(f'/api/uploads/{upload_id}', data=b'x' * (4 * 1024 * 1024),
+                               headers={'Upload-Offset': '0'})
+    assert authenticated_client.post(f'/api/uploads/{upload_id}/finalize').status_code == 200
+
+def test_bulk_download_streams_zip(authenticated_client, app, test_user):
+    """Test that bulk downloads stream a valid archive of files and folders"""
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        user = db.session.get(User, test_user)
+        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], user.username)
+        os.makedirs(os.path.join(user_folder, 'album', 'empty'), exist_ok=True)
+        with open(os.path.join(user_folder, 'notes.txt'), 'wb') as f:
+            f.write(b'notes ' * 1000)
+        with open(os.path.join(user_folder, 'album', 'photo.jpg'), 'wb') as f:
+            f.write(os.urandom(2048))
+
+    response = authenticated_client.post('/bulk-download', json={'items': [
+        {'type': 'file', 'path': 'notes.txt'},
+        {'type': 'folder', 'path': 'album'},
+        {'type': 'file', 'path': '../outside.txt'}
+    ]})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+
+    archive = zipfile.ZipFile(BytesIO(response.data))
+    assert archive.testzip() is None
+    assert archive.read('notes.txt') == b'notes ' * 1000
+    assert archive.getinfo('notes.txt').compress_type == zipfile.ZIP_DEFLATED
+    assert archive.getinfo('album/photo.jpg').compress_type == zipfile.ZIP_STORED
+    assert 'album/empty/' in archive.namelist()
+    assert not any('outside' in name for name in archive.namelist())
+
+def test_bulk_download_parallel_compression(authenticated_client, app, test_user):
+    """Test that archives compressed on several threads unpack to the original files"""
+    app.config['ARCHIVE_COMPRESS_WORKERS'] = 4
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        user = db.session.get(User, test_user)
+        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], user.username, 'logs')
+        os.makedirs(user_folder, exist_ok=True)
+        large = b''.join(b'line %d of the log\n' % i for i in range(200000))
+        with open(os.path.join(user_folder, 'large.log'), 'wb') as f:
+            f.write(large)
+        for i in range(10):
+            with open(os.path.join(user_folder, f'small-{i}.txt'), 'wb') as f:
+                f.write(b'small file %d' % i)
+
+    response = authenticated_client.post('/bulk-download', json={'items': [{'type': 'folder', 'path': 'logs'}]})
+    archive = zipfile.ZipFile(BytesIO(response.data))
+    assert archive.testzip() is None
+    assert archive.read('logs/large.log') == large
+    assert archive.getinfo('logs/large.log').compress_size < len(large) // 2
+    assert archive.read('logs/small-7.txt') == b'small file 7'
+
+def test_incremental_sync(app, test_user):
+    """Test that the filesystem sync only lists directories that changed"""
+    import shutil
+    import time
+    from app.utils.sync import sync_user_tree
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        root = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+        os.makedirs(os.path.join(root, 'docs', 'old'))
+        for name in ('a.txt', 'docs/b.txt', 'docs/old/c.txt'):
+            with open(os.path.join(root, name), 'wb') as f:
+                f.write(b'data')
+        # Older versions recorded directories as File rows
+        db.session.add(File(name='docs', owner_id=test_user))
+        db.session.commit()
+
+        # Back-date the directories so their state is not considered racy
+        past = time.time() - 60
+        for directory in (root, os.path.join(root, 'docs'), os.path.join(root, 'docs', 'old')):
+            os.utime(directory, (past, past))
+
+        stats = sync_user_tree(test_user, root)
+        assert stats['scanned'] == 3
+        assert {f.name for f in File.query.filter_by(owner_id=test_user)} == {'a.txt', 'docs/b.txt', 'docs/old/c.txt'}
+        folders = {f.name: f for f in Folder.query.filter_by(owner_id=test_user)}
+        assert set(folders) == {'docs', 'docs/old'}
+        assert folders['docs/old'].parent_id == folders['docs'].id
+
+        stats = sync_user_tree(test_user, root)
+        assert stats['directories'] == 3
+        assert stats.get('scanned', 0) == 0
+
+        # Removing a subtree only changes its parent directory
+        shutil.rmtree(os.path.join(root, 'docs', 'old'))
+        os.utime(os.path.join(root, 'docs'), (past + 1, past + 1))
+        stats = sync_user_tree(test_user, root)
+        assert stats['scanned'] == 1
+        assert {f.name for f in File.query.filter_by(owner_id=test_user)} == {'a.txt', 'docs/b.txt'}
+        assert {f.name for f in Folder.query.filter_by(owner_id=test_user)} == {'docs'}
+
+def test_startup_sync_status(app, client, test_user):
+    """Test that the startup sync reports its progress and is not repeated right away"""
+    from app.utils.sync import run_startup_sync
+    assert client.get('/status/sync').get_json()['state'] == 'pending'
+
+    run_startup_sync(app)
+    status = client.get('/status/sync').get_json()
+    assert status['ready'] is True
+    assert status['users_done'] == status['users_total'] == 1
+    finished_at = status['finished_at']
+
+    # A worker booting right after a finished sync skips its own
+    run_startup_sync(app)
+    assert client.get('/status/sync').get_json()['finished_at'] == finished_at
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_filesystem_watcher_applies_outside_changes(app, test_user):
+    """Test that files created outside the app are recorded by the watcher"""
+    from app.utils.watcher import FilesystemWatcher
+    root = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+    watcher = FilesystemWatcher(app)
+    watcher.start_watching()
+    try:
+        os.makedirs(os.path.join(root, 'dropped'))
+        with open(os.path.join(root, 'dropped', 'report.txt'), 'wb') as f:
+            f.write(b'written by rsync')
+        watcher.process_events(1)
+        watcher.process_events(0.2)
+        watcher.flush()
+    finally:
+        watcher.close()
+
+    with app.app_context():
+        file = File.query.filter_by(owner_id=test_user, name='dropped/report.txt').first()
+        assert file is not None
+        assert file.size == len(b'written by rsync')
+        assert Folder.query.filter_by(owner_id=test_user, name='dropped').first() is not None
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_filesystem_watcher_waits_for_app_writes(app, test_user):
+    """Test that the watcher leaves paths alone while the app is still writing their rows"""
+    from app.utils.watcher import FilesystemWatcher, app_write
+    app.config['FILESYSTEM_WATCHER'] = True
+    root = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+    os.makedirs(os.path.join(root, 'incoming'))
+    watcher = FilesystemWatcher(app)
+    watcher.start_watching()
+    try:
+        with app.app_context(), app_write(test_user, 'incoming/upload.txt'):
+            with open(os.path.join(root, 'incoming', 'upload.txt'), 'wb') as f:
+                f.write(b'still being recorded')
+            watcher.process_events(1)
+            watcher.process_events(0.2)
+            watcher.flush()
+            assert File.query.filter_by(owner_id=test_user, name='incoming/upload.txt').first() is None
+            assert watcher._dirty
+
+        # Applied once the write is over
+        watcher.flush()
+    finally:
+        watcher.close()
+
+    with app.app_context():
+        assert File.query.filter_by(owner_id=test_user, name='incoming/upload.txt').first() is not None
+        assert not os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], '.operations'))
+
+
+def test_search_uses_index(authenticated_client, app, test_user):
+    """Test that search ranks name prefix matches first and follows renames and deletes"""
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        db.session.add_all([
+            File(name='archive/old-report.pdf', size=1, owner_id=test_user),
+            File(name='reports/summary.txt', size=2, owner_id=test_user),
+            File(name='notes.txt', size=3, owner_id=test_user),
+            Folder(name='reports', owner_id=test_user)
+        ])
+        db.session.commit()
+
+    response = authenticated_client.get('/search?q=report')
+    assert response.status_code == 200
+    paths = [item['path'] for item in response.get_json()['results']]
+    assert paths[0] == 'reports'
+    assert set(paths) == {'reports', 'archive/old-report.pdf', 'reports/summary.txt'}
+
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        File.query.filter_by(owner_id=test_user, name='notes.txt').update({'name': 'report-notes.txt'})
+        File.query.filter_by(owner_id=test_user, name='archive/old-report.pdf').delete()
+        db.session.commit()
+
+    paths = [item['path'] for item in authenticated_client.get('/search?q=report').get_json()['results']]
+    assert 'report-notes.txt' in paths
+    assert 'archive/old-report.pdf' not in paths
+
+    # Too short for the trigram index, so it falls back to a scan
+    paths = [item['path'] for item in authenticated_client.get('/search?q=no').get_json()['results']]
+    assert paths == ['report-notes.txt']
+
+
+def test_search_pagination_and_filters(authenticated_client, app, test_user):
+    """Test that search pages through results with a cursor and applies filters"""
+    from datetime import datetime
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        for index in range(7):
+            db.session.add(File(name=f'photos/holiday-{index}.jpg', size=index * 1000, owner_id=test_user,
+                                created_at=datetime(2024, 1, index + 1)))
+        db.session.add(File(name='holiday-plan.pdf', size=500, owner_id=test_user, created_at=datetime(2024, 2, 1)))
+        db.session.add(Folder(name='holiday', owner_id=test_user, created_at=datetime(2024, 3, 1)))
+        db.session.commit()
+
+    paths = []
+    cursor = None
+    while True:
+        query = {'q': 'holiday', 'limit': 3}
+        if cursor:
+            query['cursor'] = cursor
+        data = authenticated_client.get('/search', query_string=query).get_json()
+        assert data['total'] == 9
+        assert data['total_exact']
+        assert len(data['results']) <= 3
+        paths.extend(item['path'] for item in data['results'])
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+    assert len(paths) == len(set(paths)) == 9
+
+    def search(**params):
+        data = authenticated_client.get('/search', query_string=dict(q='holiday', **params)).get_json()
+        return sorted(item['path'] for item in data['results'])
+
+    assert search(type='folder') == ['holiday']
+    assert search(ext='pdf') == ['holiday-plan.pdf']
+    assert search(ext='jpg', min_size=2000, max_size=3000) == ['photos/holiday-2.jpg', 'photos/holiday-3.jpg']
+    assert search(created_after='2024-01-06', created_before='2024-02-02') == [
+        'holiday-plan.pdf', 'photos/holiday-5.jpg', 'photos/holiday-6.jpg'
+    ]
+
+    response = authenticated_client.get('/search', query_string={'q': 'holiday', 'min_size': 'big'})
+    assert response.status_code == 400
+    response = authenticated_client.get('/search', query_string={'q': 'holiday', 'cursor': 'garbage'})
+    assert response.status_code == 400
+
+
+def test_path_columns_follow_moves(authenticated_client, app, test_user):
+    """Test that basename, extension and parent_path stay in step with name"""
+    from app.utils.filesystem import direct_children_query
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+        os.makedirs(os.path.join(user_folder, 'album', 'raw'), exist_ok=True)
+        os.makedirs(os.path.join(user_folder, 'archive'), exist_ok=True)
+        with open(os.path.join(user_folder, 'album', 'raw', 'IMG_1.JPG'), 'wb') as f:
+            f.write(b'jpeg')
+        db.session.add_all([
+            Folder(name='album', owner_id=test_user),
+            Folder(name='album/raw', owner_id=test_user),
+            Folder(name='archive', owner_id=test_user),
+            File(name='album/raw/IMG_1.JPG', size=4, owner_id=test_user)
+        ])
+        db.session.commit()
+        image = File.query.filter_by(owner_id=test_user, name='album/raw/IMG_1.JPG').one()
+        assert (image.basename, image.extension, image.parent_path) == ('IMG_1.JPG', 'jpg', 'album/raw')
+
+    response = authenticated_client.post('/browse/move', data={
+        'source_path': 'album',
+        'destination_path': 'archive',
+        'is_file': 'false'
+    })
+    assert response.get_json()['status'] == 'success'
+
+    with app.app_context():
+        image = File.query.filter_by(owner_id=test_user, name='archive/album/raw/IMG_1.JPG').one()
+        assert (image.basename, image.extension, image.parent_path) == ('IMG_1.JPG', 'jpg', 'archive/album/raw')
+        raw = Folder.query.filter_by(owner_id=test_user, name='archive/album/raw').one()
+        assert (raw.basename, raw.parent_path) == ('raw', 'archive/album')
+        album = Folder.query.filter_by(owner_id=test_user, name='archive/album').one()
+        assert (album.basename, album.parent_path) == ('album', 'archive')
+        assert [row.name for row in direct_children_query(Folder, test_user, 'archive')] == ['archive/album']
+
+
+def test_dedup_storage_shares_blobs(authenticated_client, app, test_user):
+    """Test that identical uploads and copies share one blob, which is collected once unused"""
+    from app.utils.blobs import blob_path, collect_garbage
+    app.config['DEDUP_STORAGE'] = True
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+    for name in ('first.txt', 'second.txt'):
+        authenticated_client.post('/browse/upload/', data={
+            'file': (BytesIO(b'identical content'), name)
+        }, content_type='multipart/form-data')
+    os.makedirs(os.path.join(user_folder, 'copies'), exist_ok=True)
+    response = authenticated_client.post('/browse/copy', data={
+        'source_path': 'first.txt',
+        'destination_path': 'copies',
+        'is_file': 'true'
+    })
+    assert response.get_json()['status'] == 'success'
+
+    with app.app_context():
+        digests = {f.sha256 for f in File.query.filter_by(owner_id=test_user).all()}
+        assert len(digests) == 1 and None not in digests
+        blob = blob_path(digests.pop())
+        paths = [os.path.join(user_folder, name) for name in ('first.txt', 'second.txt', 'copies/first.txt')]
+        assert all(os.path.samestat(os.stat(blob), os.stat(path)) for path in paths)
+        assert os.stat(blob).st_nlink == 4
+
+        for path in paths:
+            os.remove(path)
+        assert collect_garbage()['removed'] == 1
+        assert not os.path.exists(blob)
+
+
+def test_copy_reports_strategy(authenticated_client, app, test_user):
+    """Test that copies go through the copy engine and report how each file was copied"""
+    from app.utils.copy_engine import STRATEGIES, copy_file
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+    os.makedirs(os.path.join(user_folder, 'src', 'nested'), exist_ok=True)
+    os.makedirs(os.path.join(user_folder, 'dest'), exist_ok=True)
+    for name in ('src/one.txt', 'src/nested/two.txt'):
+        with open(os.path.join(user_folder, name), 'wb') as f:
+            f.write(b'copy me ' * 1000)
+
+    response = authenticated_client.post('/browse/copy', data={
+        'source_path': 'src',
+        'destination_path': 'dest',
+        'is_file': 'false'
+    })
+    data = response.get_json()
+    assert data['status'] == 'success'
+    assert sum(data['strategies'].values()) == 2
+    assert set(data['strategies']) <= set(STRATEGIES)
+    with open(os.path.join(user_folder, 'dest', 'src', 'nested', 'two.txt'), 'rb') as f:
+        assert f.read() == b'copy me ' * 1000
+
+    # An existing destination is replaced, not written through
+    source = os.path.join(user_folder, 'src', 'one.txt')
+    destination = os.path.join(user_folder, 'dest', 'src', 'one.txt')
+    linked = destination + '.link'
+    os.link(destination, linked)
+    with open(source, 'wb') as f:
+        f.write(b'changed')
+    assert copy_file(source, destination, strategies=('buffered',)) == 'buffered'
+    with open(destination, 'rb') as f:
+        assert f.read() == b'changed'
+    with open(linked, 'rb') as f:
+        assert f.read() == b'copy me ' * 1000
+
+
+def test_large_operations_run_as_jobs(authenticated_client, app, test_user):
+    """Test that large copies and deletes are queued, report progress and resume after an interruption"""
+    from datetime import datetime, timedelta
+    from app.models.job import Job
+    from app.utils.jobs import claim_job, run_job
+    app.config['JOB_INLINE_MAX_FILES'] = 1
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+    os.makedirs(os.path.join(user_folder, 'big', 'nested'), exist_ok=True)
+    os.makedirs(os.path.join(user_folder, 'dest'), exist_ok=True)
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        db.session.add_all([Folder(name='big', owner_id=test_user), Folder(name='big/nested', owner_id=test_user),
+                            Folder(name='dest', owner_id=test_user)])
+        for name in ('big/one.txt', 'big/nested/two.txt'):
+            with open(os.path.join(user_folder, name), 'wb') as f:
+                f.write(b'x' * 100)
+            db.session.add(File(name=name, size=100, owner_id=test_user))
+        db.session.commit()
+
+    response = authenticated_client.post('/browse/copy', data={
+        'source_path': 'big',
+        'destination_path': 'dest',
+        'is_file': 'false'
+    })
+    assert response.status_code == 202
+    job_url = response.get_json()['job_url']
+    assert authenticated_client.get(job_url).get_json()['job']['state'] == 'queued'
+
+    with app.app_context():
+        run_job(claim_job())
+        assert claim_job() is None
+    job = authenticated_client.get(job_url).get_json()['job']
+    assert (job['state'], job['files_done'], job['bytes_done'], job['files_total']) == ('done', 2, 200, 2)
+    assert os.path.exists(os.path.join(user_folder, 'dest', 'big', 'nested', 'two.txt'))
+    with app.app_context():
+        assert File.query.filter_by(owner_id=test_user, name='dest/big/nested/two.txt').count() == 1
+
+    # A delete whose worker died mid-way is taken over once its heartbeat is stale
+    authenticated_client.post('/browse/delete/big')
+    with app.app_context():
+        job_id = claim_job()
+        os.remove(os.path.join(user_folder, 'big', 'one.txt'))
+        assert claim_job() is None
+        job = db.session.get(Job, job_id)
+        job.heartbeat_at = datetime.now() - timedelta(seconds=app.config['JOB_STALE_AFTER'] + 1)
+        db.session.commit()
+        assert claim_job() == job_id
+        job = run_job(job_id)
+        assert (job.state, job.attempts) == ('done', 2)
+        assert not os.path.exists(os.path.join(user_folder, 'big'))
+        assert File.query.filter(File.owner_id == test_user, File.name.startswith('big/')).count() == 0
+        assert Folder.query.filter_by(owner_id=test_user, name='big').count() == 0
+
+
+def test_sharded_layout_keeps_folders_in_database(authenticated_client, app, test_user, runner):
+    """Test that the sharded layout stores bytes by key, keeps folders as rows and migrates both ways"""
+    from app.utils.storage import object_path
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+    os.makedirs(os.path.join(user_folder, 'old'), exist_ok=True)
+    with open(os.path.join(user_folder, 'old', 'legacy.txt'), 'wb') as f:
+        f.write(b'from the tree')
+    app.config['STORAGE_LAYOUT'] = 'sharded'
+
+    authenticated_client.post('/browse/upload/', data={'folder_name': 'docs'})
+    authenticated_client.post('/browse/upload/docs', data={
+        'file': (BytesIO(b'sharded bytes'), 'report.txt')
+    }, content_type='multipart/form-data')
+    assert not os.path.exists(os.path.join(user_folder, 'docs'))
+    with app.app_context():
+        key = File.query.filter_by(owner_id=test_user, name='docs/report.txt').one().storage_key
+        assert os.path.isfile(object_path(key))
+
+    listing = authenticated_client.get('/api/browse/docs').get_json()
+    assert [item['name'] for item in listing['items']] == ['report.txt']
+    assert authenticated_client.get('/browse/download/docs/report.txt').data == b'sharded bytes'
+
+    # A move only renames rows
+    authenticated_client.post('/browse/upload/', data={'folder_name': 'archive'})
+    response = authenticated_client.post('/browse/move', data={
+        'source_path': 'docs',
+        'destination_path': 'archive',
+        'is_file': 'false'
+    })
+    assert response.get_json()['status'] == 'success'
+    with app.app_context():
+        assert File.query.filter_by(owner_id=test_user, name='archive/docs/report.txt').one().storage_key == key
+
+    # Files still in the tree are moved into the store, and back again
+    result = runner.invoke(args=['migrate-layout'])
+    assert 'fileuser: 1 files moved' in result.output
+    assert not os.path.exists(os.path.join(user_folder, 'old'))
+    assert authenticated_client.get('/browse/download/old/legacy.txt').data == b'from the tree'
+
+    app.config['STORAGE_LAYOUT'] = 'tree'
+    result = runner.invoke(args=['migrate-layout'])
+    assert 'fileuser: 2 files moved' in result.output
+    with open(os.path.join(user_folder, 'archive', 'docs', 'report.txt'), 'rb') as f:
+        assert f.read() == b'sharded bytes'
+    with app.app_context():
+        assert not os.path.exists(object_path(key))
+        assert File.query.filter(File.owner_id == test_user, File.storage_key.isnot(None)).count() == 0
+
+def test_cold_files_move_between_tiers(authenticated_client, app, test_user, tmp_path):
+    """Test that unread files move to a capacity tier behind a symlink and come back once read"""
+    from datetime import datetime, timedelta
+    from app.utils.tiering import move_tiers, tier_path
+    app.config['STORAGE_TIERS'] = [str(tmp_path / 'cold')]
+    app.config['TIER_MIN_SIZE'] = 0
+    authenticated_client.post('/browse/upload/', data={
+        'file': (BytesIO(b'rarely read'), 'old.txt')
+    }, content_type='multipart/form-data')
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser', 'old.txt')
+
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        file = File.query.filter_by(owner_id=test_user, name='old.txt').one()
+        file.created_at = datetime.now() - timedelta(seconds=app.config['TIER_DEMOTE_AFTER'] + 60)
+        db.session.commit()
+        assert move_tiers()['demoted'] == 1
+        target = tier_path(1, file.id)
+    assert os.path.islink(path) and os.readlink(path) == target
+    assert authenticated_client.get('/browse/download/old.txt').data == b'rarely read'
+
+    # The read is recorded and the next run brings the file back
+    with app.app_context():
+        file = File.query.filter_by(owner_id=test_user, name='old.txt').one()
+        assert file.last_accessed_at is not None and file.tier == 1
+        assert move_tiers()['promoted'] == 1
+        assert File.query.filter_by(owner_id=test_user, name='old.txt').one().tier == 0
+    assert not os.path.islink(path) and not os.path.exists(target)
+    with open(path, 'rb') as f:
+        assert f.read() == b'rarely read'
+
+def test_text_previews_are_cached_by_version(authenticated_client, app):
+    """Test that text previews show the first lines and can be cached for good under their versioned URL"""
+    app.config['PREVIEW_WORKERS'] = 0
+    app.config['TEXT_PREVIEW_LINES'] = 2
+    authenticated_client.post('/browse/upload/', data={
+        'file': (BytesIO(b'first line\nsecond line\nthird line\n'), 'notes.txt')
+    }, content_type='multipart/form-data')
+    authenticated_client.post('/browse/upload/', data={
+        'file': (BytesIO(b'\x00\x01binary'), 'data.bin')
+    }, content_type='multipart/form-data')
+
+    response = authenticated_client.get('/browse/preview/notes.txt')
+    assert response.status_code == 200
+    assert response.data == b'first line\nsecond line'
+    assert response.cache_control.no_cache
+    etag = response.headers['ETag']
+    assert authenticated_client.get('/browse/preview/notes.txt', headers={'If-None-Match': etag}).status_code == 304
+
+    mtime_ns = os.stat(os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser', 'notes.txt')).st_mtime_ns
+    response = authenticated_client.get(f'/browse/preview/notes.txt?v={mtime_ns}')
+    assert response.cache_control.immutable and response.cache_control.max_age > 0
+
+    assert authenticated_client.get('/browse/preview/data.bin').status_code == 404
+
+def test_preview_renderer_stores_renders_finished_at_submit(app, tmp_path):
+    """Test that a render finishing before its callback is registered does not deadlock the renderer"""
+    from concurrent.futures import Future
+    from app.utils.disk_cache import DiskCache
+    from app.utils.previews import PreviewRenderer
+
+    class FinishedExecutor:
+        def submit(self, function, *arguments):
+            future = Future()
+            future.set_result(function(*arguments))
+            return future
+
+    app.config['PREVIEW_WORKERS'] = 1
+    path = tmp_path / 'notes.txt'
+    path.write_bytes(b'first line\n')
+    renderer = PreviewRenderer(DiskCache(str(tmp_path / 'cache'), 1024 * 1024))
+    renderer._executor = FinishedExecutor()
+    with app.app_context():
+        assert renderer.render('notes', 'text', str(path)) == b'first line'
+        assert renderer.render('notes', 'text', str(path)) == b'first line'
+    assert renderer.cache.hits == 1
+    assert not renderer._pending
+
+def test_move_onto_existing_file_is_refused(authenticated_client, app, test_user):
+    """Test that moving a file onto an existing name changes neither the disk nor the rows"""
+    authenticated_client.post('/browse/upload/', data={'folder_name': 'docs'})
+    authenticated_client.post('/browse/upload/', data={
+        'file': (BytesIO(b'moved'), 'report.txt')
+    }, content_type='multipart/form-data')
+    authenticated_client.post('/browse/upload/docs', data={
+        'file': (BytesIO(b'already there'), 'report.txt')
+    }, content_type='multipart/form-data')
+
+    response = authenticated_client.post('/browse/move', data={
+        'source_path': 'report.txt',
+        'destination_path': 'docs',
+        'is_file': 'true'
+    })
+    assert response.status_code == 409
+
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+    with open(os.path.join(user_folder, 'docs', 'report.txt'), 'rb') as f:
+        assert f.read() == b'already there'
+    assert os.path.exists(os.path.join(user_folder, 'report.txt'))
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        assert File.query.filter_by(owner_id=test_user).count() == 2
+        assert db.session.get(User, test_user).storage_used == len(b'moved') + len(b'already there')
+
+def test_sharded_move_onto_unmigrated_file_is_refused(authenticated_client, app, test_user):
+    """Test that a sharded move is not taken for a resumed one because its source has no tree entry"""
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'fileuser')
+    authenticated_client.post('/browse/upload/', data={
+        'file': (BytesIO(b'still in the tree'), 'report.txt')
+    }, content_type='multipart/form-data')
+    app.config['STORAGE_LAYOUT'] = 'sharded'
+    authenticated_client.post('/browse/upload/', data={'folder_name': 'docs'})
+    authenticated_client.post('/browse/upload/docs', data={
+        'file': (BytesIO(b'in the store'), 'report.txt')
+    }, content_type='multipart/form-data')
+
+    response = authenticated_client.post('/browse/move', data={
+        'source_path': 'docs/report.txt',
+        'destination_path': '/',
+        'is_file': 'true'
+    })
+    assert response.status_code == 409
+    assert authenticated_client.get('/browse/download/report.txt').data == b'still in the tree'
+    assert authenticated_client.get('/browse/download/docs/report.txt').data == b'in the store'
+    assert os.path.exists(os.path.join(user_folder, 'report.txt'))
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import pytest
+from sqlalchemy import text
+from app import create_app, db
+from app.config import Config
+from app.utils.migrations import MIGRATIONS, get_schema_version
+
+
+@pytest.fixture
+def legacy_database(tmp_path):
+    """Create a database with the pre-index schema and duplicated paths"""
+    db_path = tmp_path / 'legacy.db'
+    connection = sqlite3.connect(db_path)
+    connection.executescript("""
+        CREATE TABLE role (id INTEGER PRIMARY KEY, name VARCHAR(50) UNIQUE NOT NULL, description VARCHAR(200));
+        CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(150) UNIQUE NOT NULL,
+            password VARCHAR(150) NOT NULL, role_id INTEGER NOT NULL, created_at DATETIME,
+            storage_quota BIGINT);
+        CREATE TABLE file (id INTEGER PRIMARY KEY, name VARCHAR(150) NOT NULL, size INTEGER,
+            created_at DATETIME, owner_id INTEGER NOT NULL, view_access INTEGER, full_access INTEGER);
+        CREATE TABLE folder (id INTEGER PRIMARY KEY, name VARCHAR(150) NOT NULL, size INTEGER,
+            created_at DATETIME, parent_id INTEGER, owner_id INTEGER NOT NULL, view_access INTEGER,
+            full_access INTEGER);
+        CREATE TABLE shared_link (id INTEGER PRIMARY KEY, token VARCHAR(64) UNIQUE NOT NULL,
+            file_id INTEGER, folder_id INTEGER, created_by INTEGER NOT NULL, created_at DATETIME,
+            expires_at DATETIME, is_active BOOLEAN, bulk_share_id VARCHAR(64), is_bulk_parent BOOLEAN,
+            name VARCHAR(255), description VARCHAR(500), password VARCHAR(128));
+        INSERT INTO file (id, name, size, owner_id) VALUES (1, 'a.txt', 1, 1), (2, 'a.txt', 1, 1), (3, 'a.txt', 1, 2);
+        INSERT INTO shared_link (id, token, file_id, created_by) VALUES (1, 'token', 2, 1);
+    """)
+    connection.commit()
+    connection.close()
+    return db_path
+
+
+def test_migrations_upgrade_legacy_database(legacy_database):
+    """Test that migrations deduplicate paths and add the lookup indexes"""
+    class LegacyConfig(Config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{legacy_database}'
+        UPLOAD_FOLDER = os.path.abspath('test_uploads')
+
+    app = create_app(LegacyConfig)
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert get_schema_version(connection) == max(version for version, _, _ in MIGRATIONS)
+            file_indexes = {row[1] for row in connection.execute(text("PRAGMA index_list('file')"))}
+            link_indexes = {row[1] for row in connection.execute(text("PRAGMA index_list('shared_link')"))}
+            rows = connection.execute(text('SELECT id, owner_id FROM file ORDER BY id')).fetchall()
+            share_file = connection.execute(text('SELECT file_id FROM shared_link')).scalar()
+
+        assert 'ix_file_owner_name' in file_indexes
+        assert {'ix_shared_link_created_by', 'ix_shared_link_bulk_share_id'} <= link_indexes
+        assert [tuple(row) for row in rows] == [(1, 1), (3, 2)]
+        assert share_file == 1
+        db.session.remove()
+
+    if os.path.exists(app.config['UPLOAD_FOLDER']):
+        import shutil
+        shutil.rmtree(app.config['UPLOAD_FOLDER'])
@@ -162,6 +162,68 @@ def test_download_shared_file(client, app, test_users, test_file):
         db.session.commit()
 
 
+def test_download_shared_file_range(client, app, test_users, test_file):
+    """Test resuming and revalidating a shared file download"""
+    with app.app_context():
+        share_link = SharedLink(
+            file_id=test_file.id,
+            created_by=test_users['owner_id'],
+            name='Test Share'
+        )
+        db = app.extensions['sqlalchemy']
+        db.session.add(share_link)
+        db.session.commit()
+        token = share_link.token
+
+    response = client.get(f'/shared/{token}/download')
+    assert response.status_code == 200
+    assert response.data == b'This is a test file for sharing'
+    etag = response.headers['ETag']
+
+    response = client.get(f'/shared/{token}/download', headers={'Range': 'bytes=10-', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == b'test file for sharing'
+
+    response = client.get(f'/shared/{token}/download', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_shared_bulk_download_is_cached(client, app, test_users, test_file):
+    """Test that repeated shared archive downloads are served from the archive cache"""
+    import os
+    import zipfile
+    with app.app_context():
+        share_link = SharedLink(
+            file_id=test_file.id,
+            created_by=test_users['owner_id'],
+            name='Test Share'
+        )
+        db = app.extensions['sqlalchemy']
+        db.session.add(share_link)
+        db.session.commit()
+        token = share_link.token
+
+    first = client.post('/bulk_download', data={'token': token})
+    assert first.status_code == 200
+    archive = zipfile.ZipFile(BytesIO(first.data))
+    assert archive.read('shared_test.txt') == b'This is a test file for sharing'
+
+    second = client.post('/bulk_download', data={'token': token})
+    assert second.data == first.data
+    assert second.headers['Accept-Ranges'] == 'bytes'
+    cache = app.extensions['archive_cache']
+    assert cache.stats()['builds'] == 1
+    assert cache.hits == 1
+
+    # Changing a shared file changes the manifest and forces a rebuild
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'owner', 'shared_test.txt')
+    with open(file_path, 'wb') as f:
+        f.write(b'Updated shared content')
+    third = client.post('/bulk_download', data={'token': token})
+    assert zipfile.ZipFile(BytesIO(third.data)).read('shared_test.txt') == b'Updated shared content'
+    assert cache.stats()['builds'] == 2
+
+
 def test_share_nonexistent_file(owner_client, app, test_users):
     """Test sharing a file that doesn't exist"""
     response = owner_client.post('/share/file/99999', data={
@@ -489,4 +551,61 @@ def test_share_folder(owner_client, app, test_users):
         # Test accessing the shared folder
         response = owner_client.get(f'/shared/{share_link.token}')
         assert response.status_code == 200
-        assert b'Shared Folder' in response.data
\ No newline at end of file
+        assert b'Shared Folder' in response.data
+
+def test_shared_folder_does_not_follow_outside_symlinks(owner_client, client, app, test_users, tmp_path):
+    """Test that a symlink inside a shared folder cannot serve a file from outside the upload folder"""
+    import os
+    secret = tmp_path / 'secret.txt'
+    secret.write_bytes(b'not for sharing')
+    with app.app_context():
+        db = app.extensions['sqlalchemy']
+        folder = Folder(name='Links', owner_id=test_users['owner_id'])
+        db.session.add(folder)
+        db.session.commit()
+        folder_path = os.path.join(app.config['UPLOAD_FOLDER'], 'owner', 'Links')
+        os.makedirs(folder_path, exist_ok=True)
+        os.symlink(str(secret), os.path.join(folder_path, 'secret.txt'))
+
+        owner_client.post(f'/share/folder/{folder.id}', data={'name': 'Links', 'expires_in': 7})
+        token = SharedLink.query.filter_by(folder_id=folder.id).first().token
+
+    assert client.get(f'/shared/{token}/download/secret.txt').status_code == 404
+
+
+def test_shared_archives_over_the_cache_budget_are_not_cached(client, app, test_users, test_file):
+    """Test that an archive larger than the whole cache budget is streamed without being written to the cache"""
+    import zipfile
+    with app.app_context():
+        share_link = SharedLink(file_id=test_file.id, created_by=test_users['owner_id'], name='Big Share')
+        db = app.extensions['sqlalchemy']
+        db.session.add(share_link)
+        db.session.commit()
+        token = share_link.token
+    cache = app.extensions['archive_cache']
+    cache.max_bytes = 10
+
+    response = client.post('/bulk_download', data={'token': token})
+    assert zipfile.ZipFile(BytesIO(response.data)).read('shared_test.txt') == b'This is a test file for sharing'
+    assert cache.stats()['builds'] == 0
+
+def test_archive_cache_build_relocks_a_lock_file_evicted_while_opening(tmp_path, monkeypatch):
+    """Test that a build never holds the lock of a lock file unlinked before it was locked"""
+    import os
+    from app.utils import disk_cache
+    cache = disk_cache.DiskCache(str(tmp_path), 1024 * 1024)
+    real_open = os.open
+    evicted = []
+
+    def open_then_evict(path, *args, **kwargs):
+        fd = real_open(path, *args, **kwargs)
+        if path.endswith('.lock') and not evicted:
+            # An eviction unlinking the lock between os.open and flock
+            evicted.append(path)
+            os.remove(path)
+        return fd
+
+    monkeypatch.setattr(disk_cache.os, 'open', open_then_evict)
+    assert b''.join(cache.get_or_build('archive', lambda: [b'zip ', b'bytes'])) == b'zip bytes'
+    assert evicted and os.path.exists(evicted[0])
+    assert cache.lookup('archive')
@@ -1,9 +1,9 @@
 from app.utils.decorators import admin_required
 from app.utils.filesystem import (
-    synchronize_database_with_filesystem,
     ensure_user_folder,
     delete_user_folder
 )
+from app.utils.sync import synchronize_database_with_filesystem
 
 __all__ = [
     'admin_required',
@@ -0,0 +1,26 @@
+import logging
+import threading
+
+def start_periodic_task(app, name, interval, func):
+    """Run ``func`` every ``interval`` seconds in a daemon thread with an app context.
+
+    Returns an Event that stops the task when set, or None when background
+    tasks are disabled (they never run under TESTING, where every test
+    builds its own app).
+    """
+    if app.config.get('TESTING') or not interval:
+        return None
+
+    stop_event = threading.Event()
+
+    def run():
+        while not stop_event.wait(interval):
+            try:
+                with app.app_context():
+                    func()
+            except Exception:
+                logging.exception(f"Background task {name} failed")
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return stop_event
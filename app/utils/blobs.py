@@ -0,0 +1,135 @@
+"""Optional content-addressed store that deduplicates file bytes.
+
+With DEDUP_STORAGE enabled, every stored file is a hard link to a blob named
+by the sha256 of its contents under BLOB_FOLDER (UPLOAD_FOLDER/.blobs unless
+configured, and always on the same filesystem as the upload folder). User
+paths stay ordinary directory entries, so downloads, archives and the sync
+read them as before. Identical uploads share one inode, and a copy is a new
+link rather than new bytes. A blob's link count is its reference count: its
+own name plus one per user path. The garbage collector deletes the blobs no
+user path links to any more.
+
+Blobs are read-only, because rewriting one path in place would change every
+path that shares it. The app only ever replaces files, never rewrites them.
+"""
+import hashlib
+import logging
+import os
+import uuid
+from flask import current_app
+from app.utils.copy_engine import copy_file
+from app.utils.filesystem import UPLOAD_TEMP_PREFIX
+
+def dedup_enabled():
+    return bool(current_app.config['DEDUP_STORAGE'])
+
+def blob_folder():
+    return current_app.config['BLOB_FOLDER'] or os.path.join(current_app.config['UPLOAD_FOLDER'], '.blobs')
+
+def blob_path(digest):
+    """Path of the blob with the given sha256, fanned out over two directory levels"""
+    return os.path.join(blob_folder(), digest[:2], digest[2:4], digest)
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Return the hex sha256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _replace_with_link(source, destination):
+    """Atomically make ``destination`` a hard link to ``source``"""
+    temp_path = os.path.join(os.path.dirname(destination), f'{UPLOAD_TEMP_PREFIX}{uuid.uuid4().hex}')
+    os.link(source, temp_path)
+    try:
+        os.replace(temp_path, destination)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+def store_blob(path, digest=None):
+    """Deduplicate the file at ``path`` against the blob store and return its sha256.
+
+    A new blob is created by linking the file into the store; if a blob with
+    the same content already exists, the file is replaced by a link to it.
+    Returns None when the file cannot be stored, e.g. because the store is
+    on another filesystem or the file is a symlink to a capacity tier; the
+    file is left as it is.
+    """
+    if os.path.islink(path):
+        return None
+    digest = digest or hash_file(path)
+    target = blob_path(digest)
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # A blob the garbage collector removes between two of these steps is simply created again
+        for _ in range(3):
+            try:
+                os.link(path, target)
+                os.chmod(target, 0o444)
+                return digest
+            except FileExistsError:
+                pass
+            try:
+                blob_stat = os.stat(target)
+                path_stat = os.stat(path)
+                if os.path.samestat(blob_stat, path_stat):
+                    return digest
+                if blob_stat.st_size != path_stat.st_size:
+                    logging.error(f"Blob {digest} does not match {path}; leaving the file unshared")
+                    return None
+                _replace_with_link(target, path)
+                return digest
+            except FileNotFoundError:
+                continue
+    except OSError as e:
+        logging.warning(f"Could not add {path} to the blob store: {e}")
+    return None
+
+def link_copy(source, destination, digest=None):
+    """Copy ``source`` to ``destination`` as a new link to its blob and return the sha256.
+
+    ``digest`` is the sha256 recorded for the source. It is only trusted if
+    the source still is that blob, in which case nothing is read; otherwise
+    the source is hashed and stored first. Falls back to copying the bytes
+    when the source cannot be stored.
+    """
+    if digest:
+        try:
+            if os.path.samestat(os.stat(blob_path(digest)), os.stat(source)):
+                _replace_with_link(blob_path(digest), destination)
+                return digest
+        except FileNotFoundError:
+            pass
+    digest = store_blob(source)
+    if digest is None:
+        copy_file(source, destination)
+        return None
+    _replace_with_link(blob_path(digest), destination)
+    return digest
+
+def collect_garbage():
+    """Delete blobs that no user path links to; return counts of what was kept and freed"""
+    stats = {'blobs': 0, 'removed': 0, 'bytes_freed': 0}
+    root = blob_folder()
+    for current, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(current, name)
+            try:
+                stat = os.stat(path)
+                if stat.st_nlink > 1:
+                    stats['blobs'] += 1
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            stats['removed'] += 1
+            stats['bytes_freed'] += stat.st_size
+    if stats['removed']:
+        logging.info(f"Blob store garbage collection freed {stats['bytes_freed']} bytes "
+                     f"in {stats['removed']} blobs")
+    return stats
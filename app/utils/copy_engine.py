@@ -0,0 +1,107 @@
+"""File copies that avoid moving bytes through user space where the kernel allows it.
+
+Each copy tries, in order:
+
+* ``reflink``: an FICLONE ioctl, which shares the source's extents on
+  copy-on-write filesystems (btrfs, XFS with reflink=1), so the copy is
+  instant and takes no space until either side is modified;
+* ``copy_file_range``: an in-kernel copy, which some filesystems and NFS 4.2
+  servers turn into a server-side or block-level copy;
+* ``buffered``: a plain read/write loop.
+
+A pair of devices that rejects a strategy is remembered, so later copies
+between them go straight to the next one.
+"""
+import errno
+import os
+import shutil
+import tempfile
+from collections import Counter
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+from app.utils.filesystem import UPLOAD_TEMP_PREFIX
+
+STRATEGIES = ('reflink', 'copy_file_range', 'buffered')
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+# Errors meaning "not supported here" rather than a failed copy
+_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.EPERM}
+_COPY_RANGE_CHUNK = 1 << 30
+_no_reflink = set()
+_no_copy_file_range = set()
+
+def _reflink(source_fd, destination_fd, device):
+    if fcntl is None or device in _no_reflink:
+        return False
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+        return True
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+        _no_reflink.add(device)
+        return False
+
+def _copy_file_range(source_fd, destination_fd, device):
+    """Copy in the kernel; returns False if nothing could be copied this way"""
+    if not hasattr(os, 'copy_file_range') or device in _no_copy_file_range:
+        return False
+    copied = 0
+    while True:
+        try:
+            count = os.copy_file_range(source_fd, destination_fd, _COPY_RANGE_CHUNK)
+        except OSError as e:
+            if copied or e.errno not in _UNSUPPORTED:
+                raise
+            _no_copy_file_range.add(device)
+            return False
+        if not count:
+            return True
+        copied += count
+
+def copy_file(source, destination, strategies=STRATEGIES, chunk_size=1024 * 1024):
+    """Copy a file's bytes and metadata like ``shutil.copy2``; return the strategy that did it.
+
+    The copy is written next to ``destination`` and renamed over it, so an
+    existing destination, which may share its inode with other files, is
+    replaced rather than written to. ``strategies`` limits which strategies
+    may be tried, in their usual order.
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=UPLOAD_TEMP_PREFIX, dir=os.path.dirname(destination) or '.')
+    try:
+        with open(source, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            device = (os.fstat(src.fileno()).st_dev, os.fstat(dst.fileno()).st_dev)
+            if 'reflink' in strategies and _reflink(src.fileno(), dst.fileno(), device):
+                strategy = 'reflink'
+            elif 'copy_file_range' in strategies and _copy_file_range(src.fileno(), dst.fileno(), device):
+                strategy = 'copy_file_range'
+            else:
+                shutil.copyfileobj(src, dst, chunk_size)
+                strategy = 'buffered'
+        shutil.copystat(source, temp_path)
+        os.replace(temp_path, destination)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return strategy
+
+def copy_tree(source, destination, strategies=STRATEGIES, copy_function=None, dirs_exist_ok=False):
+    """Copy a directory tree like ``shutil.copytree``; return a Counter of the strategies used.
+
+    ``copy_function(source, destination)``, if given, copies each file
+    instead and returns the name of the strategy it used. With
+    ``dirs_exist_ok``, files already in an existing destination are replaced.
+    """
+    used = Counter()
+
+    def copy(src, dst):
+        if copy_function:
+            used[copy_function(src, dst)] += 1
+        else:
+            used[copy_file(src, dst, strategies)] += 1
+        return dst
+
+    shutil.copytree(source, destination, copy_function=copy, dirs_exist_ok=dirs_exist_ok)
+    return used
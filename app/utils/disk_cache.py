@@ -0,0 +1,261 @@
+"""Size-bounded on-disk cache for generated downloads.
+
+Entries are files named after the SHA-256 of their key. A build runs once per
+key across threads and worker processes: the first request takes an exclusive
+``flock`` on the key's lock file and writes the entry in a background thread,
+while every request for that key, including the first, streams the partial
+file as it grows. Hits refresh the entry's mtime, and the least recently used
+entries are evicted once the cache grows past its byte budget. Small entries
+produced elsewhere, such as previews, are stored whole with ``put``.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+_READ_SIZE = 1024 * 1024
+_POLL_INTERVAL = 0.05
+
+def _is_linked(fd, path):
+    """Whether ``path`` still names the file open as ``fd``"""
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+class DiskCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.evictions = 0
+
+    def _paths(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        base = os.path.join(self.directory, digest)
+        return base, base + '.part', base + '.lock'
+
+    def lookup(self, key):
+        """Return the path of a complete cached entry, or None on a miss"""
+        path = self._paths(key)[0]
+        try:
+            # The mtime doubles as the LRU timestamp
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key, data):
+        """Store ``data`` as the complete entry for ``key``, replacing any previous one"""
+        os.makedirs(self.directory, exist_ok=True)
+        final = self._paths(key)[0]
+        temp_path = f'{final}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, final)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        with self._lock:
+            self.builds += 1
+        self.evict(keep=final)
+        return final
+
+    def get_or_build(self, key, build):
+        """Stream the entry for ``key``, building it with ``build()`` unless another request already is.
+
+        ``build`` returns an iterable of byte chunks. It runs on a background
+        thread, so it must not depend on the request or app context.
+        """
+        if fcntl is None:
+            return iter(build())
+        os.makedirs(self.directory, exist_ok=True)
+        final, part, lock_path = self._paths(key)
+
+        while True:
+            lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(lock_fd)
+                return self._follow(final, part, lock_path, build)
+            if _is_linked(lock_fd, lock_path):
+                break
+            # Unlinked by evict() between opening and locking it; a lock on it excludes nobody
+            os.close(lock_fd)
+
+        if os.path.exists(final):
+            # Finished by another request between lookup() and taking the lock
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+            return self._follow(final, part, lock_path, build)
+
+        # Create the partial file before the thread starts so followers can open it
+        open(part, 'wb').close()
+        with self._lock:
+            self.builds += 1
+        threading.Thread(target=self._build, args=(build, final, part, lock_fd),
+                         name='disk-cache-build', daemon=True).start()
+        return self._follow(final, part, lock_path, build)
+
+    def _build(self, build, final, part, lock_fd):
+        try:
+            with open(part, 'wb', buffering=0) as f:
+                for chunk in build():
+                    f.write(chunk)
+            os.replace(part, final)
+            self.evict(keep=final)
+        except Exception:
+            logging.exception(f"Building cache entry {os.path.basename(final)} failed")
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+
+    def _is_building(self, lock_path):
+        try:
+            fd = os.open(lock_path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def _follow(self, final, part, lock_path, build):
+        """Yield the entry's bytes, waiting on a build in progress as needed"""
+        while True:
+            for path in (final, part):
+                try:
+                    f = open(path, 'rb')
+                    break
+                except FileNotFoundError:
+                    continue
+            else:
+                if self._is_building(lock_path):
+                    time.sleep(_POLL_INTERVAL)
+                    continue
+                # The build failed or the entry was evicted before it could
+                # be opened; serve an uncached copy
+                yield from build()
+                return
+            break
+
+        with f:
+            while True:
+                data = f.read(_READ_SIZE)
+                if data:
+                    yield data
+                    continue
+                if f.name == final or not self._is_building(lock_path):
+                    # The builder releases the lock only after its last write
+                    while True:
+                        data = f.read(_READ_SIZE)
+                        if not data:
+                            break
+                        yield data
+                    if f.name == part and not os.path.exists(final):
+                        raise RuntimeError('Cache entry build failed while it was being streamed')
+                    return
+                time.sleep(_POLL_INTERVAL)
+
+    def _remove_lock(self, lock_path):
+        """Unlink a key's lock file unless a build is holding it"""
+        try:
+            fd = os.open(lock_path, os.O_RDWR)
+        except OSError:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Another eviction may have replaced the file since it was opened, and
+            # holding this lock says nothing about whether its successor is in use
+            if _is_linked(fd, lock_path):
+                os.remove(lock_path)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries, and the lock files of missing ones, until the cache fits its budget"""
+        entries = []
+        locks = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith('.lock'):
+                        locks.append(entry.path)
+                    if '.' in entry.name:
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                # Never pull an entry out from under the build that just made it
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+        # Locks outlive their entries, and builds that failed leave them too
+        for lock_path in locks:
+            if not os.path.exists(lock_path[:-len('.lock')]):
+                self._remove_lock(lock_path)
+
+    def stats(self):
+        total = 0
+        count = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if '.' not in entry.name:
+                        count += 1
+                        total += entry.stat().st_size
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': count,
+                'bytes': total,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'builds': self.builds,
+                'evictions': self.evictions
+            }
@@ -1,15 +1,121 @@
 import os
 import shutil
+import tempfile
 from app import db
 from app.models.user import User
 from app.models.file import File
 from app.models.folder import Folder
-from flask import flash
+from app.models.upload_session import UploadSession
+from datetime import datetime
+from flask import current_app, flash
 from sqlalchemy import func
 
+# Name prefix of in-progress upload files, hidden from listings and the sync
+UPLOAD_TEMP_PREFIX = '.upload-'
+
+class QuotaExceededError(Exception):
+    """Raised when an upload grows past the space left in the user's quota"""
+
 def get_user_storage_usage(user_id):
-    """Calculate total storage usage for a user"""
-    return db.session.query(func.sum(File.size)).filter_by(owner_id=user_id).scalar() or 0
+    """Return the stored storage usage counter for a user"""
+    return db.session.query(User.storage_used).filter_by(id=user_id).scalar() or 0
+
+def adjust_storage_used(user_id, delta):
+    """Add ``delta`` bytes to a user's storage counter in the current transaction.
+
+    The increment is done in SQL, so concurrent requests never lose updates,
+    and it commits or rolls back together with the file rows it accounts for.
+    """
+    if delta:
+        User.query.filter_by(id=user_id).update(
+            {User.storage_used: User.storage_used + delta},
+            synchronize_session=False
+        )
+
+def recalculate_storage_usage(user_id=None):
+    """Recompute storage counters from the File table for one user or everyone"""
+    total = db.session.query(func.coalesce(func.sum(File.size), 0)).filter(
+        File.owner_id == User.id
+    ).scalar_subquery()
+    query = User.query
+    if user_id is not None:
+        query = query.filter_by(id=user_id)
+    query.update({User.storage_used: total}, synchronize_session=False)
+    db.session.commit()
+
+def subtree_condition(column, path):
+    """Match ``path`` and every path below it, as ranges the (owner_id, name) indexes can scan"""
+    path = path.rstrip('/')
+    # '0' is the character after '/', so this range holds exactly the 'path/...' names
+    return (column == path) | ((column >= path + '/') & (column < path + '0'))
+
+def subtree_file_size(user_id, path):
+    """Total size of the file rows at or below ``path``"""
+    return db.session.query(func.coalesce(func.sum(File.size), 0)).filter(
+        File.owner_id == user_id,
+        subtree_condition(File.name, path)
+    ).scalar()
+
+def subtree_totals(user_id, path):
+    """Number and total size of the file rows at or below ``path``, or of all the user's files if it is empty"""
+    query = db.session.query(func.count(File.id), func.coalesce(func.sum(File.size), 0)).filter(File.owner_id == user_id)
+    if path:
+        query = query.filter(subtree_condition(File.name, path))
+    count, size = query.one()
+    return count, size
+
+def get_remaining_quota(user_id, exclude_upload=None):
+    """Bytes the user may still store, or None for unlimited storage.
+
+    The sizes announced by the user's open upload sessions count as used, all
+    but ``exclude_upload``'s, so parallel sessions cannot together overrun the quota.
+    """
+    user = db.session.get(User, user_id)
+    if not user or user.storage_quota is None:
+        return None
+    reserved = db.session.query(func.coalesce(func.sum(UploadSession.size), 0)).filter(
+        UploadSession.owner_id == user_id,
+        UploadSession.expires_at >= datetime.now()
+    )
+    if exclude_upload is not None:
+        reserved = reserved.filter(UploadSession.id != exclude_upload)
+    return max(user.storage_quota - get_user_storage_usage(user_id) - reserved.scalar(), 0)
+
+def save_upload_stream(stream, destination, max_bytes=None, chunk_size=1024 * 1024, hasher=None):
+    """Stream an upload into place through a temp file next to its destination.
+
+    Data is copied in ``chunk_size`` pieces while the byte count is checked
+    against ``max_bytes``, so neither the size check nor the write needs the
+    whole file in memory. The temp file is renamed over ``destination`` only
+    once the upload is complete. Returns the number of bytes written; empty
+    uploads are discarded and return 0. Raises QuotaExceededError as soon as
+    more than ``max_bytes`` have arrived, leaving the destination untouched.
+    ``hasher``, if given, is updated with every chunk written.
+    """
+    directory = os.path.dirname(destination)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=UPLOAD_TEMP_PREFIX, dir=directory)
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if max_bytes is not None and written > max_bytes:
+                    raise QuotaExceededError(f'Upload exceeds the remaining quota of {max_bytes} bytes')
+                temp_file.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+        if written:
+            # mkstemp creates the file private to the owner
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, destination)
+        return written
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 def check_user_quota(user_id, required_space=0):
     """Check if user has enough quota for required space"""
@@ -24,40 +130,133 @@ def check_user_quota(user_id, required_space=0):
     current_usage = get_user_storage_usage(user_id)
     return (current_usage + required_space) <= user.storage_quota
 
-def synchronize_database_with_filesystem(app):
-    users = db.session.query(User).all()
-    
-    for user in users:
-        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], user.username)
-        
-        if not os.path.exists(user_folder):
-            continue
-            
-        for root, dirs, files in os.walk(user_folder):
-            relative_path = os.path.relpath(root, user_folder)
-            
-            if not File.query.filter_by(name=relative_path).first():
-                new_file = File(name=relative_path, owner_id=user.id)
-                db.session.add(new_file)
-                
-            for file in files:
-                if not File.query.filter_by(name=os.path.join(relative_path, file)).first():
-                    file_path = os.path.join(root, file)
-                    file_size = os.path.getsize(file_path)
-                    new_file = File(name=os.path.join(relative_path, file), size=file_size, owner_id=user.id)
-                    db.session.add(new_file)
-        
-        for file in File.query.filter_by(owner_id=user.id).all():
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], user.username, file.name)
-            if not os.path.exists(file_path):
-                File.query.filter_by(id=file.id).delete()
-        
-        for folder in Folder.query.filter_by(owner_id=user.id).all():
-            folder_path = os.path.join(app.config['UPLOAD_FOLDER'], user.username, folder.name)
-            if not os.path.exists(folder_path):
-                Folder.query.filter_by(id=folder.id).delete()
-                
-    db.session.commit()
+def _escape_like(value):
+    """Escape LIKE wildcards so a path can be used as a literal prefix"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def direct_children_query(model, user_id, path):
+    """Query the File or Folder rows that sit directly inside ``path``"""
+    return model.query.filter(model.owner_id == user_id, model.parent_path == path.strip('/'))
+
+def scan_directory(full_path, path):
+    """Stat every entry of a directory once and return browse-style item dicts"""
+    items = []
+    with os.scandir(full_path) as entries:
+        for entry in entries:
+            if entry.name.startswith(UPLOAD_TEMP_PREFIX):
+                continue
+            try:
+                is_file = entry.is_file()
+                stat = entry.stat()
+            except OSError:
+                # Entry vanished or is a dangling symlink
+                continue
+            items.append({
+                'name': entry.name,
+                'is_file': is_file,
+                'size': stat.st_size if is_file else 0,
+                'created_at': datetime.fromtimestamp(stat.st_ctime),
+                'mtime_ns': stat.st_mtime_ns,
+                'path': os.path.join(path, entry.name) if path else entry.name,
+            })
+    return items
+
+def real_location(path):
+    """Resolve ``path`` for containment checks, leaving a demoted file's own symlink in place.
+
+    A file demoted to a capacity tier is a symlink out of the upload folder,
+    so its last component is kept when it links into one of STORAGE_TIERS.
+    Any other symlink is resolved in full and must stay inside the check's root.
+    """
+    path = os.path.normpath(path)
+    resolved = os.path.realpath(path)
+    if os.path.islink(path):
+        for tier in current_app.config['STORAGE_TIERS'] or []:
+            tier_root = os.path.realpath(tier)
+            if resolved.startswith(tier_root + os.sep):
+                return os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+    return resolved
+
+def iter_archive_entries(folder_path, base_path, include_dirs=True):
+    """Lazily yield (arcname, path) pairs for a folder tree, arcnames relative to ``base_path``.
+
+    Directory entries have a path of None. The tree is walked while the
+    archive streams, so nothing is listed up front.
+    """
+    for root, dirs, files in os.walk(folder_path):
+        if include_dirs:
+            for name in dirs:
+                yield os.path.relpath(os.path.join(root, name), base_path), None
+        for name in files:
+            if name.startswith(UPLOAD_TEMP_PREFIX):
+                continue
+            file_path = os.path.join(root, name)
+            yield os.path.relpath(file_path, base_path), file_path
+
+# Above this many entries a single prefix query beats a huge IN (...) list
+_IN_CLAUSE_LIMIT = 500
+
+def _known_ids(model, user_id, path, items):
+    """Map path -> id for the rows of ``model`` matching the given items"""
+    if not items:
+        return {}
+    if len(items) <= _IN_CLAUSE_LIMIT:
+        query = model.query.filter(model.owner_id == user_id,
+                                   model.name.in_([item['path'] for item in items]))
+    else:
+        query = direct_children_query(model, user_id, path)
+    return {row.name: row.id for row in query.with_entities(model.name, model.id)}
+
+def reconcile_directory(user_id, path, items):
+    """Attach database ids to scanned directory items, creating missing rows.
+
+    Known rows are fetched with one query per model and looked up by path, and
+    every missing row is inserted in a single transaction, so the number of
+    queries does not grow with the number of entries. ``items`` may be a whole
+    directory or just one page of it.
+    """
+    files = _known_ids(File, user_id, path, [item for item in items if item['is_file']])
+    folders = _known_ids(Folder, user_id, path, [item for item in items if not item['is_file']])
+
+    missing_files = [item for item in items if item['is_file'] and item['path'] not in files]
+    missing_folders = [item for item in items if not item['is_file'] and item['path'] not in folders]
+
+    recount_storage = False
+    if missing_files or missing_folders:
+        # OR IGNORE: a concurrent request may have inserted the same paths already
+        if missing_files:
+            result = db.session.execute(File.__table__.insert().prefix_with('OR IGNORE'), [
+                {'name': item['path'], 'size': item['size'], 'owner_id': user_id}
+                for item in missing_files
+            ])
+            if result.rowcount == len(missing_files):
+                adjust_storage_used(user_id, sum(item['size'] for item in missing_files))
+            else:
+                # Some rows were inserted concurrently; count from the table instead
+                recount_storage = True
+        if missing_folders:
+            db.session.execute(Folder.__table__.insert().prefix_with('OR IGNORE'), [
+                {'name': item['path'], 'owner_id': user_id}
+                for item in missing_folders
+            ])
+        db.session.commit()
+        if recount_storage:
+            recalculate_storage_usage(user_id)
+
+        # Read back the ids assigned to the rows we just inserted
+        if missing_files:
+            files.update(_known_ids(File, user_id, path, missing_files))
+        if missing_folders:
+            folders.update(_known_ids(Folder, user_id, path, missing_folders))
+
+    for item in items:
+        if item['is_file']:
+            item['id'] = files.get(item['path'])
+            item['folder_id'] = None
+        else:
+            item['id'] = folders.get(item['path'])
+            item['folder_id'] = item['id']
+    return items
 
 def ensure_user_folder(app, username):
     user_folder = os.path.join(app.config['UPLOAD_FOLDER'], username)
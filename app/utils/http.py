@@ -0,0 +1,143 @@
+import mimetypes
+import os
+import secrets
+import unicodedata
+from datetime import datetime, timezone
+from urllib.parse import quote
+from flask import Response, request
+
+# Ranges beyond this count are answered with the whole file instead
+MAX_RANGES = 16
+_READ_SIZE = 256 * 1024
+
+def make_etag(stat, checksum=None):
+    """Strong validator from a stored checksum, else from the file's size and mtime"""
+    if checksum:
+        return checksum
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+def _satisfiable_ranges(length, etag, last_modified):
+    """Resolve the request's Range header to absolute (start, stop) pairs.
+
+    Returns None when the whole file should be sent, or a possibly empty list
+    of ranges. An empty list means none of the ranges can be satisfied.
+    """
+    header = request.range
+    if header is None or header.units != 'bytes':
+        return None
+    if_range = request.if_range
+    if if_range.etag or if_range.date:
+        # A stale If-Range validator turns the request into a plain GET
+        if if_range.etag != etag and if_range.date != last_modified:
+            return None
+
+    ranges = []
+    for begin, end in header.ranges:
+        if begin < 0:
+            start, stop = max(length + begin, 0), length
+        else:
+            start, stop = begin, length if end is None else min(end, length)
+        if start < stop:
+            ranges.append((start, stop))
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # Coalesce overlapping or adjacent ranges so no byte is sent twice
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def _filename_options(download_name):
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        return {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+^`|~')}"}
+    return {'filename': download_name}
+
+def _read_segment(file_path, start, stop):
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(_READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+def _multipart_body(file_path, parts, closing):
+    for part_header, (start, stop) in parts:
+        yield part_header
+        yield from _read_segment(file_path, start, stop)
+        yield b'\r\n'
+    yield closing
+
+def send_file_ranges(file_path, download_name=None, as_attachment=True, checksum=None, mimetype=None):
+    """Send a file with ETag/Last-Modified validation and byte-range support.
+
+    Handles If-None-Match and If-Modified-Since (304), If-Range, single
+    ranges (206 with Content-Range), multiple ranges (206
+    multipart/byteranges), and unsatisfiable ranges (416). ``checksum``, when
+    known, is used as the strong ETag instead of the size/mtime validator.
+    """
+    stat = os.stat(file_path)
+    length = stat.st_size
+    download_name = download_name or os.path.basename(file_path)
+    mimetype = mimetype or mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    etag = make_etag(stat, checksum)
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+
+    def finish(response):
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Accept-Ranges'] = 'bytes'
+        # Always revalidate, but let the browser keep its copy for a 304
+        response.headers['Cache-Control'] = 'private, no-cache'
+        if response.status_code != 304:
+            response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline',
+                                 **_filename_options(download_name))
+        return response
+
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag) or request.if_none_match.star_tag:
+            return finish(Response(status=304))
+    elif request.if_modified_since and last_modified <= request.if_modified_since:
+        return finish(Response(status=304))
+
+    ranges = _satisfiable_ranges(length, etag, last_modified)
+    if ranges is None:
+        response = Response(_read_segment(file_path, 0, length), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = length
+        return finish(response)
+
+    if not ranges:
+        response = Response(status=416)
+        response.headers['Content-Range'] = f'bytes */{length}'
+        return finish(response)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = Response(_read_segment(file_path, start, stop), status=206,
+                            mimetype=mimetype, direct_passthrough=True)
+        response.content_length = stop - start
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+        return finish(response)
+
+    boundary = secrets.token_hex(16)
+    parts = [(
+        f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+        f'Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n'.encode('latin-1'),
+        (start, stop)
+    ) for start, stop in ranges]
+    closing = f'--{boundary}--\r\n'.encode('latin-1')
+    body_length = sum(len(header) + (stop - start) + 2 for header, (start, stop) in parts) + len(closing)
+    response = Response(_multipart_body(file_path, parts, closing), status=206,
+                        content_type=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
+    response.content_length = body_length
+    return finish(response)
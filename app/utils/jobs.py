@@ -0,0 +1,158 @@
+"""Background jobs for copies, moves and deletes too large to run inside a request.
+
+A job is a row in the jobs table. Worker threads claim queued jobs with an
+atomic UPDATE, so any number of threads and processes can share the queue,
+and run them through the same operations the requests use for small items.
+While a job runs, its worker refreshes ``heartbeat_at``; a running job whose
+heartbeat is older than JOB_STALE_AFTER belonged to a worker that died (for
+example in a restart) and is claimed again. The operations are safe to
+repeat, so the new attempt finishes what the old one started.
+"""
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import SQLAlchemyError
+from app import db
+from app.models.job import Job
+from app.utils.operations import copy_entry, move_entry, delete_entry, delete_user_data
+
+JOB_KINDS = {
+    'copy': copy_entry,
+    'move': move_entry,
+    'delete': delete_entry,
+    'delete_user': delete_user_data
+}
+# Seconds between progress writes while a job runs
+PROGRESS_INTERVAL = 1
+
+def enqueue_job(kind, owner_id, files_total=0, bytes_total=0, **params):
+    """Queue a job running ``JOB_KINDS[kind](**params)`` and wake a worker"""
+    job = Job(kind=kind, owner_id=owner_id, params=json.dumps(params),
+              files_total=files_total, bytes_total=bytes_total)
+    db.session.add(job)
+    db.session.commit()
+    wakeup = current_app.extensions.get('job_wakeup')
+    if wakeup:
+        wakeup.set()
+    return job
+
+def _runnable():
+    stale = datetime.now() - timedelta(seconds=current_app.config['JOB_STALE_AFTER'])
+    return or_(Job.state == 'queued', and_(Job.state == 'running', Job.heartbeat_at < stale))
+
+def claim_job():
+    """Mark the oldest queued or abandoned job as running; return its id, or None if there is none"""
+    for _ in range(3):
+        job_id = db.session.query(Job.id).filter(_runnable()).order_by(Job.created_at).limit(1).scalar()
+        if job_id is None:
+            return None
+        now = datetime.now()
+        # Only one claimant's UPDATE still matches the row
+        claimed = Job.query.filter(Job.id == job_id, _runnable()).update({
+            Job.state: 'running',
+            Job.attempts: Job.attempts + 1,
+            Job.started_at: now,
+            Job.heartbeat_at: now,
+            Job.files_done: 0,
+            Job.bytes_done: 0
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job_id
+    return None
+
+def run_job(job_id):
+    """Run a claimed job to completion and record its result or error"""
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return None
+    if job.attempts > current_app.config['JOB_MAX_ATTEMPTS']:
+        job.state = 'failed'
+        job.error = f'Interrupted {job.attempts - 1} times'
+        job.finished_at = datetime.now()
+        db.session.commit()
+        return job
+
+    # Progress and heartbeats go through their own connections, outside the operation's transaction
+    engine = db.engine
+    table = Job.__table__
+    done = {'files': 0, 'bytes': 0, 'written': time.monotonic()}
+
+    def record(**values):
+        try:
+            with engine.begin() as connection:
+                connection.execute(table.update().where(table.c.id == job_id).values(**values))
+        except SQLAlchemyError as e:
+            logging.warning(f"Could not record progress of job {job_id}: {e}")
+
+    def progress(files, size):
+        done['files'] += files
+        done['bytes'] += size
+        if time.monotonic() - done['written'] >= PROGRESS_INTERVAL:
+            done['written'] = time.monotonic()
+            record(files_done=done['files'], bytes_done=done['bytes'], heartbeat_at=datetime.now())
+
+    stop_event = threading.Event()
+    heartbeat_interval = max(current_app.config['JOB_STALE_AFTER'] / 5, 1)
+
+    def heartbeat():
+        while not stop_event.wait(heartbeat_interval):
+            record(heartbeat_at=datetime.now())
+
+    heartbeat_thread = threading.Thread(target=heartbeat, name=f'job-heartbeat-{job_id}', daemon=True)
+    heartbeat_thread.start()
+    operation = JOB_KINDS[job.kind]
+    arguments = job.arguments
+    result = error = None
+    try:
+        result = operation(progress=progress, **arguments)
+    except Exception as e:
+        db.session.rollback()
+        logging.exception(f"Job {job_id} ({job.kind}) failed")
+        error = str(e)
+    finally:
+        stop_event.set()
+        heartbeat_thread.join()
+
+    job = db.session.get(Job, job_id)
+    job.state = 'failed' if error else 'done'
+    job.error = error
+    job.result = json.dumps(result) if result is not None else None
+    job.files_done = done['files']
+    job.bytes_done = done['bytes']
+    job.finished_at = datetime.now()
+    db.session.commit()
+    return job
+
+def start_job_workers(app):
+    """Start JOB_WORKERS threads running queued jobs; returns the Event that wakes them.
+
+    Like the other background tasks, the workers never run under TESTING.
+    """
+    if app.config.get('TESTING') or not app.config['JOB_WORKERS']:
+        return None
+
+    wakeup = threading.Event()
+    app.extensions['job_wakeup'] = wakeup
+
+    def work():
+        while True:
+            wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+            wakeup.clear()
+            try:
+                while True:
+                    with app.app_context():
+                        job_id = claim_job()
+                        if job_id is None:
+                            break
+                        run_job(job_id)
+            except Exception:
+                logging.exception("Job worker failed")
+
+    for i in range(app.config['JOB_WORKERS']):
+        threading.Thread(target=work, name=f'job-worker-{i}', daemon=True).start()
+    return wakeup
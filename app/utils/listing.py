@@ -0,0 +1,72 @@
+import base64
+import json
+
+SORT_FIELDS = ('name', 'size', 'date')
+# Types of the parts of each sort key, as _sort_key builds it
+_KEY_TYPES = {
+    'name': (str, str),
+    'size': (int, str, str),
+    'date': ((int, float), str, str)
+}
+
+def _sort_key(item, sort):
+    """Return the per-item key for the given sort field, ties broken by name"""
+    name = item['name']
+    if sort == 'size':
+        return [item['size'], name.lower(), name]
+    if sort == 'date':
+        return [item['created_at'].timestamp(), name.lower(), name]
+    return [name.lower(), name]
+
+def sort_listing(items, sort='name', descending=False):
+    """Sort directory items in place, folders first, then by the sort field"""
+    items.sort(key=lambda item: _sort_key(item, sort), reverse=descending)
+    # Stable sort keeps the field order inside each group
+    items.sort(key=lambda item: item['is_file'])
+    return items
+
+def encode_cursor(item, sort):
+    """Encode the position of an item as an opaque cursor string"""
+    payload = json.dumps([item['is_file'], _sort_key(item, sort)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, sort='name'):
+    """Decode a cursor produced by encode_cursor for ``sort``, or return None if it is invalid"""
+    try:
+        is_file, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        return None
+    types = _KEY_TYPES[sort]
+    # A key of the wrong shape could not even be compared with the items' keys
+    if (not isinstance(is_file, bool) or not isinstance(key, list) or len(key) != len(types)
+            or any(isinstance(part, bool) or not isinstance(part, kind) for part, kind in zip(key, types))):
+        return None
+    return is_file, key
+
+def paginate_listing(items, sort='name', descending=False, after=None, limit=100):
+    """Return one page of a sorted listing and the cursor for the next page.
+
+    ``after`` is a position decoded with decode_cursor. The cursor holds the
+    sort key of the last item returned instead of an offset, so entries
+    created or deleted between requests do not make pages skip or repeat
+    items.
+    """
+    start = 0
+    if after:
+        cursor_is_file, cursor_key = after
+        for start, item in enumerate(items):
+            if item['is_file'] != cursor_is_file:
+                if item['is_file'] > cursor_is_file:
+                    break
+                continue
+            key = _sort_key(item, sort)
+            if (key < cursor_key) if descending else (key > cursor_key):
+                break
+        else:
+            start = len(items)
+
+    page = items[start:start + limit]
+    next_cursor = None
+    if start + limit < len(items) and page:
+        next_cursor = encode_cursor(page[-1], sort)
+    return page, next_cursor
@@ -0,0 +1,137 @@
+import os
+import threading
+from collections import OrderedDict
+from flask import current_app
+from app.utils.filesystem import scan_directory
+
+# Rough per-entry cost of a cached item dict, on top of its path strings
+_ITEM_OVERHEAD = 600
+
+def _normalize(path):
+    return path.replace('\\', '/').strip('/')
+
+def _estimate_size(items):
+    return sum(_ITEM_OVERHEAD + 2 * (len(item['name']) + len(item['path'])) for item in items)
+
+class ListingCache:
+    """LRU cache of scanned directory listings keyed by (user id, path).
+
+    An entry is only served while the directory's mtime is unchanged, which
+    catches entries created, renamed or removed behind the app's back. Writes
+    that do not touch the directory mtime, such as overwriting a file in place,
+    must call invalidate() explicitly.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id, path, full_path):
+        """Return the cached items for a directory, or None on a miss"""
+        key = (user_id, _normalize(path))
+        try:
+            mtime_ns = os.stat(full_path).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and mtime_ns is not None and entry[0] == mtime_ns:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                # Callers fill in row ids, so they get copies of the shared items
+                return [dict(item) for item in entry[1]]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, user_id, path, mtime_ns, items):
+        """Cache a listing scanned while the directory had the given mtime"""
+        size = _estimate_size(items)
+        if size > self.max_bytes:
+            return
+        key = (user_id, _normalize(path))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (mtime_ns, [dict(item) for item in items], size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def attach_ids(self, user_id, path, items):
+        """Copy the database ids reconciled onto listed items into the cached listing, if it is still cached"""
+        ids = {item['path']: (item['id'], item['folder_id']) for item in items if item.get('id') is not None}
+        if not ids:
+            return
+        with self._lock:
+            entry = self._entries.get((user_id, _normalize(path)))
+            if entry is None:
+                return
+            for item in entry[1]:
+                if item['path'] in ids:
+                    item['id'], item['folder_id'] = ids[item['path']]
+
+    def invalidate(self, user_id, path=''):
+        """Drop the cached listings of a directory and everything below it"""
+        path = _normalize(path)
+        prefix = path + '/'
+        with self._lock:
+            stale = [key for key in self._entries
+                     if key[0] == user_id and (not path or key[1] == path or key[1].startswith(prefix))]
+            for key in stale:
+                self._remove(key)
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.current_bytes -= entry[2]
+
+def get_listing_cache():
+    """Return the listing cache of the current app"""
+    return current_app.extensions['listing_cache']
+
+def list_directory(user_id, path, full_path):
+    """Return the scanned items of a directory, served from the cache when valid"""
+    cache = get_listing_cache()
+    items = cache.get(user_id, path, full_path)
+    if items is None:
+        # Read the mtime before scanning so a change during the scan is never cached as current
+        mtime_ns = os.stat(full_path).st_mtime_ns
+        items = scan_directory(full_path, path)
+        cache.put(user_id, path, mtime_ns, items)
+    return items
+
+def remember_listing_ids(user_id, path, items):
+    """Keep the database ids of listed items in the current app's cached listing, so later views skip the lookups"""
+    get_listing_cache().attach_ids(user_id, path, items)
+
+def invalidate_listing(user_id, path=''):
+    """Invalidate cached listings for a directory subtree of the current app"""
+    get_listing_cache().invalidate(user_id, path)
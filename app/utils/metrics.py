@@ -0,0 +1,84 @@
+"""System metrics sampled in the background for the admin dashboard.
+
+Every METRICS_INTERVAL seconds a sampler thread records CPU, memory and
+upload-disk usage and the request rate since the previous sample into a
+ring buffer of METRICS_HISTORY samples, so pages read the latest sample
+instead of measuring on the spot. CPU usage is psutil's figure since the
+previous call, which never blocks. Like the listing cache, the sampler and
+its request counter belong to one worker process.
+"""
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from flask import current_app
+import psutil
+from app.utils.background import start_periodic_task
+
+class MetricsSampler:
+    def __init__(self, disk_path, history=720):
+        self.disk_path = disk_path
+        self._samples = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._last_count = (time.monotonic(), 0)
+        # Start psutil's CPU measurement so the first sample covers a real interval
+        psutil.cpu_percent(interval=None)
+
+    def count_request(self):
+        with self._lock:
+            self._requests += 1
+
+    def sample(self):
+        """Record the current metrics and return them"""
+        cpu_percent = psutil.cpu_percent(interval=None)
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(self.disk_path)
+        now = time.monotonic()
+        with self._lock:
+            since, counted = self._last_count
+            requests = self._requests
+            self._last_count = (now, requests)
+        elapsed = now - since
+        sample = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'cpu_percent': cpu_percent,
+            'memory_percent': memory.percent,
+            'memory_used': memory.used,
+            'disk_percent': disk.percent,
+            'disk_used': disk.used,
+            'disk_free': disk.free,
+            'requests_per_second': round((requests - counted) / elapsed, 2) if elapsed > 0 else 0.0
+        }
+        with self._lock:
+            self._samples.append(sample)
+        return sample
+
+    def latest(self):
+        """The most recent sample, taken now if there is none yet"""
+        with self._lock:
+            if self._samples:
+                return self._samples[-1]
+        return self.sample()
+
+    def history(self, limit=None):
+        """Samples oldest first, the last ``limit`` of them if given"""
+        with self._lock:
+            samples = list(self._samples)
+        return samples[-limit:] if limit else samples
+
+def get_metrics_sampler():
+    """Return the metrics sampler of the current app"""
+    return current_app.extensions['metrics_sampler']
+
+def start_metrics_sampler(app):
+    """Count requests and sample metrics every METRICS_INTERVAL seconds.
+
+    Requests are counted even under TESTING, but samples are then only taken
+    on demand, as no background task runs there.
+    """
+    sampler = MetricsSampler(app.config['UPLOAD_FOLDER'], app.config['METRICS_HISTORY'])
+    app.extensions['metrics_sampler'] = sampler
+    app.before_request(sampler.count_request)
+    start_periodic_task(app, 'metrics-sampler', app.config['METRICS_INTERVAL'], sampler.sample)
+    return sampler
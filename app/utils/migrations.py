@@ -0,0 +1,142 @@
+"""Versioned schema migrations for existing databases.
+
+``db.create_all()`` creates missing tables but never alters tables that already
+exist, so schema changes to existing deployments are applied here. The version
+of the last applied migration is stored in SQLite's ``user_version`` pragma.
+Every migration is idempotent, because a fresh database already gets the
+current schema from ``db.create_all()`` before the migrations run.
+"""
+import logging
+from sqlalchemy import text
+from app import db
+from app.models.file import split_path
+from app.utils.search import create_search_index
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """Register a migration function for the given schema version"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+def get_schema_version(connection):
+    """Return the version of the last migration applied to the database"""
+    return connection.execute(text('PRAGMA user_version')).scalar() or 0
+
+def table_columns(connection, table):
+    """Return the column names of an existing table"""
+    return {row[1] for row in connection.execute(text(f'PRAGMA table_info("{table}")'))}
+
+def add_column_if_missing(connection, table, column, ddl):
+    """Add a column to an existing table unless it is already there"""
+    if column not in table_columns(connection, table):
+        connection.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+def run_migrations():
+    """Apply every registered migration newer than the database's schema version"""
+    with db.engine.begin() as connection:
+        current_version = get_schema_version(connection)
+        for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version <= current_version:
+                continue
+            logging.info(f"Applying schema migration {version}: {description}")
+            func(connection)
+            connection.execute(text(f'PRAGMA user_version = {int(version)}'))
+            current_version = version
+    return current_version
+
+@migration(1, 'Unique (owner_id, name) indexes on files and folders, shared link lookup indexes')
+def _add_lookup_indexes(connection):
+    # Older versions could record the same path twice. Point shares and child
+    # folders at the oldest row for each path, drop the duplicates, and only
+    # then build the unique indexes.
+    connection.execute(text(
+        'UPDATE shared_link SET file_id = ('
+        ' SELECT MIN(dup.id) FROM file AS orig JOIN file AS dup'
+        ' ON dup.owner_id = orig.owner_id AND dup.name = orig.name'
+        ' WHERE orig.id = shared_link.file_id'
+        ') WHERE file_id IN (SELECT id FROM file)'
+    ))
+    connection.execute(text(
+        'UPDATE shared_link SET folder_id = ('
+        ' SELECT MIN(dup.id) FROM folder AS orig JOIN folder AS dup'
+        ' ON dup.owner_id = orig.owner_id AND dup.name = orig.name'
+        ' WHERE orig.id = shared_link.folder_id'
+        ') WHERE folder_id IN (SELECT id FROM folder)'
+    ))
+    connection.execute(text(
+        'UPDATE folder SET parent_id = ('
+        ' SELECT MIN(dup.id) FROM folder AS orig JOIN folder AS dup'
+        ' ON dup.owner_id = orig.owner_id AND dup.name = orig.name'
+        ' WHERE orig.id = folder.parent_id'
+        ') WHERE parent_id IN (SELECT id FROM folder)'
+    ))
+    for table in ('file', 'folder'):
+        connection.execute(text(
+            f'DELETE FROM {table} WHERE id NOT IN '
+            f'(SELECT MIN(id) FROM {table} GROUP BY owner_id, name)'
+        ))
+        connection.execute(text(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS ix_{table}_owner_name ON {table} (owner_id, name)'
+        ))
+
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_shared_link_created_by ON shared_link (created_by)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_shared_link_bulk_share_id ON shared_link (bulk_share_id)'
+    ))
+
+@migration(2, 'Stored per-user storage usage counter')
+def _add_storage_used(connection):
+    add_column_if_missing(connection, 'users', 'storage_used', "BIGINT NOT NULL DEFAULT 0")
+    connection.execute(text(
+        'UPDATE users SET storage_used = COALESCE('
+        '(SELECT SUM(size) FROM file WHERE file.owner_id = users.id), 0)'
+    ))
+
+@migration(3, 'Trigram full-text index over file and folder paths')
+def _add_search_index(connection):
+    create_search_index(connection)
+
+@migration(4, 'Basename, extension and parent path columns on files and folders')
+def _add_path_columns(connection):
+    columns = {'file': ('basename', 'extension', 'parent_path'), 'folder': ('basename', 'parent_path')}
+    for table, names in columns.items():
+        for column in names:
+            add_column_if_missing(connection, table, column, "VARCHAR NOT NULL DEFAULT ''")
+        rows = connection.execute(text(f'SELECT id, name FROM {table}')).fetchall()
+        assignments = ', '.join(f'{column} = :{column}' for column in names)
+        for start in range(0, len(rows), 10000):
+            params = []
+            for row_id, name in rows[start:start + 10000]:
+                split = split_path(name)
+                params.append({'id': row_id, **{column: split[column] for column in names}})
+            connection.execute(text(f'UPDATE {table} SET {assignments} WHERE id = :id'), params)
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_file_owner_parent ON file (owner_id, parent_path, basename)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_file_owner_extension ON file (owner_id, extension)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_folder_owner_parent ON folder (owner_id, parent_path, basename)'
+    ))
+
+@migration(5, 'Content hash of deduplicated files')
+def _add_file_sha256(connection):
+    add_column_if_missing(connection, 'file', 'sha256', 'VARCHAR(64)')
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_file_sha256 ON file (sha256)'))
+
+@migration(6, 'Object store key of files kept in the sharded layout')
+def _add_file_storage_key(connection):
+    add_column_if_missing(connection, 'file', 'storage_key', 'VARCHAR(64)')
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_file_storage_key ON file (storage_key)'))
+
+@migration(7, 'Last access time and storage tier of files')
+def _add_file_tiering(connection):
+    add_column_if_missing(connection, 'file', 'last_accessed_at', 'DATETIME')
+    add_column_if_missing(connection, 'file', 'tier', 'INTEGER NOT NULL DEFAULT 0')
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_file_tier_access ON file (tier, last_accessed_at)'))
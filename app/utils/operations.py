@@ -0,0 +1,289 @@
+"""Copy, move and delete operations on a user's files, shared by requests and background jobs.
+
+Each operation keeps the disk and the File/Folder rows in step and commits
+once at the end. They are written to be safe to run again after being
+interrupted, which is how a job resumes after a restart: copies overwrite
+what an earlier attempt already copied, a move whose source is gone but whose
+destination exists only updates the rows, and deletes skip what is already
+gone. ``progress(files, bytes)``, if given, is called with the increments as
+files are processed.
+"""
+import os
+import shutil
+from collections import Counter
+from sqlalchemy import func, literal
+from app import db
+from app.models.user import User
+from app.models.file import File
+from app.models.folder import Folder
+from app.utils.blobs import dedup_enabled, link_copy
+from app.utils.copy_engine import copy_file, copy_tree
+from app.utils.filesystem import adjust_storage_used, subtree_condition, subtree_file_size
+from app.utils.listing_cache import invalidate_listing
+from app.utils.storage import sharded_layout, user_root, stored_path, storage_target, remove_stored_files
+from app.utils.watcher import app_write
+
+class DestinationExistsError(Exception):
+    """Raised when a move would replace an existing file or folder"""
+
+def _report(progress, path):
+    if progress:
+        try:
+            progress(1, os.lstat(path).st_size)
+        except OSError:
+            progress(1, 0)
+
+def copy_entry(user_id, username, source_path, destination_path, is_file, progress=None):
+    """Copy a file or folder into ``destination_path``; return how many files each strategy copied"""
+    base = user_root(username)
+    source_full_path = os.path.join(base, source_path)
+    destination_full_path = os.path.join(base, destination_path.strip('/'), os.path.basename(source_path))
+    relative_path = os.path.join(destination_path.strip('/'), os.path.basename(source_path))
+
+    with app_write(user_id, relative_path):
+        if sharded_layout():
+            strategies = _copy_rows(user_id, username, source_path, relative_path, progress)
+        elif is_file:
+            os.makedirs(os.path.dirname(destination_full_path), exist_ok=True)
+            sha256 = None
+            if dedup_enabled():
+                # A new link to the source's blob; no bytes are copied
+                source_file = File.query.filter_by(name=source_path, owner_id=user_id).first()
+                sha256 = link_copy(source_full_path, destination_full_path, source_file.sha256 if source_file else None)
+                strategies = {'link' if sha256 else 'copy': 1}
+            else:
+                strategies = {copy_file(source_full_path, destination_full_path): 1}
+            _report(progress, destination_full_path)
+
+            # Create new file record, or refresh the one for an overwritten file
+            file_size = os.path.getsize(destination_full_path)
+            existing_file = File.query.filter_by(name=relative_path, owner_id=user_id).first()
+            if existing_file:
+                adjust_storage_used(user_id, file_size - (existing_file.size or 0))
+                existing_file.size = file_size
+                existing_file.sha256 = sha256
+                existing_file.tier = 0
+            else:
+                db.session.add(File(name=relative_path, size=file_size, owner_id=user_id, sha256=sha256))
+                adjust_storage_used(user_id, file_size)
+        else:
+            copied = {}
+            if dedup_enabled():
+                recorded = {
+                    os.path.join(base, name): sha256
+                    for name, sha256 in File.query.filter(
+                        File.owner_id == user_id,
+                        subtree_condition(File.name, source_path),
+                        File.sha256.isnot(None)
+                    ).with_entities(File.name, File.sha256)
+                }
+
+                def copy_function(source, destination):
+                    copied[destination] = link_copy(source, destination, recorded.get(source))
+                    _report(progress, destination)
+                    return 'link' if copied[destination] else 'copy'
+            else:
+                def copy_function(source, destination):
+                    strategy = copy_file(source, destination)
+                    _report(progress, destination)
+                    return strategy
+
+            # An interrupted earlier attempt may have created part of the tree
+            strategies = copy_tree(source_full_path, destination_full_path, copy_function=copy_function,
+                                   dirs_exist_ok=True)
+
+            # Create new folder record
+            if not Folder.query.filter_by(name=relative_path, owner_id=user_id).first():
+                db.session.add(Folder(name=relative_path, owner_id=user_id))
+
+            # Create records for all files in the folder
+            for root, dirs, files in os.walk(destination_full_path):
+                relative_root = os.path.relpath(root, base)
+
+                for dir_name in dirs:
+                    folder_path = os.path.join(relative_root, dir_name)
+                    if not Folder.query.filter_by(name=folder_path, owner_id=user_id).first():
+                        db.session.add(Folder(name=folder_path, owner_id=user_id))
+
+                for file_name in files:
+                    file_path = os.path.join(relative_root, file_name)
+                    if not File.query.filter_by(name=file_path, owner_id=user_id).first():
+                        file_size = os.path.getsize(os.path.join(root, file_name))
+                        db.session.add(File(name=file_path, size=file_size, owner_id=user_id,
+                                            sha256=copied.get(os.path.join(root, file_name))))
+                        adjust_storage_used(user_id, file_size)
+
+        db.session.commit()
+        invalidate_listing(user_id, destination_path)
+        # Number of files copied by each strategy
+        return {'strategies': dict(strategies)}
+
+def _copy_rows(user_id, username, source_path, relative_path, progress=None):
+    """Copy the rows at or below ``source_path`` to ``relative_path``, each file to an object of its own"""
+    source_path = source_path.strip('/')
+    strategies = Counter()
+    added_bytes = 0
+    # Nothing is written until the end, so progress updates of a job are not blocked by this transaction
+    with db.session.no_autoflush:
+        for folder in Folder.query.filter(Folder.owner_id == user_id, subtree_condition(Folder.name, source_path)).all():
+            name = relative_path + folder.name[len(source_path):]
+            if not Folder.query.filter_by(name=name, owner_id=user_id).first():
+                db.session.add(Folder(name=name, owner_id=user_id))
+
+        for file in File.query.filter(File.owner_id == user_id, subtree_condition(File.name, source_path)).all():
+            name = relative_path + file.name[len(source_path):]
+            existing_file = File.query.filter_by(name=name, owner_id=user_id).first()
+            destination, key = storage_target(username, name, existing_file)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            sha256 = None
+            if dedup_enabled():
+                sha256 = link_copy(stored_path(username, file), destination, file.sha256)
+                strategies['link' if sha256 else 'copy'] += 1
+            else:
+                strategies[copy_file(stored_path(username, file), destination)] += 1
+            _report(progress, destination)
+
+            file_size = os.path.getsize(destination)
+            if existing_file:
+                added_bytes += file_size - (existing_file.size or 0)
+                existing_file.size = file_size
+                existing_file.sha256 = sha256
+                existing_file.tier = 0
+            else:
+                db.session.add(File(name=name, size=file_size, owner_id=user_id, sha256=sha256, storage_key=key))
+                added_bytes += file_size
+    adjust_storage_used(user_id, added_bytes)
+    return strategies
+
+def _row_exists(user_id, path):
+    return any(model.query.filter_by(owner_id=user_id, name=path).first() is not None for model in (File, Folder))
+
+def _remove_rows(user_id, path):
+    """Delete the rows at or below ``path`` in the current transaction, uncounting their sizes"""
+    adjust_storage_used(user_id, -subtree_file_size(user_id, path))
+    for model in (File, Folder):
+        model.query.filter(model.owner_id == user_id, subtree_condition(model.name, path)).delete(synchronize_session=False)
+
+def move_entry(user_id, username, source_path, destination_path, is_file, progress=None):
+    """Move a file or folder into ``destination_path`` and rename its rows"""
+    base = user_root(username)
+    source_full_path = os.path.join(base, source_path)
+    destination_full_path = os.path.join(base, destination_path.strip('/'), os.path.basename(source_path))
+    new_path = os.path.join(destination_path.strip('/'), os.path.basename(source_path))
+
+    def copy_function(source, destination):
+        strategy = copy_file(source, destination)
+        _report(progress, destination)
+        return strategy
+
+    if new_path == source_path:
+        return {'path': new_path}
+
+    with app_write(user_id, source_path, new_path):
+        source_exists = os.path.lexists(source_full_path)
+        source_rows = _row_exists(user_id, source_path)
+        if not source_exists and not source_rows and _row_exists(user_id, new_path):
+            # Finished by an earlier attempt that was interrupted before its job was marked done
+            return {'path': new_path}
+
+        # Checked before touching the disk, so a refused move changes nothing
+        if sharded_layout():
+            # Moved entries have no tree entry to go by, so only the rows tell whether the name is taken
+            if _row_exists(user_id, new_path):
+                raise DestinationExistsError(f'{new_path} already exists')
+        elif not source_exists and source_rows and os.path.lexists(destination_full_path):
+            # Moved on disk by an interrupted earlier attempt whose rows still carry the source path;
+            # drop the rows the sync may have added for the destination since, the source's are renamed onto it
+            _remove_rows(user_id, new_path)
+        elif os.path.lexists(destination_full_path) or _row_exists(user_id, new_path):
+            raise DestinationExistsError(f'{new_path} already exists')
+
+        # In the sharded layout only files not migrated yet have a tree entry to move.
+        if os.path.lexists(source_full_path) or not (sharded_layout() or os.path.lexists(destination_full_path)):
+            os.makedirs(os.path.dirname(destination_full_path), exist_ok=True)
+            # Only copies when the destination is on another filesystem
+            shutil.move(source_full_path, destination_full_path, copy_function=copy_function)
+
+        if is_file:
+            # Update file record
+            file = File.query.filter_by(name=source_path, owner_id=user_id).first()
+            if file:
+                file.name = new_path
+        else:
+            # Update folder record and all contained files/folders
+            folder = Folder.query.filter_by(name=source_path, owner_id=user_id).first()
+            if folder:
+                folder.name = new_path
+
+            # Update paths for all files and folders inside
+            old_prefix = source_path + '/'
+            new_prefix = new_path + '/'
+
+            # Basenames stay the same; only the leading part of name and parent_path changes
+            for model in (File, Folder):
+                model.query.filter(
+                    model.owner_id == user_id,
+                    model.name >= old_prefix,
+                    model.name < old_prefix[:-1] + '0'
+                ).update({
+                    model.name: literal(new_prefix) + func.substr(model.name, len(old_prefix) + 1),
+                    model.parent_path: literal(new_prefix[:-1]) + func.substr(model.parent_path, len(source_path) + 1)
+                }, synchronize_session=False)
+
+        db.session.commit()
+        invalidate_listing(user_id, os.path.dirname(source_path))
+        invalidate_listing(user_id, destination_path)
+        return {'path': new_path}
+
+def _remove_tree(full_path, progress=None):
+    """Delete a file or directory tree bottom-up, tolerating entries that are already gone"""
+    if not os.path.isdir(full_path) or os.path.islink(full_path):
+        try:
+            size = os.lstat(full_path).st_size
+            os.remove(full_path)
+        except FileNotFoundError:
+            return
+        if progress:
+            progress(1, size)
+        return
+    for root, dirs, files in os.walk(full_path, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                size = os.lstat(path).st_size
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            if progress:
+                progress(1, size)
+        for name in dirs:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.remove(path)
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+    shutil.rmtree(full_path, ignore_errors=True)
+
+def delete_entry(user_id, username, path, progress=None):
+    """Delete a file or folder and every row at or below it"""
+    path = path.strip('/')
+    with app_write(user_id, path):
+        remove_stored_files(user_id, path, progress)
+        _remove_tree(os.path.join(user_root(username), path), progress)
+        _remove_rows(user_id, path)
+        db.session.commit()
+        invalidate_listing(user_id, os.path.dirname(path))
+        return {'path': path}
+
+def delete_user_data(user_id, username, progress=None):
+    """Delete a user together with their files and rows"""
+    with app_write(user_id, ''):
+        remove_stored_files(user_id, progress=progress)
+        _remove_tree(user_root(username), progress)
+        File.query.filter_by(owner_id=user_id).delete()
+        Folder.query.filter_by(owner_id=user_id).delete()
+        user = db.session.get(User, user_id)
+        if user:
+            db.session.delete(user)
+        db.session.commit()
+        return {'username': username}
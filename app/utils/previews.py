@@ -0,0 +1,200 @@
+"""Image thumbnails and the first lines of text files, shown in listings.
+
+Previews are rendered by a pool of PREVIEW_WORKERS processes, so decoding a
+large image never holds a request thread's GIL, and kept in a DiskCache
+under PREVIEW_CACHE_FOLDER keyed by the file's path, size and mtime: a
+rewritten file gets a new entry and the old one ages out of the cache. A
+request for a preview that is not cached yet queues it, waits up to
+PREVIEW_WAIT seconds and otherwise answers 202 with a placeholder, and the
+page asks again shortly. A file that cannot be rendered is cached as an
+empty entry, so it is not retried until it changes.
+
+Preview URLs carry the file's mtime as ``v``; a response for the current
+version may be cached by the browser for good, any other gets revalidated
+with its ETag. Image thumbnails need Pillow, which requirements.txt installs;
+where it is missing only text files have previews.
+"""
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import Response, current_app, request
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = None
+
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tif', 'tiff'}
+TEXT_EXTENSIONS = {
+    'txt', 'md', 'csv', 'log', 'json', 'xml', 'yml', 'yaml', 'ini', 'cfg', 'conf',
+    'html', 'css', 'js', 'py', 'java', 'php', 'c', 'cpp', 'h', 'sh', 'sql'
+}
+PREVIEW_MIMETYPES = {'image': 'image/jpeg', 'text': 'text/plain'}
+PLACEHOLDERS = {
+    'image': ('image/svg+xml', b'<svg xmlns="http://www.w3.org/2000/svg" width="64" height="64">'
+                               b'<rect width="64" height="64" rx="6" fill="#3a3f44"/></svg>'),
+    'text': ('text/plain', b'')
+}
+# A year, the longest max-age browsers honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+def preview_kind(name):
+    """'image' or 'text' if a file with this name gets a preview, else None"""
+    extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    if extension in IMAGE_EXTENSIONS and Image is not None:
+        return 'image'
+    if extension in TEXT_EXTENSIONS:
+        return 'text'
+    return None
+
+def render_thumbnail(path, size):
+    """JPEG bytes of the image at ``path`` scaled to fit a ``size`` pixel square"""
+    with Image.open(path) as image:
+        # Lets JPEG decoding scale down as it goes, which is far cheaper than resizing afterwards
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode != 'RGB':
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=80, optimize=True)
+    return output.getvalue()
+
+def render_text_head(path, max_bytes, max_lines):
+    """UTF-8 bytes of the first lines of the text file at ``path``; empty for binary files"""
+    with open(path, 'rb') as f:
+        data = f.read(max_bytes + 1)
+    if b'\0' in data:
+        return b''
+    lines = data[:max_bytes].decode('utf-8', errors='replace').splitlines()
+    if len(data) > max_bytes and len(lines) > 1:
+        # The last line was cut off
+        lines.pop()
+    return '\n'.join(lines[:max_lines]).encode('utf-8')
+
+class PreviewRenderer:
+    """Renders previews into a DiskCache, at most one render per key at a time"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _start_pool(self, workers):
+        # The pool starts from a threaded request worker, and a forked child could inherit
+        # a lock another thread held at that moment, so workers come from a clean process
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method))
+
+    def _job(self, kind, path):
+        config = current_app.config
+        if kind == 'image':
+            return render_thumbnail, (path, config['THUMBNAIL_SIZE'])
+        return render_text_head, (path, config['TEXT_PREVIEW_BYTES'], config['TEXT_PREVIEW_LINES'])
+
+    def _store(self, key, future):
+        try:
+            data = future.result()
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool next time rather than caching a failure
+            logging.error("Preview worker process died")
+            with self._lock:
+                self._executor = None
+                self._pending.pop(key, None)
+            return
+        except Exception as e:
+            logging.info(f"No preview for cache key {key!r}: {e}")
+            data = b''
+        try:
+            self.cache.put(key, data)
+        except OSError as e:
+            logging.warning(f"Could not cache preview: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def render(self, key, kind, path):
+        """Return the preview bytes for ``key``, empty if there is none, or None while it is rendering"""
+        cached = self.cache.lookup(key)
+        if cached:
+            with open(cached, 'rb') as f:
+                return f.read()
+
+        function, arguments = self._job(kind, path)
+        workers = current_app.config['PREVIEW_WORKERS']
+        if not workers:
+            try:
+                data = function(*arguments)
+            except Exception as e:
+                logging.info(f"No preview for {path}: {e}")
+                data = b''
+            self.cache.put(key, data)
+            return data
+
+        submitted = False
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._start_pool(workers)
+                try:
+                    future = self._executor.submit(function, *arguments)
+                except BrokenProcessPool:
+                    self._start_pool(workers)
+                    future = self._executor.submit(function, *arguments)
+                self._pending[key] = future
+                submitted = True
+        if submitted:
+            # Outside the lock: a future that is already done runs the callback, which takes the lock, right here
+            future.add_done_callback(lambda done: self._store(key, done))
+        try:
+            return future.result(timeout=current_app.config['PREVIEW_WAIT'])
+        except TimeoutError:
+            return None
+        except BrokenProcessPool:
+            return None
+        except Exception:
+            return b''
+
+def get_preview_renderer():
+    """Return the preview renderer of the current app"""
+    return current_app.extensions['preview_renderer']
+
+def preview_response(path, name):
+    """Answer a preview request for the file stored at ``path`` and called ``name``; None if it has no preview"""
+    kind = preview_kind(name)
+    if kind is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = f'{kind}\0{path}\0{stat.st_size}\0{stat.st_mtime_ns}'
+    data = get_preview_renderer().render(key, kind, path)
+    if data is None:
+        mimetype, placeholder = PLACEHOLDERS[kind]
+        response = Response(placeholder, status=202, mimetype=mimetype)
+        response.headers['Retry-After'] = '1'
+        response.cache_control.no_store = True
+        return response
+    if not data:
+        return None
+
+    response = Response(data, mimetype=PREVIEW_MIMETYPES[kind])
+    response.set_etag(hashlib.sha256(key.encode('utf-8')).hexdigest()[:32])
+    response.cache_control.private = True
+    if request.args.get('v') == str(stat.st_mtime_ns):
+        # The URL changes whenever the file does
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -0,0 +1,230 @@
+"""Name search backed by an SQLite FTS5 trigram index.
+
+``search_index`` holds one row per file and folder, keyed by rowid
+``2 * id`` for files and ``2 * id + 1`` for folders, so triggers on the file
+and folder tables can keep it current with rowid lookups. The trigram
+tokenizer matches any substring of three or more characters, case
+insensitively, so searching keeps the substring semantics of the old
+``ILIKE '%q%'`` query without scanning the tables. Where SQLite was built
+without FTS5 or the trigram tokenizer, the index is not created and search
+falls back to LIKE.
+"""
+import base64
+import json
+import logging
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from app import db
+from app.utils.filesystem import _escape_like
+
+SEARCH_TABLE = 'search_index'
+# The trigram tokenizer cannot match anything shorter than this
+MIN_INDEXED_TERM = 3
+
+def _basename_sql(column):
+    # SQLite has no basename(); strip everything up to the last '/'
+    return f"replace({column}, rtrim({column}, replace({column}, '/', '')), '')"
+
+def _index_row_sql(source, kind):
+    rowid = f'{source}.id * 2' if kind == 'file' else f'{source}.id * 2 + 1'
+    return (f'INSERT INTO {SEARCH_TABLE} (rowid, name, path, owner_id) '
+            f'VALUES ({rowid}, {_basename_sql(source + ".name")}, {source}.name, {source}.owner_id);')
+
+def _trigger_statements():
+    statements = []
+    for table, kind in (('file', 'file'), ('folder', 'folder')):
+        old_rowid = 'old.id * 2' if kind == 'file' else 'old.id * 2 + 1'
+        statements += [
+            f'CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN '
+            f'{_index_row_sql("new", kind)} END',
+            f'CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN '
+            f'DELETE FROM {SEARCH_TABLE} WHERE rowid = {old_rowid}; END',
+            f'CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF name, owner_id ON {table} BEGIN '
+            f'DELETE FROM {SEARCH_TABLE} WHERE rowid = {old_rowid}; {_index_row_sql("new", kind)} END',
+        ]
+    return statements
+
+def create_search_index(connection):
+    """Create the index and its triggers and fill it from the tables; False if FTS5 trigram is unavailable"""
+    try:
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+            f"USING fts5(name, path, owner_id UNINDEXED, tokenize='trigram')"
+        ))
+    except OperationalError as e:
+        logging.warning(f"SQLite FTS5 trigram index unavailable, search will scan names: {e}")
+        return False
+    for statement in _trigger_statements():
+        connection.execute(text(statement))
+    connection.execute(text(f'DELETE FROM {SEARCH_TABLE}'))
+    connection.execute(text(
+        f'INSERT INTO {SEARCH_TABLE} (rowid, name, path, owner_id) '
+        f'SELECT id * 2, {_basename_sql("name")}, name, owner_id FROM file'
+    ))
+    connection.execute(text(
+        f'INSERT INTO {SEARCH_TABLE} (rowid, name, path, owner_id) '
+        f'SELECT id * 2 + 1, {_basename_sql("name")}, name, owner_id FROM folder'
+    ))
+    return True
+
+def search_index_available():
+    """Whether the current app's database has the search index"""
+    available = current_app.extensions.get('search_index')
+    if available is None:
+        available = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': SEARCH_TABLE}
+        ).scalar() is not None
+        current_app.extensions['search_index'] = available
+    return available
+
+def _match_expression(terms):
+    return ' AND '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def _indexed_candidates(terms, file_type, params):
+    indexed = [term for term in terms if len(term) >= MIN_INDEXED_TERM]
+    params['match'] = _match_expression(indexed)
+    where = f'{SEARCH_TABLE} MATCH :match AND owner_id = :owner_id'
+    for i, term in enumerate(t for t in terms if len(t) < MIN_INDEXED_TERM):
+        where += f" AND path LIKE :short{i} ESCAPE '\\'"
+        params[f'short{i}'] = '%' + _escape_like(term) + '%'
+    if file_type:
+        where += ' AND rowid % 2 = ' + ('0' if file_type == 'file' else '1')
+    return (
+        f"SELECT rowid, CASE WHEN name LIKE :prefix ESCAPE '\\' THEN 0 ELSE 1 END AS prefix_miss, "
+        f'bm25({SEARCH_TABLE}, 10.0, 1.0) AS score FROM {SEARCH_TABLE} WHERE {where}'
+    )
+
+def _extension_clause(column, extensions, params):
+    for i, extension in enumerate(extensions):
+        params[f'ext{i}'] = extension
+    return f"{column} IN ({', '.join(f':ext{i}' for i in range(len(extensions)))})"
+
+def _scanned_candidates(terms, filters, params):
+    where = 'owner_id = :owner_id'
+    for i, term in enumerate(terms):
+        where += f" AND name LIKE :term{i} ESCAPE '\\'"
+        params[f'term{i}'] = '%' + _escape_like(term) + '%'
+    file_only = (filters.get('type') == 'file' or filters.get('extensions')
+                 or filters.get('min_size') is not None or filters.get('max_size') is not None)
+    selects = []
+    for table, rowid in (('file', 'id * 2'), ('folder', 'id * 2 + 1')):
+        if table == 'file' and filters.get('type') == 'folder' or table == 'folder' and file_only:
+            continue
+        table_where = where
+        if table == 'file' and filters.get('extensions'):
+            # Filter-only searches become a range scan of ix_file_owner_extension
+            table_where += ' AND ' + _extension_clause('extension', filters['extensions'], params)
+        selects.append(
+            f"SELECT {rowid} AS rowid, CASE WHEN basename LIKE :prefix ESCAPE '\\' "
+            f'THEN 0 ELSE 1 END AS prefix_miss, name AS score FROM {table} WHERE {table_where}'
+        )
+    if not selects:
+        # The filters exclude both tables
+        return 'SELECT 0 AS rowid, 0 AS prefix_miss, 0 AS score WHERE 0'
+    return ' UNION ALL '.join(selects)
+
+def _filter_clauses(filters, params):
+    clauses = []
+    if filters.get('extensions'):
+        clauses.append(_extension_clause('f.extension', filters['extensions'], params))
+    # Folders have no size, so a size bound only matches files
+    if filters.get('min_size') is not None:
+        clauses.append('f.size >= :min_size')
+        params['min_size'] = filters['min_size']
+    if filters.get('max_size') is not None:
+        clauses.append('f.size <= :max_size')
+        params['max_size'] = filters['max_size']
+    # Stored the way SQLAlchemy writes DateTime columns to SQLite, so they compare as text
+    if filters.get('created_after') is not None:
+        clauses.append('COALESCE(f.created_at, d.created_at) >= :created_after')
+        params['created_after'] = filters['created_after'].strftime('%Y-%m-%d %H:%M:%S.%f')
+    if filters.get('created_before') is not None:
+        clauses.append('COALESCE(f.created_at, d.created_at) < :created_before')
+        params['created_before'] = filters['created_before'].strftime('%Y-%m-%d %H:%M:%S.%f')
+    return clauses
+
+def build_search_query(user_id, query, filters=None, after=None, limit=100, indexed=True, count_limit=None):
+    """Return the (statement, params) for one page of search results.
+
+    Each result row is (rowid, prefix_miss, score). With ``indexed``, terms
+    of three or more characters are matched through the trigram index,
+    shorter ones are applied as substring filters on the matched rows, and
+    results rank by bm25 with name hits weighted above hits elsewhere in the
+    path. Otherwise the file and folder tables are scanned and results are
+    ordered by path. Either way, names that start with the query come first.
+
+    ``filters`` may hold ``type`` ('file' or 'folder'), ``extensions``,
+    ``min_size``, ``max_size``, ``created_after`` and ``created_before``;
+    they are all applied in SQL. ``after`` is the (prefix_miss, score, rowid)
+    of the last row of the previous page. With ``count_limit``, the statement
+    counts the matches instead, stopping at that many.
+    """
+    filters = filters or {}
+    terms = query.split()
+    params = {'owner_id': user_id, 'prefix': _escape_like(query) + '%'}
+    if indexed:
+        candidates = _indexed_candidates(terms, filters.get('type'), params)
+    else:
+        candidates = _scanned_candidates(terms, filters, params)
+
+    clauses = _filter_clauses(filters, params)
+    joins = ''
+    if clauses:
+        joins = (' LEFT JOIN file AS f ON c.rowid % 2 = 0 AND f.id = c.rowid / 2'
+                 ' LEFT JOIN folder AS d ON c.rowid % 2 = 1 AND d.id = c.rowid / 2')
+    sql = f'WITH c AS ({candidates}) SELECT c.rowid, c.prefix_miss, c.score FROM c{joins}'
+
+    if count_limit is not None:
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        params['count_limit'] = count_limit
+        return text(f'SELECT COUNT(*) FROM ({sql}{where} LIMIT :count_limit)'), params
+
+    if after is not None:
+        clauses.append('(c.prefix_miss, c.score, c.rowid) > (:after_prefix_miss, :after_score, :after_rowid)')
+        params['after_prefix_miss'], params['after_score'], params['after_rowid'] = after
+    where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+    params['limit'] = limit
+    return text(f'{sql}{where} ORDER BY c.prefix_miss, c.score, c.rowid LIMIT :limit'), params
+
+def encode_search_cursor(row):
+    """Encode the sort position of a (rowid, prefix_miss, score) row as an opaque cursor string"""
+    rowid, prefix_miss, score = row
+    payload = json.dumps([prefix_miss, score, rowid], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_search_cursor(cursor):
+    """Decode a cursor produced by encode_search_cursor, or return None if it is invalid"""
+    try:
+        prefix_miss, score, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return int(prefix_miss), score, int(rowid)
+    except (ValueError, TypeError):
+        return None
+
+def search(user_id, query, filters=None, after=None, limit=100, count_limit=1000):
+    """Return one page of matches for ``query`` and ``filters``, best first.
+
+    Returns ``(items, next_cursor, total, total_exact)``, where ``items`` is a
+    list of (is_file, id) pairs. The index is used whenever the query has a
+    term it can match; other queries, and databases without the index, scan
+    the tables. The total is counted in SQL up to ``count_limit`` matches;
+    past that, ``total_exact`` is False and the total is a lower bound.
+    """
+    indexed = (any(len(term) >= MIN_INDEXED_TERM for term in query.split())
+               and search_index_available())
+    rows = db.session.execute(*build_search_query(
+        user_id, query, filters, after, limit + 1, indexed
+    )).fetchall()
+    next_cursor = encode_search_cursor(rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+
+    if after is None and next_cursor is None:
+        # Everything fit on the first page
+        total = len(rows)
+    else:
+        total = db.session.execute(*build_search_query(
+            user_id, query, filters, indexed=indexed, count_limit=count_limit
+        )).scalar()
+    items = [(rowid % 2 == 0, rowid // 2) for rowid, _, _ in rows]
+    return items, next_cursor, total, total < count_limit
@@ -0,0 +1,244 @@
+"""Where the bytes of a user's files are kept on disk.
+
+The default ``tree`` layout stores a file at UPLOAD_FOLDER/<username>/<path>,
+mirroring the folders users see. With STORAGE_LAYOUT = 'sharded', the bytes
+of new files go to OBJECT_FOLDER (UPLOAD_FOLDER/.objects unless configured)
+under ``<key[:2]>/<key[2:4]>/<key>``, where the key is a random hex id kept
+in File.storage_key. No directory then holds more than a few hundred
+entries however many files a user puts in one folder, and the hierarchy
+exists only in the File and Folder tables: folders have no directory,
+listings come from the database and a move only renames rows.
+
+A row with a storage key is always read from the object store and one
+without from the tree, so files in both places work side by side while
+``flask migrate-layout`` moves them to the configured layout.
+"""
+import logging
+import os
+import posixpath
+import shutil
+import uuid
+from flask import current_app
+from app import db
+from app.models.file import File
+from app.models.folder import Folder
+from app.utils.filesystem import UPLOAD_TEMP_PREFIX, direct_children_query, adjust_storage_used, subtree_condition
+
+STORAGE_LAYOUTS = ('tree', 'sharded')
+
+def sharded_layout():
+    return current_app.config['STORAGE_LAYOUT'] == 'sharded'
+
+def user_root(username):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], username)
+
+def object_folder():
+    return current_app.config['OBJECT_FOLDER'] or os.path.join(current_app.config['UPLOAD_FOLDER'], '.objects')
+
+def object_path(key):
+    """Path of the object with the given storage key, fanned out over two directory levels"""
+    return os.path.join(object_folder(), key[:2], key[2:4], key)
+
+def new_storage_key():
+    return uuid.uuid4().hex
+
+def stored_path(username, file):
+    """Path holding the bytes of a File row"""
+    if file.storage_key:
+        return object_path(file.storage_key)
+    return os.path.join(user_root(username), file.name)
+
+def storage_target(username, name, file=None):
+    """Return ``(path, storage key)`` to write the contents of ``name`` to.
+
+    An existing row keeps its place; a new file gets an object key in the
+    sharded layout and its tree path otherwise, with a key of None.
+    """
+    if file is not None:
+        return stored_path(username, file), file.storage_key
+    if sharded_layout():
+        key = new_storage_key()
+        return object_path(key), key
+    return os.path.join(user_root(username), name), None
+
+def locate_file(user_id, username, path):
+    """Return the path holding the bytes of the file at ``path``, or None if there is no such file"""
+    path = path.strip('/')
+    file = File.query.filter_by(owner_id=user_id, name=path).first()
+    if file is not None and file.storage_key:
+        full_path = object_path(file.storage_key)
+    else:
+        # Files in the tree may not have a row yet
+        full_path = os.path.join(user_root(username), path)
+    return full_path if os.path.isfile(full_path) else None
+
+def item_exists(user_id, username, path):
+    """Whether a file or folder exists at ``path``, on disk or only in the database"""
+    path = path.strip('/')
+    if not path or os.path.lexists(os.path.join(user_root(username), path)):
+        return True
+    if not sharded_layout():
+        return False
+    return any(model.query.filter_by(owner_id=user_id, name=path).first() is not None for model in (File, Folder))
+
+def folder_exists(user_id, path):
+    """Whether the folder ``path`` exists in the sharded layout, where folders are only rows"""
+    path = path.strip('/')
+    return not path or Folder.query.filter_by(owner_id=user_id, name=path).first() is not None
+
+def list_stored_directory(user_id, path):
+    """Return browse-style items, ids included, for the rows directly inside ``path``"""
+    path = path.strip('/')
+    items = []
+    for folder in direct_children_query(Folder, user_id, path):
+        items.append({
+            'name': folder.basename,
+            'is_file': False,
+            'size': 0,
+            'created_at': folder.created_at,
+            'path': folder.name,
+            'id': folder.id,
+            'folder_id': folder.id
+        })
+    for file in direct_children_query(File, user_id, path):
+        items.append({
+            'name': file.basename,
+            'is_file': True,
+            'size': file.size or 0,
+            'created_at': file.created_at,
+            'path': file.name,
+            'id': file.id,
+            'folder_id': None
+        })
+    return items
+
+def iter_stored_entries(user_id, username, path, base_path='', include_dirs=True):
+    """Return (arcname, path) pairs for the rows below ``path`` like iter_archive_entries.
+
+    Arcnames are relative to ``base_path`` and directory entries have a path
+    of None. The rows are read up front, so the pairs can be consumed after
+    the request's database session is gone.
+    """
+    def arcname(name):
+        return posixpath.relpath(name, base_path) if base_path else name
+
+    entries = []
+    if include_dirs:
+        folders = Folder.query.filter(
+            Folder.owner_id == user_id,
+            Folder.name.startswith(path.strip('/') + '/', autoescape=True)
+        ).order_by(Folder.name).with_entities(Folder.name)
+        entries.extend((arcname(name), None) for name, in folders)
+    files = File.query.filter(
+        File.owner_id == user_id,
+        subtree_condition(File.name, path.strip('/'))
+    ).order_by(File.name).with_entities(File.name, File.storage_key)
+    root = user_root(username)
+    entries.extend(
+        (arcname(name), object_path(key) if key else os.path.join(root, name))
+        for name, key in files
+    )
+    return entries
+
+def remove_stored_files(user_id, path=None, progress=None):
+    """Delete the objects of the rows at or below ``path``, or of all the user's rows, leaving the rows"""
+    query = File.query.filter(File.owner_id == user_id, File.storage_key.isnot(None))
+    if path:
+        query = query.filter(subtree_condition(File.name, path.strip('/')))
+    for key, size in query.with_entities(File.storage_key, File.size).all():
+        try:
+            os.remove(object_path(key))
+        except FileNotFoundError:
+            continue
+        if progress:
+            progress(1, size or 0)
+
+def _move(source, destination):
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.move(source, destination)
+
+def _remove_empty_directories(root):
+    for current, _, _ in os.walk(root, topdown=False):
+        if current != root:
+            try:
+                os.rmdir(current)
+            except OSError:
+                pass
+
+def migrate_user_to_sharded(user_id, username, batch_size=1000):
+    """Move a user's files from the tree into the object store; return how many were moved.
+
+    The tree is walked rather than the rows, so files that were never synced
+    are picked up too. A batch's keys are committed before its files move,
+    and a file whose row already has a key is simply moved on a later run.
+    """
+    root = user_root(username)
+    moved = 0
+    batch = []
+
+    def flush():
+        nonlocal moved
+        db.session.commit()
+        for key, full_path in batch:
+            _move(full_path, object_path(key))
+        moved += len(batch)
+        batch.clear()
+
+    for current, dirs, names in os.walk(root):
+        relative_root = os.path.relpath(current, root).replace(os.sep, '/')
+        relative_root = '' if relative_root == '.' else relative_root
+        for name in dirs:
+            path = posixpath.join(relative_root, name)
+            if not Folder.query.filter_by(owner_id=user_id, name=path).first():
+                db.session.add(Folder(name=path, owner_id=user_id))
+        for name in names:
+            full_path = os.path.join(current, name)
+            # Demoted files are symlinks into a capacity tier and move like any other file
+            if name.startswith(UPLOAD_TEMP_PREFIX) or not os.path.isfile(full_path):
+                continue
+            path = posixpath.join(relative_root, name)
+            file = File.query.filter_by(owner_id=user_id, name=path).first()
+            if file is None:
+                size = os.path.getsize(full_path)
+                file = File(name=path, size=size, owner_id=user_id)
+                db.session.add(file)
+                adjust_storage_used(user_id, size)
+            if not file.storage_key:
+                file.storage_key = new_storage_key()
+            batch.append((file.storage_key, full_path))
+            if len(batch) >= batch_size:
+                flush()
+    flush()
+    _remove_empty_directories(root)
+    return moved
+
+def migrate_user_to_tree(user_id, username, batch_size=1000):
+    """Move a user's files from the object store back into the tree; return how many were moved"""
+    root = user_root(username)
+    moved = 0
+    last_id = 0
+    while True:
+        files = File.query.filter(
+            File.owner_id == user_id,
+            File.storage_key.isnot(None),
+            File.id > last_id
+        ).order_by(File.id).limit(batch_size).all()
+        if not files:
+            break
+        last_id = files[-1].id
+        for file in files:
+            source = object_path(file.storage_key)
+            destination = os.path.join(root, file.name)
+            if os.path.exists(source):
+                _move(source, destination)
+            elif not os.path.exists(destination):
+                # Neither copy exists; keep the row pointing at the store so nothing is silently lost
+                logging.error(f"Object {file.storage_key} of {username}/{file.name} is missing")
+                continue
+            file.storage_key = None
+            moved += 1
+        db.session.commit()
+    # Folders exist as directories in the tree layout
+    for name, in Folder.query.filter_by(owner_id=user_id).with_entities(Folder.name):
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+    return moved
@@ -0,0 +1,334 @@
+"""Incremental synchronization of the File and Folder tables with the upload folder.
+
+Adding, removing or renaming an entry changes the mtime of the directory that
+holds it, so a directory whose mtime and inode match the state recorded by the
+previous sync still has the same entries and is not listed again. Its
+subdirectories are taken from the Folder table and checked the same way. A
+changed directory is listed once and diffed against its rows with set
+operations, and the resulting inserts and deletes are committed in batches.
+
+Rewriting a file in place does not touch its directory, so size changes made
+behind the app's back are only picked up when the directory changes for
+another reason.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+from sqlalchemy import bindparam
+from app import db
+from app.models.user import User
+from app.models.file import File
+from app.models.folder import Folder
+from app.models.directory_state import DirectoryState
+from app.utils.filesystem import (
+    UPLOAD_TEMP_PREFIX,
+    direct_children_query,
+    recalculate_storage_usage,
+    subtree_condition
+)
+
+# A directory modified this close to the scan may change again within the same
+# mtime tick, so its state is not recorded and it is listed again next time
+_RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+# Rows per IN (...) list when deleting by id
+_DELETE_CHUNK = 500
+
+def _join(path, name):
+    return f'{path}/{name}' if path else name
+
+def _scan(full_path, path):
+    """Return ({relative path: size} for files, set of relative subdirectory paths)"""
+    files = {}
+    dirs = set()
+    with os.scandir(full_path) as entries:
+        for entry in entries:
+            if entry.name.startswith(UPLOAD_TEMP_PREFIX):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.add(_join(path, entry.name))
+                elif entry.is_file():
+                    files[_join(path, entry.name)] = entry.stat().st_size
+            except OSError:
+                # Entry vanished or is a dangling symlink
+                continue
+    return files, dirs
+
+def _delete_ids(model, ids):
+    ids = list(ids)
+    for start in range(0, len(ids), _DELETE_CHUNK):
+        model.query.filter(model.id.in_(ids[start:start + _DELETE_CHUNK])).delete(synchronize_session=False)
+
+def _delete_subtree(user_id, path):
+    """Delete the rows of a directory that no longer exists and everything below it"""
+    File.query.filter(File.owner_id == user_id, subtree_condition(File.name, path)).delete(synchronize_session=False)
+    Folder.query.filter(Folder.owner_id == user_id, subtree_condition(Folder.name, path)).delete(synchronize_session=False)
+    DirectoryState.query.filter(
+        DirectoryState.owner_id == user_id,
+        subtree_condition(DirectoryState.path, path)
+    ).delete(synchronize_session=False)
+
+def sync_directory(user_id, path, full_path, folders, stats):
+    """Diff one directory against its rows; return its subdirectories and the number of rows written"""
+    fs_files, fs_dirs = _scan(full_path, path)
+    db_files = {
+        name: (file_id, size)
+        for file_id, name, size in direct_children_query(File, user_id, path).with_entities(File.id, File.name, File.size)
+    }
+    db_dirs = {
+        name for (name,) in direct_children_query(Folder, user_id, path).with_entities(Folder.name)
+    }
+
+    # Directories recorded as File rows by older versions are dropped here too
+    removed_files = db_files.keys() - fs_files.keys()
+    added_files = fs_files.keys() - db_files.keys()
+    resized = [
+        {'_id': db_files[name][0], 'size': size}
+        for name, size in fs_files.items()
+        if name in db_files and db_files[name][1] != size
+    ]
+    removed_dirs = db_dirs - fs_dirs
+    added_dirs = fs_dirs - db_dirs
+
+    if removed_files:
+        _delete_ids(File, (db_files[name][0] for name in removed_files))
+    if added_files:
+        db.session.execute(File.__table__.insert().prefix_with('OR IGNORE'), [
+            {'name': name, 'size': fs_files[name], 'owner_id': user_id} for name in added_files
+        ])
+    if resized:
+        table = File.__table__
+        db.session.execute(
+            # Rewritten behind the app's back, so no longer the content of its blob
+            table.update().where(table.c.id == bindparam('_id')).values(size=bindparam('size'), sha256=None),
+            resized
+        )
+    for name in removed_dirs:
+        _delete_subtree(user_id, name)
+        folders.pop(name, None)
+    if added_dirs:
+        db.session.execute(Folder.__table__.insert().prefix_with('OR IGNORE'), [
+            {'name': name, 'owner_id': user_id, 'parent_id': folders.get(path)} for name in added_dirs
+        ])
+        # Children inserted later need these ids as their parent_id
+        folders.update(
+            Folder.query.filter(Folder.owner_id == user_id, Folder.name.in_(added_dirs))
+            .with_entities(Folder.name, Folder.id)
+        )
+
+    stats['files_added'] += len(added_files)
+    stats['files_removed'] += len(removed_files)
+    stats['folders_added'] += len(added_dirs)
+    stats['folders_removed'] += len(removed_dirs)
+    written = len(removed_files) + len(added_files) + len(resized) + len(removed_dirs) + len(added_dirs)
+    return fs_dirs, written
+
+def _write_states(user_id, inserts, updates, deletes):
+    table = DirectoryState.__table__
+    if inserts:
+        db.session.execute(table.insert().prefix_with('OR REPLACE'), [
+            {'owner_id': user_id, 'path': path, 'mtime_ns': mtime_ns, 'inode': inode}
+            for path, mtime_ns, inode in inserts
+        ])
+    if updates:
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('_id'))
+            .values(mtime_ns=bindparam('mtime_ns'), inode=bindparam('inode')),
+            [{'_id': state_id, 'mtime_ns': mtime_ns, 'inode': inode} for state_id, mtime_ns, inode in updates]
+        )
+    if deletes:
+        _delete_ids(DirectoryState, deletes)
+    inserts.clear()
+    updates.clear()
+    deletes.clear()
+
+def record_directory_state(user_id, path, stat, scan_started):
+    """Record the ``stat`` of a directory listed at ``scan_started``, or forget it if it changed too close to that"""
+    if scan_started - stat.st_mtime_ns > _RACY_WINDOW_NS:
+        _write_states(user_id, [(path, stat.st_mtime_ns, stat.st_ino)], [], [])
+    else:
+        DirectoryState.query.filter_by(owner_id=user_id, path=path).delete(synchronize_session=False)
+
+def sync_user_tree(user_id, root, batch_size=1000, progress=None):
+    """Bring one user's File and Folder rows in line with their directory tree.
+
+    ``progress``, if given, is called with the running stats after every commit.
+    """
+    stats = defaultdict(int)
+    # Plain tuples rather than ORM objects, which would be reloaded one by one after each commit
+    states = {
+        path: (state_id, mtime_ns, inode)
+        for state_id, path, mtime_ns, inode in DirectoryState.query.filter_by(owner_id=user_id).with_entities(
+            DirectoryState.id, DirectoryState.path, DirectoryState.mtime_ns, DirectoryState.inode)
+    }
+    folders = dict(Folder.query.filter_by(owner_id=user_id).with_entities(Folder.name, Folder.id))
+    children = defaultdict(list)
+    for name in folders:
+        children[os.path.dirname(name)].append(name)
+
+    state_inserts, state_updates, state_deletes = [], [], []
+    scan_started = time.time_ns()
+    pending = 0
+    stack = ['']
+    while stack:
+        path = stack.pop()
+        full_path = os.path.join(root, path) if path else root
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            # Removed since its parent was listed; the parent's next sync drops the rows
+            continue
+        stats['directories'] += 1
+
+        state = states.get(path)
+        if state is not None and state[1] == stat.st_mtime_ns and state[2] == stat.st_ino:
+            stack.extend(children[path])
+            continue
+
+        stats['scanned'] += 1
+        try:
+            subdirs, written = sync_directory(user_id, path, full_path, folders, stats)
+        except OSError as e:
+            logging.warning(f"Skipping {full_path} during sync: {e}")
+            continue
+        stack.extend(subdirs)
+        pending += written + 1
+
+        if scan_started - stat.st_mtime_ns > _RACY_WINDOW_NS:
+            if state is None:
+                state_inserts.append((path, stat.st_mtime_ns, stat.st_ino))
+            else:
+                state_updates.append((state[0], stat.st_mtime_ns, stat.st_ino))
+        elif state is not None:
+            state_deletes.append(state[0])
+
+        if pending >= batch_size:
+            # A directory's state is committed with its rows, so an interrupted
+            # sync resumes where it stopped
+            _write_states(user_id, state_inserts, state_updates, state_deletes)
+            db.session.commit()
+            pending = 0
+            if progress:
+                progress(stats)
+
+    _write_states(user_id, state_inserts, state_updates, state_deletes)
+    db.session.commit()
+    return dict(stats)
+
+def synchronize_database_with_filesystem(app, progress=None):
+    """Sync every user's rows with the upload folder, listing only directories that changed.
+
+    ``progress``, if given, is called with a status dict as the sync advances.
+    Nothing is synced while any file lives in the object store of the sharded
+    layout, since the tree no longer holds every file and its rows would be
+    deleted.
+    """
+    batch_size = app.config['SYNC_BATCH_SIZE']
+    users = db.session.query(User.id, User.username).all()
+    status = {'users_total': len(users), 'users_done': 0, 'directories': 0, 'scanned': 0}
+    if app.config['STORAGE_LAYOUT'] == 'sharded' or db.session.query(File.id).filter(File.storage_key.isnot(None)).first():
+        logging.info("Skipping the filesystem sync: files are kept in the sharded layout")
+        status['skipped'] = True
+        return status
+    for user_id, username in users:
+        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], username)
+        if os.path.isdir(user_folder):
+            started = time.monotonic()
+            done = dict(status)
+
+            def report(stats):
+                status['directories'] = done['directories'] + stats.get('directories', 0)
+                status['scanned'] = done['scanned'] + stats.get('scanned', 0)
+                if progress:
+                    progress(status)
+
+            stats = sync_user_tree(user_id, user_folder, batch_size, report)
+            report(stats)
+            logging.info(
+                f"Synced {username}: {stats.get('scanned', 0)}/{stats.get('directories', 0)} directories listed, "
+                f"{stats.get('files_added', 0)} files added, {stats.get('files_removed', 0)} removed "
+                f"in {time.monotonic() - started:.1f}s"
+            )
+        status['users_done'] += 1
+        if progress:
+            progress(status)
+    recalculate_storage_usage()
+    return status
+
+def _sync_paths(app):
+    folder = app.config['UPLOAD_FOLDER']
+    return os.path.join(folder, '.sync.lock'), os.path.join(folder, '.sync-status.json')
+
+def _write_sync_status(path, status):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(temp_path, path)
+
+def read_sync_status(app):
+    """Return the status of the latest filesystem sync, as written by whichever process ran it"""
+    try:
+        with open(_sync_paths(app)[1]) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'state': 'pending'}
+
+def run_startup_sync(app):
+    """Run the filesystem sync unless another process is running it or finished one recently"""
+    lock_path, status_path = _sync_paths(app)
+    lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("Filesystem sync is already running in another process")
+                return
+
+        previous = read_sync_status(app)
+        grace = app.config['STARTUP_SYNC_GRACE']
+        if previous.get('state') == 'done' and time.time() - previous.get('finished_at', 0) < grace:
+            # Another worker of the same deployment has just synced
+            return
+
+        status = {'state': 'running', 'pid': os.getpid(), 'started_at': time.time()}
+        _write_sync_status(status_path, status)
+        last_write = 0
+
+        def progress(current):
+            nonlocal last_write
+            status.update(current)
+            if time.monotonic() - last_write >= 1:
+                last_write = time.monotonic()
+                _write_sync_status(status_path, status)
+
+        try:
+            with app.app_context():
+                synchronize_database_with_filesystem(app, progress)
+        except Exception as e:
+            logging.exception("Filesystem sync failed")
+            status.update(state='failed', error=str(e), finished_at=time.time())
+        else:
+            status.update(state='done', finished_at=time.time())
+        _write_sync_status(status_path, status)
+    finally:
+        os.close(lock_fd)
+
+def start_background_sync(app):
+    """Start the filesystem sync on a daemon thread so the app can serve requests meanwhile.
+
+    Until the sync reaches a directory, browsing it reconciles its rows on
+    demand. Returns the thread, or None under TESTING.
+    """
+    if app.config.get('TESTING'):
+        return None
+    thread = threading.Thread(target=run_startup_sync, args=(app,), name='filesystem-sync', daemon=True)
+    thread.start()
+    return thread
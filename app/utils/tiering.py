@@ -0,0 +1,203 @@
+"""Hot/cold tiering of file contents across STORAGE_TIERS.
+
+The upload folder (and the object store of the sharded layout) is the fast
+tier. STORAGE_TIERS lists capacity tiers, fastest first, as plain local
+directories that may sit on other filesystems. A file unread for
+TIER_DEMOTE_AFTER seconds is moved to the first capacity tier, after twice
+that to the second, and so on. Its bytes go to ``<tier>/<id % 1000>/<id>``
+and its usual path becomes a symlink to them, so downloads, archives, the
+sync and everything else that opens the path keep working unchanged.
+
+Downloads record when a file was last read. A demoted file that is read
+again is moved back to the fast tier by the next run of the mover, and a
+capacity tier file whose path no longer links to it, because the file was
+deleted or rewritten, is removed.
+
+Files whose bytes are shared through the blob store stay on the fast tier,
+since moving one path would not free the space.
+"""
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+from flask import current_app
+from sqlalchemy import func, or_
+from app import db
+from app.models.file import File
+from app.models.user import User
+from app.utils.copy_engine import copy_file
+from app.utils.filesystem import UPLOAD_TEMP_PREFIX
+from app.utils.storage import stored_path
+
+# Reads closer together than this are recorded once
+ACCESS_RESOLUTION = timedelta(hours=1)
+
+def tiers():
+    return current_app.config['STORAGE_TIERS'] or []
+
+def tier_path(tier, file_id):
+    """Path of a file's bytes on capacity tier ``tier`` (1 is the first capacity tier)"""
+    return os.path.join(tiers()[tier - 1], f'{file_id % 1000:03d}', str(file_id))
+
+def record_access(user_id, name):
+    """Note that a file was read, at most once per ACCESS_RESOLUTION"""
+    now = datetime.now()
+    updated = File.query.filter(
+        File.owner_id == user_id,
+        File.name == name.strip('/'),
+        or_(File.last_accessed_at.is_(None), File.last_accessed_at < now - ACCESS_RESOLUTION)
+    ).update({File.last_accessed_at: now}, synchronize_session=False)
+    if updated:
+        db.session.commit()
+
+def _replace_with_symlink(target, path):
+    """Atomically make ``path`` a symlink to ``target``"""
+    temp_path = os.path.join(os.path.dirname(path), f'{UPLOAD_TEMP_PREFIX}{uuid.uuid4().hex}')
+    os.symlink(target, temp_path)
+    try:
+        os.replace(temp_path, path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+def _unchanged(path, stat):
+    try:
+        current = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    return (current.st_ino, current.st_size, current.st_mtime_ns) == (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def demote_file(file, path, tier):
+    """Move a file's bytes to capacity tier ``tier`` behind a symlink at ``path``; return whether it moved"""
+    before = os.lstat(path)
+    previous = os.readlink(path) if os.path.islink(path) else None
+    if previous is None and before.st_nlink > 1:
+        return False
+    target = tier_path(tier, file.id)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    copy_file(path, target)
+    # The file may have been rewritten or deleted while it was copied
+    if not _unchanged(path, before):
+        os.remove(target)
+        return False
+    _replace_with_symlink(target, path)
+    if previous and previous != target:
+        os.remove(previous)
+    file.tier = tier
+    return True
+
+def promote_file(file, path):
+    """Move a demoted file's bytes back to ``path``; return whether it moved"""
+    if not os.path.islink(path):
+        # Rewritten since it was demoted, so it is already on the fast tier
+        file.tier = 0
+        return True
+    before = os.lstat(path)
+    target = os.readlink(path)
+    temp_path = os.path.join(os.path.dirname(path), f'{UPLOAD_TEMP_PREFIX}{uuid.uuid4().hex}')
+    copy_file(target, temp_path)
+    if not _unchanged(path, before):
+        os.remove(temp_path)
+        return False
+    os.replace(temp_path, path)
+    os.remove(target)
+    file.tier = 0
+    return True
+
+def _candidates(condition, order, limit):
+    return db.session.query(File, User.username).join(User, User.id == File.owner_id).filter(
+        condition
+    ).order_by(order).limit(limit).all()
+
+def _move_batch(rows, move, stats, key):
+    for file, username in rows:
+        path = stored_path(username, file)
+        try:
+            if move(file, path):
+                stats[key] += 1
+        except FileNotFoundError:
+            # Deleted while the mover ran
+            continue
+        except OSError as e:
+            logging.warning(f"Could not move {path} between storage tiers: {e}")
+            stats['errors'] += 1
+    db.session.commit()
+
+def collect_tier_garbage():
+    """Remove capacity tier files that their path no longer links to; return how many"""
+    removed = 0
+    for tier in range(1, len(tiers()) + 1):
+        root = tiers()[tier - 1]
+        if not os.path.isdir(root):
+            continue
+        for shard in os.listdir(root):
+            directory = os.path.join(root, shard)
+            names = [name for name in os.listdir(directory) if name.isdigit()] if os.path.isdir(directory) else []
+            if not names:
+                continue
+            rows = {
+                file.id: (file, username)
+                for file, username in db.session.query(File, User.username).join(User, User.id == File.owner_id).filter(
+                    File.id.in_([int(name) for name in names])
+                )
+            }
+            for name in names:
+                target = os.path.join(directory, name)
+                row = rows.get(int(name))
+                if row is not None:
+                    path = stored_path(row[1], row[0])
+                    if os.path.islink(path) and os.readlink(path) == target:
+                        continue
+                try:
+                    os.remove(target)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
+
+def move_tiers():
+    """Promote demoted files read since, demote files left unread, and collect orphaned tier files.
+
+    Returns counts of what was moved. Only one process runs the mover at a
+    time; the others return None.
+    """
+    if not tiers():
+        return None
+    lock_fd = os.open(os.path.join(current_app.config['UPLOAD_FOLDER'], '.tiering.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+        stats = {'promoted': 0, 'demoted': 0, 'errors': 0, 'collected': 0}
+        batch = current_app.config['TIER_MOVE_BATCH']
+        demote_after = timedelta(seconds=current_app.config['TIER_DEMOTE_AFTER'])
+        now = datetime.now()
+        last_read = func.coalesce(File.last_accessed_at, File.created_at)
+
+        # A demoted file was last read before it was demoted, so a later read is a recent one
+        _move_batch(_candidates((File.tier > 0) & (File.last_accessed_at >= now - demote_after),
+                                File.last_accessed_at.desc(), batch), promote_file, stats, 'promoted')
+
+        # A file moves down one tier for every further TIER_DEMOTE_AFTER it stays
+        # unread; deepest tier first, so no file moves twice in one run
+        for tier in reversed(range(1, len(tiers()) + 1)):
+            rows = _candidates(
+                (File.tier == tier - 1) & (File.size >= current_app.config['TIER_MIN_SIZE']) &
+                File.sha256.is_(None) & (last_read < now - demote_after * tier),
+                last_read, batch
+            )
+            _move_batch(rows, lambda file, path, tier=tier: demote_file(file, path, tier), stats, 'demoted')
+
+        stats['collected'] = collect_tier_garbage()
+        if any(stats.values()):
+            logging.info(f"Storage tier mover: {stats}")
+        return stats
+    finally:
+        os.close(lock_fd)
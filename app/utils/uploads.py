@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+from datetime import datetime
+from flask import current_app
+from werkzeug.utils import secure_filename
+from app import db
+from app.models.upload_session import UploadSession
+
+# Optimistic-locking retries when parallel chunks update the same session
+_MAX_RANGE_UPDATE_ATTEMPTS = 20
+
+def secure_relative_path(path):
+    """Sanitize each segment of a client-supplied relative path, dropping those left empty"""
+    parts = (secure_filename(part) for part in path.replace('\\', '/').split('/'))
+    return '/'.join(part for part in parts if part)
+
+def get_incoming_folder():
+    """Directory holding partial uploads; it sits inside UPLOAD_FOLDER so finalizing is a rename"""
+    folder = os.path.join(current_app.config['UPLOAD_FOLDER'], '.incoming')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def get_part_path(upload_id):
+    return os.path.join(get_incoming_folder(), f'{upload_id}.part')
+
+def create_part_file(upload_id, size):
+    """Create the sparse file that chunks are written into at their offsets"""
+    with open(get_part_path(upload_id), 'wb') as part_file:
+        part_file.truncate(size)
+
+def write_chunk(upload_id, stream, offset, limit, chunk_size=1024 * 1024):
+    """Copy a request body into the part file starting at ``offset``.
+
+    Writes are positional, so several chunks of the same upload can be
+    written concurrently by different requests. At most ``limit`` bytes are
+    accepted. Returns the number of bytes written, or None if the body was
+    longer than ``limit``.
+    """
+    written = 0
+    fd = os.open(get_part_path(upload_id), os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        while True:
+            data = stream.read(chunk_size)
+            if not data:
+                break
+            if written + len(data) > limit:
+                return None
+            if hasattr(os, 'pwrite'):
+                os.pwrite(fd, data, offset + written)
+            else:
+                os.lseek(fd, offset + written, os.SEEK_SET)
+                os.write(fd, data)
+            written += len(data)
+    finally:
+        os.close(fd)
+    return written
+
+def merge_ranges(ranges, start, end):
+    """Insert the byte range [start, end) into a sorted list of disjoint ranges"""
+    merged = []
+    for range_start, range_end in sorted(list(ranges) + [(start, end)]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+def record_received_range(upload_id, start, end):
+    """Merge a written byte range into the session with a compare-and-swap update.
+
+    Returns the refreshed session, or None if it vanished in the meantime.
+    """
+    for _ in range(_MAX_RANGE_UPDATE_ATTEMPTS):
+        upload = db.session.get(UploadSession, upload_id, populate_existing=True)
+        if not upload:
+            return None
+        ranges = merge_ranges(upload.received_ranges, start, end)
+        upload_version = upload.version
+        updated = UploadSession.query.filter_by(id=upload_id, version=upload_version).update({
+            UploadSession.ranges: json.dumps(ranges),
+            UploadSession.received: sum(range_end - range_start for range_start, range_end in ranges),
+            UploadSession.version: upload_version + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if updated:
+            return db.session.get(UploadSession, upload_id, populate_existing=True)
+    raise RuntimeError(f'Could not record chunk for upload {upload_id}')
+
+def discard_upload_session(upload):
+    """Remove a session together with its partial data"""
+    part_path = get_part_path(upload.id)
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    db.session.delete(upload)
+    db.session.commit()
+
+def sweep_expired_upload_sessions():
+    """Delete expired upload sessions and part files that no session refers to"""
+    expired = UploadSession.query.filter(UploadSession.expires_at < datetime.now()).all()
+    for upload in expired:
+        discard_upload_session(upload)
+
+    incoming = get_incoming_folder()
+    known = {upload_id for (upload_id,) in db.session.query(UploadSession.id)}
+    ttl = current_app.config['UPLOAD_SESSION_TTL']
+    now = datetime.now().timestamp()
+    orphans = 0
+    for entry in os.scandir(incoming):
+        upload_id = entry.name[:-len('.part')]
+        if entry.name.endswith('.part') and upload_id not in known and now - entry.stat().st_mtime > ttl:
+            os.remove(entry.path)
+            orphans += 1
+
+    if expired or orphans:
+        logging.info(f"Swept {len(expired)} expired upload sessions and {orphans} orphaned part files")
@@ -0,0 +1,53 @@
+"""Storage usage across all users, for the admin dashboard.
+
+Per-user file counts and sizes come from one GROUP BY over the file table,
+and the largest folders from another over the top-level folder of each
+file, so the cost of a snapshot does not grow with the number of users.
+Snapshots are kept for USAGE_CACHE_TTL seconds per worker, as a dashboard
+showing usage a minute old is fine.
+"""
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func
+from app import db
+from app.models.file import File
+from app.models.user import User
+
+def _compute_snapshot():
+    per_user = {
+        owner_id: {'files': count, 'bytes': size}
+        for owner_id, count, size in db.session.query(
+            File.owner_id, func.count(File.id), func.coalesce(func.sum(File.size), 0)
+        ).group_by(File.owner_id)
+    }
+
+    # Everything below a top-level folder counts towards it
+    separator = func.instr(File.name, '/')
+    top_folder = func.substr(File.name, 1, separator - 1)
+    folder_size = func.sum(File.size)
+    largest_folders = [
+        {'username': username, 'path': path, 'files': count, 'bytes': size or 0}
+        for username, path, count, size in db.session.query(
+            User.username, top_folder, func.count(File.id), folder_size
+        ).join(User, User.id == File.owner_id).filter(separator > 0).group_by(
+            File.owner_id, top_folder
+        ).order_by(folder_size.desc()).limit(current_app.config['LARGEST_FOLDERS_LIMIT'])
+    ]
+
+    return {
+        'taken_at': datetime.now().isoformat(timespec='seconds'),
+        'users': per_user,
+        'total_files': sum(usage['files'] for usage in per_user.values()),
+        'total_bytes': sum(usage['bytes'] for usage in per_user.values()),
+        'largest_folders': largest_folders
+    }
+
+def usage_snapshot(refresh=False):
+    """Return the cached usage snapshot, recomputing it once it is older than USAGE_CACHE_TTL"""
+    cached = current_app.extensions.get('usage_snapshot')
+    if not refresh and cached and time.monotonic() - cached[0] < current_app.config['USAGE_CACHE_TTL']:
+        return cached[1]
+    snapshot = _compute_snapshot()
+    current_app.extensions['usage_snapshot'] = (time.monotonic(), snapshot)
+    return snapshot
@@ -0,0 +1,345 @@
+"""Optional inotify watcher that keeps file metadata fresh between syncs.
+
+Every directory under the upload folder is watched. Create, move, delete and
+close-after-write events mark their directory dirty, and once events have been
+quiet for WATCHER_DEBOUNCE seconds the dirty directories are diffed against
+the database in one batch, the same way the incremental sync does it, and
+their state is recorded for the next one. When inotify is unavailable, the
+watch limit is exhausted or the event queue overflows, the watcher falls back
+to incremental rescans of the whole tree.
+
+The app's own uploads, copies, moves and deletes write their rows themselves.
+While one runs it holds a locked marker file naming the paths it writes, in
+whichever process it runs, and directories at, above or below those paths
+are left dirty until the marker is gone, so the watcher never races a
+transaction that is still open.
+"""
+import errno
+import logging
+import os
+import select
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+from flask import current_app
+from app import db
+from app.models.user import User
+from app.models.folder import Folder
+from app.utils.filesystem import UPLOAD_TEMP_PREFIX, recalculate_storage_usage
+from app.utils.inotify import (
+    Inotify,
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_DELETE,
+    IN_DELETE_SELF,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    IN_ONLYDIR,
+    IN_Q_OVERFLOW
+)
+from app.utils.sync import record_directory_state, sync_directory, synchronize_database_with_filesystem
+
+_WATCH_MASK = (IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+               | IN_DELETE_SELF | IN_ONLYDIR)
+# A steady stream of events is flushed after at most this many debounce periods
+_MAX_DELAY_FACTOR = 10
+# Marker files of the app's writes in progress, under the upload folder
+_OPERATIONS_FOLDER = '.operations'
+
+class WatchLimitReached(Exception):
+    """Raised when the kernel refuses more inotify watches"""
+
+@contextmanager
+def app_write(user_id, *paths):
+    """Keep the watcher off a user's ``paths`` until the block, and the transaction recording the change, ends"""
+    config = current_app.config
+    if fcntl is None or not config['FILESYSTEM_WATCHER'] or config['STORAGE_LAYOUT'] == 'sharded':
+        yield
+        return
+    folder = os.path.join(config['UPLOAD_FOLDER'], _OPERATIONS_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    marker = os.path.join(folder, uuid.uuid4().hex)
+    fd = os.open(marker + '.tmp', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, '\n'.join([str(user_id), *(path.strip('/') for path in paths)]).encode('utf-8'))
+        # Only complete, locked markers appear under their final name
+        os.rename(marker + '.tmp', marker)
+        try:
+            yield
+        finally:
+            os.remove(marker)
+    finally:
+        os.close(fd)
+
+def _overlaps(path, other):
+    """Whether one of two relative paths is the other or lies below it"""
+    return (path == other or not path or not other
+            or path.startswith(other + '/') or other.startswith(path + '/'))
+
+class FilesystemWatcher:
+    def __init__(self, app):
+        self.app = app
+        self.root = app.config['UPLOAD_FOLDER']
+        self.debounce = app.config['WATCHER_DEBOUNCE']
+        self.rescan_interval = app.config['WATCHER_RESCAN_INTERVAL']
+        self.stop_event = threading.Event()
+        self.lock_fd = None
+        self._inotify = None
+        self._watches = {}  # wd -> (user id, relative path); the upload folder itself has user id None
+        self._user_roots = {}
+        self._dirty = set()
+        self._new_dirs = set()
+        self._new_users = set()
+        self._overflowed = False
+        self._first_event = None
+        self._last_event = None
+
+    def run(self):
+        """Watch until stopped, falling back to periodic rescans when inotify cannot be used"""
+        try:
+            self.start_watching()
+            while not self.stop_event.is_set():
+                self.process_events(self._timeout())
+                if self._due():
+                    self.flush()
+        except (OSError, WatchLimitReached) as e:
+            logging.warning(f"Filesystem watcher stopped ({e}); rescanning every {self.rescan_interval}s instead")
+            self.close()
+            self._rescan_periodically()
+
+    def start_watching(self):
+        self._inotify = Inotify()
+        self._add_watch(None, '', self.root)
+        with self.app.app_context():
+            for user_id, username in db.session.query(User.id, User.username).all():
+                self._watch_user(user_id, username, mark_dirty=False)
+
+    def close(self):
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+        self._watches.clear()
+
+    def _add_watch(self, user_id, path, full_path):
+        try:
+            wd = self._inotify.add_watch(full_path, _WATCH_MASK)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise WatchLimitReached('inotify watch limit reached; raise fs.inotify.max_user_watches')
+            # The directory vanished before it could be watched
+            return
+        self._watches[wd] = (user_id, path)
+
+    def _watch_tree(self, user_id, path, mark_dirty):
+        root = self._user_roots[user_id]
+        top = os.path.join(root, path) if path else root
+        for current, dirs, _ in os.walk(top):
+            relative = os.path.relpath(current, root).replace(os.sep, '/')
+            relative = '' if relative == '.' else relative
+            self._add_watch(user_id, relative, current)
+            if mark_dirty:
+                # Entries created before the watch existed produced no events
+                self._dirty.add((user_id, relative))
+
+    def _watch_user(self, user_id, username, mark_dirty):
+        user_root = os.path.join(self.root, username)
+        if os.path.isdir(user_root):
+            self._user_roots[user_id] = user_root
+            self._watch_tree(user_id, '', mark_dirty)
+
+    def _unwatch_tree(self, user_id, path):
+        prefix = path + '/'
+        for wd, (owner, watched) in list(self._watches.items()):
+            if owner == user_id and (watched == path or watched.startswith(prefix)):
+                self._inotify.rm_watch(wd)
+                del self._watches[wd]
+
+    def process_events(self, timeout):
+        """Wait up to ``timeout`` seconds for events and record what they touched"""
+        readable, _, _ = select.select([self._inotify.fd], [], [], timeout)
+        if not readable:
+            return
+        now = time.monotonic()
+        for wd, mask, _, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self._overflowed = True
+            elif mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            else:
+                self._record(wd, mask, name)
+            self._last_event = now
+            if self._first_event is None:
+                self._first_event = now
+
+    def _record(self, wd, mask, name):
+        watch = self._watches.get(wd)
+        if watch is None or not name:
+            return
+        user_id, path = watch
+        if user_id is None:
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._new_users.add(name)
+            return
+        if name.startswith(UPLOAD_TEMP_PREFIX):
+            return
+        self._dirty.add((user_id, path))
+        if mask & IN_ISDIR:
+            child = f'{path}/{name}' if path else name
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._new_dirs.add((user_id, child))
+            elif mask & IN_MOVED_FROM:
+                # Its watches would keep reporting the old path
+                self._unwatch_tree(user_id, child)
+
+    def _timeout(self):
+        if self._last_event is None:
+            return 1.0
+        now = time.monotonic()
+        due = min(self._last_event + self.debounce, self._first_event + _MAX_DELAY_FACTOR * self.debounce)
+        return max(due - now, 0)
+
+    def _due(self):
+        return self._last_event is not None and self._timeout() == 0
+
+    def _writes_in_progress(self):
+        """{user id: paths} of the app's writes that still hold their marker"""
+        writes = defaultdict(list)
+        folder = os.path.join(self.root, _OPERATIONS_FOLDER)
+        try:
+            names = os.listdir(folder)
+        except FileNotFoundError:
+            return writes
+        for name in names:
+            if '.' in name:
+                continue
+            path = os.path.join(folder, name)
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    user_id, *paths = f.read().decode('utf-8').split('\n')
+                    writes[int(user_id)].extend(paths)
+                    continue
+                try:
+                    # Left behind by a process that died during the write, or released since listing
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return writes
+
+    def flush(self):
+        """Apply the recorded changes to the database in one batch"""
+        with self.app.app_context():
+            try:
+                self._apply()
+            except WatchLimitReached:
+                raise
+            except Exception:
+                db.session.rollback()
+                logging.exception("Applying filesystem events failed")
+        self._first_event = self._last_event = None
+        if self._dirty or self._overflowed:
+            # Held back by writes of the app; retried after another debounce period
+            self._first_event = self._last_event = time.monotonic()
+
+    def _apply(self):
+        for username in self._new_users:
+            user_id = db.session.query(User.id).filter_by(username=username).scalar()
+            if user_id is not None:
+                self._watch_user(user_id, username, mark_dirty=True)
+        for user_id, path in sorted(self._new_dirs, key=lambda d: d[1].count('/')):
+            if user_id in self._user_roots:
+                self._watch_tree(user_id, path, mark_dirty=True)
+        self._new_users.clear()
+        self._new_dirs.clear()
+
+        in_progress = self._writes_in_progress() if fcntl is not None else {}
+        if self._overflowed:
+            if in_progress:
+                return
+            # Events were lost, so nothing short of a rescan can be trusted
+            self._overflowed = False
+            self._dirty.clear()
+            synchronize_database_with_filesystem(self.app)
+            return
+
+        dirty = sorted(self._dirty, key=lambda d: (d[0], d[1].count('/'), d[1]))
+        self._dirty.clear()
+        batch_size = self.app.config['SYNC_BATCH_SIZE']
+        stats = {'files_added': 0, 'files_removed': 0, 'folders_added': 0, 'folders_removed': 0}
+        touched_users = set()
+        folders = {}
+        pending = 0
+        for user_id, path in dirty:
+            if any(_overlaps(path, written) for written in in_progress.get(user_id, ())):
+                # Its rows are being written by the app in a transaction still open
+                self._dirty.add((user_id, path))
+                continue
+            root = self._user_roots.get(user_id)
+            full_path = os.path.join(root, path) if root and path else root
+            if root is None or not os.path.isdir(full_path):
+                # Removed; the diff of its parent drops its rows
+                continue
+            if user_id not in touched_users:
+                touched_users.add(user_id)
+                folders = dict(
+                    Folder.query.filter(Folder.owner_id == user_id, Folder.name.in_([p for u, p in dirty if u == user_id]))
+                    .with_entities(Folder.name, Folder.id)
+                )
+            scan_started = time.time_ns()
+            stat = os.stat(full_path)
+            _, written = sync_directory(user_id, path, full_path, folders, stats)
+            record_directory_state(user_id, path, stat, scan_started)
+            pending += written + 1
+            if pending >= batch_size:
+                db.session.commit()
+                pending = 0
+        db.session.commit()
+        for user_id in touched_users:
+            recalculate_storage_usage(user_id)
+        if any(stats.values()):
+            logging.info(f"Filesystem watcher applied {len(dirty)} directory changes: {stats}")
+
+    def _rescan_periodically(self):
+        while not self.stop_event.wait(self.rescan_interval):
+            try:
+                with self.app.app_context():
+                    synchronize_database_with_filesystem(self.app)
+            except Exception:
+                logging.exception("Periodic filesystem rescan failed")
+
+def start_filesystem_watcher(app):
+    """Start the watcher thread in the first process to claim it, if FILESYSTEM_WATCHER is enabled.
+
+    Returns the watcher, or None when it is disabled, under TESTING, in the
+    sharded layout, whose folders are not directories, or already running in
+    another process.
+    """
+    if app.config.get('TESTING') or not app.config['FILESYSTEM_WATCHER'] or app.config['STORAGE_LAYOUT'] == 'sharded':
+        return None
+    lock_fd = os.open(os.path.join(app.config['UPLOAD_FOLDER'], '.watcher.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl is not None:
+        try:
+            # Held for the life of the process
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return None
+    watcher = FilesystemWatcher(app)
+    watcher.lock_fd = lock_fd
+    threading.Thread(target=watcher.run, name='filesystem-watcher', daemon=True).start()
+    return watcher
@@ -0,0 +1,339 @@
+"""Streaming zip archive writer.
+
+Unlike ``zipfile.ZipFile``, which needs a seekable output, the archive is
+produced as a generator of byte chunks while the source files are read, so the
+first bytes reach the client before the last file has been opened. Sizes and
+CRCs follow each entry in a data descriptor, and ZIP64 records are written for
+entries, offsets and entry counts beyond the classic zip limits.
+"""
+import hashlib
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+# Placeholder written in classic fields whose real value is in the ZIP64 record
+_ZIP64_MARKER = 0xFFFFFFFF
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Formats that are already compressed and gain nothing from another deflate pass
+STORED_EXTENSIONS = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.jar', '.apk'
+})
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+_MADE_BY_UNIX = 3 << 8
+
+def compression_for(arcname):
+    """Return the compression method to use for an entry name"""
+    return ZIP_STORED if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS else ZIP_DEFLATED
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+def _zip64_extra(*values):
+    return struct.pack('<HH', 0x0001, 8 * len(values)) + b''.join(struct.pack('<Q', v) for v in values)
+
+def _read_chunks(f, chunk_size):
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            return
+        yield data
+
+def _deflate(chunks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    for data in chunks:
+        out = compressor.compress(data)
+        if out:
+            yield out
+    yield compressor.flush()
+
+# Deflate back-references reach at most this far, so it is all a block needs
+# from its predecessor
+_WINDOW_SIZE = 32 * 1024
+# An empty final block, ending a stream of sync-flushed blocks
+_FINAL_BLOCK = zlib.compressobj(6, zlib.DEFLATED, -15).flush()
+
+def _deflate_block(data, level, preset):
+    """Deflate one block so it can be concatenated with its neighbours.
+
+    The block is primed with the tail of the previous block and ends on a
+    byte boundary without the final-block bit, like pigz does.
+    """
+    if preset:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=preset)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def _parallel_deflate(chunks, level, executor, window):
+    """Deflate chunks concurrently, yielding the output in order.
+
+    zlib releases the GIL while compressing, so threads scale across cores. At
+    most ``window`` blocks are in flight to bound memory use.
+    """
+    pending = deque()
+    preset = None
+    for data in chunks:
+        pending.append(executor.submit(_deflate_block, data, level, preset))
+        preset = data[-_WINDOW_SIZE:]
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+    yield _FINAL_BLOCK
+
+def _load_small_file(path, method, level, max_size):
+    """Read, checksum and compress a whole small file in a worker thread.
+
+    Returns None if the file is gone and False if it grew past ``max_size``,
+    in which case it is streamed normally instead.
+    """
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = f.read(max_size + 1)
+    except OSError:
+        return None
+    if len(data) > max_size:
+        return False
+    payload = data if method == ZIP_STORED else b''.join(_deflate([data], level))
+    return stat, zlib.crc32(data), len(data), payload
+
+class _Entry:
+    __slots__ = ('name', 'method', 'flags', 'dos_time', 'dos_date', 'crc',
+                 'compressed_size', 'size', 'offset', 'external_attr', 'zip64')
+
+class ZipStream:
+    """Iterable that yields a zip archive built from (arcname, path) pairs.
+
+    A path of None adds a directory entry. Files that vanish before they are
+    opened are skipped. ``compress_level`` is the zlib level for deflated
+    entries. With ``workers`` above 1, small files are read and compressed
+    ahead of the output on a thread pool and large files are deflated in
+    parallel blocks; the archive bytes are identical in layout either way.
+    """
+
+    def __init__(self, entries, compress_level=6, chunk_size=1024 * 1024, workers=1):
+        self.entries = entries
+        self.compress_level = compress_level
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self._executor = None
+        self._records = []
+        self._offset = 0
+
+    def __iter__(self):
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='zip-deflate')
+        try:
+            for job in self._jobs():
+                for chunk in self._write_job(*job):
+                    self._offset += len(chunk)
+                    yield chunk
+        finally:
+            if self._executor:
+                # The client may have disconnected mid-archive
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+        yield self._central_directory()
+
+    def compress(self, chunks):
+        """Yield the deflated form of a stream of file chunks"""
+        if self._executor:
+            return _parallel_deflate(chunks, self.compress_level, self._executor, 2 * self.workers)
+        return _deflate(chunks, self.compress_level)
+
+    def _jobs(self):
+        """Yield (name, path, future) per entry, keeping small files prefetched ahead"""
+        if not self._executor:
+            for arcname, path in self.entries:
+                yield arcname, path, None
+            return
+
+        pending = deque()
+        for arcname, path in self.entries:
+            future = None
+            if path is not None:
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    continue
+                if size <= self.chunk_size:
+                    future = self._executor.submit(_load_small_file, path, compression_for(arcname),
+                                                   self.compress_level, self.chunk_size)
+            pending.append((arcname, path, future))
+            if len(pending) > 2 * self.workers:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def _write_job(self, arcname, path, future):
+        name = arcname.replace('\\', '/').lstrip('/')
+        if path is None:
+            if not name.endswith('/'):
+                name += '/'
+            yield self._local_header(self._new_entry(name, ZIP_STORED, time.time(), 0o40775, 0))
+            return
+
+        loaded = future.result() if future else False
+        if loaded is None:
+            return
+        if loaded:
+            stat, crc, size, payload = loaded
+            entry = self._new_entry(name, compression_for(name), stat.st_mtime, stat.st_mode & 0xFFFF, size)
+            yield self._local_header(entry)
+            if payload:
+                yield payload
+            yield self._data_descriptor(entry, crc, size, len(payload))
+            return
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            method = compression_for(name)
+            entry = self._new_entry(name, method, stat.st_mtime, stat.st_mode & 0xFFFF, stat.st_size)
+            yield self._local_header(entry)
+
+            crc = 0
+            size = 0
+            compressed_size = 0
+
+            def source():
+                nonlocal crc, size
+                for data in _read_chunks(f, self.chunk_size):
+                    crc = zlib.crc32(data, crc)
+                    size += len(data)
+                    yield data
+
+            body = source() if method == ZIP_STORED else self.compress(source())
+            for chunk in body:
+                if chunk:
+                    compressed_size += len(chunk)
+                    yield chunk
+
+        yield self._data_descriptor(entry, crc, size, compressed_size)
+
+    def _data_descriptor(self, entry, crc, size, compressed_size):
+        if not entry.zip64 and (size > ZIP64_LIMIT or compressed_size > ZIP64_LIMIT):
+            raise RuntimeError(f'{entry.name.decode("utf-8")} grew past the zip size limit while being archived')
+        entry.crc = crc
+        entry.size = size
+        entry.compressed_size = compressed_size
+        if entry.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size)
+        return struct.pack('<IIII', 0x08074b50, crc, compressed_size, size)
+
+    def _new_entry(self, name, method, mtime, mode, expected_size):
+        entry = _Entry()
+        entry.name = name.encode('utf-8')
+        entry.method = method
+        is_dir = name.endswith('/')
+        entry.flags = _FLAG_UTF8 if is_dir else _FLAG_UTF8 | _FLAG_DATA_DESCRIPTOR
+        entry.dos_time, entry.dos_date = _dos_datetime(mtime)
+        entry.crc = entry.compressed_size = entry.size = 0
+        entry.offset = self._offset
+        entry.external_attr = (mode << 16) | (0x10 if is_dir else 0)
+        # Deflate can expand incompressible data slightly, so leave headroom
+        entry.zip64 = expected_size * 1.05 > ZIP64_LIMIT
+        self._records.append(entry)
+        return entry
+
+    def _local_header(self, entry):
+        if entry.zip64:
+            extra = _zip64_extra(0, 0)
+            sizes = _ZIP64_MARKER
+            version = _VERSION_ZIP64
+        else:
+            extra = b''
+            sizes = 0
+            version = _VERSION_DEFAULT
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, version, entry.flags, entry.method,
+            entry.dos_time, entry.dos_date, 0, sizes, sizes, len(entry.name), len(extra)
+        ) + entry.name + extra
+
+    def _central_directory(self):
+        start = self._offset
+        parts = []
+        for entry in self._records:
+            zip64_values = []
+            size = entry.size
+            compressed_size = entry.compressed_size
+            offset = entry.offset
+            if entry.zip64:
+                zip64_values += [size, compressed_size]
+                size = compressed_size = _ZIP64_MARKER
+            if offset >= ZIP64_LIMIT:
+                zip64_values.append(offset)
+                offset = _ZIP64_MARKER
+            extra = _zip64_extra(*zip64_values) if zip64_values else b''
+            version = _VERSION_ZIP64 if zip64_values else _VERSION_DEFAULT
+            parts.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, _MADE_BY_UNIX | version, version,
+                entry.flags, entry.method, entry.dos_time, entry.dos_date, entry.crc,
+                compressed_size, size, len(entry.name), len(extra), 0, 0, 0,
+                entry.external_attr, offset
+            ) + entry.name + extra)
+
+        directory = b''.join(parts)
+        size = len(directory)
+        count = len(self._records)
+        end = self._offset + size
+        zip64 = count >= ZIP_FILECOUNT_LIMIT or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT
+        if zip64:
+            directory += struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, _MADE_BY_UNIX | _VERSION_ZIP64, _VERSION_ZIP64,
+                0, 0, count, count, size, start
+            )
+            directory += struct.pack('<IIQI', 0x07064b50, 0, end, 1)
+        directory += struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF if zip64 else count,
+            0xFFFF if zip64 else count, _ZIP64_MARKER if zip64 else size,
+            _ZIP64_MARKER if zip64 else start, 0
+        )
+        return directory
+
+def stream_zip(entries, compress_level=6, chunk_size=1024 * 1024, workers=1):
+    """Return an iterator over a zip archive of the given (arcname, path) pairs"""
+    return iter(ZipStream(entries, compress_level, chunk_size, workers))
+
+def manifest_fingerprint(entries):
+    """Return a digest of entry names, sizes and mtimes, which changes whenever the archive would,
+    and the total size of the files"""
+    digest = hashlib.sha256()
+    total_size = 0
+    for arcname, path in entries:
+        if path is None:
+            line = f'{arcname}\0dir\n'
+        else:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            line = f'{arcname}\0{stat.st_size}\0{stat.st_mtime_ns}\n'
+            total_size += stat.st_size
+        digest.update(line.encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest(), total_size
@@ -0,0 +1,77 @@
+"""Compare single-threaded and parallel bulk archive throughput.
+
+Builds a synthetic tree of compressible text files (a few large ones and many
+small ones), then streams it through the zip writer with one worker and with
+several, discarding the output.
+
+    python -m benchmarks.archive_compression --workers 4 --size-mb 256
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from app.utils.zipstream import stream_zip
+
+def build_tree(root, size_mb, small_files):
+    """Write a synthetic tree of roughly ``size_mb`` megabytes under ``root``"""
+    rng = random.Random(0)
+    words = [''.join(rng.choice('abcdefghijklmnop') for _ in range(rng.randint(2, 10))) for _ in range(2000)]
+    def text(n):
+        out = []
+        length = 0
+        while length < n:
+            line = ' '.join(rng.choice(words) for _ in range(12)) + '\n'
+            out.append(line)
+            length += len(line)
+        return ''.join(out).encode('ascii')[:n]
+
+    small_total = small_files * 16 * 1024
+    os.makedirs(os.path.join(root, 'small'))
+    for i in range(small_files):
+        with open(os.path.join(root, 'small', f'{i:05d}.txt'), 'wb') as f:
+            f.write(text(16 * 1024))
+    large_size = max(size_mb * 1024 * 1024 - small_total, 0) // 4
+    block = text(4 * 1024 * 1024)
+    for i in range(4):
+        with open(os.path.join(root, f'large-{i}.log'), 'wb') as f:
+            written = 0
+            while written < large_size:
+                f.write(block[:large_size - written])
+                written += len(block)
+
+def entries(root):
+    for dirpath, _, files in os.walk(root):
+        for name in sorted(files):
+            path = os.path.join(dirpath, name)
+            yield os.path.relpath(path, root), path
+
+def run(root, workers, level):
+    start = time.perf_counter()
+    size = 0
+    for chunk in stream_zip(entries(root), level, workers=workers):
+        size += len(chunk)
+    return time.perf_counter() - start, size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--small-files', type=int, default=2000)
+    parser.add_argument('--level', type=int, default=6)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='archive-bench-')
+    try:
+        build_tree(root, args.size_mb, args.small_files)
+        source_bytes = sum(os.path.getsize(path) for _, path in entries(root))
+        for workers in sorted({1, args.workers}):
+            elapsed, archive_bytes = run(root, workers, args.level)
+            print(f'workers={workers:<3} {elapsed:7.2f}s  {source_bytes / elapsed / 1e6:8.1f} MB/s  '
+                  f'ratio {archive_bytes / source_bytes:.3f}')
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
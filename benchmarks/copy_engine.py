@@ -0,0 +1,60 @@
+"""Compare the copy engine's strategies with shutil.copytree.
+
+Builds a tree of a few large and many small files under ``--dir`` (point it
+at a tmpfs, ext4, btrfs or XFS mount to compare filesystems), then copies it
+once per strategy and reports throughput and the strategy each copy ended up
+using.
+
+    python -m benchmarks.copy_engine --dir /mnt/btrfs --size-mb 512
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from app.utils.copy_engine import STRATEGIES, copy_tree
+
+def build_tree(root, size_mb, small_files):
+    """Write ``small_files`` 16KB files and four large ones adding up to about ``size_mb`` megabytes"""
+    os.makedirs(os.path.join(root, 'small'))
+    for i in range(small_files):
+        with open(os.path.join(root, 'small', f'{i:05d}.bin'), 'wb') as f:
+            f.write(os.urandom(16 * 1024))
+    large_size = max(size_mb * 1024 * 1024 - small_files * 16 * 1024, 0) // 4
+    block = os.urandom(4 * 1024 * 1024)
+    for i in range(4):
+        with open(os.path.join(root, f'large-{i}.bin'), 'wb') as f:
+            written = 0
+            while written < large_size:
+                written += f.write(block[:large_size - written])
+    return size_mb * 1024 * 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='filesystem to benchmark on')
+    parser.add_argument('--size-mb', type=int, default=256, help='approximate size of the tree')
+    parser.add_argument('--small-files', type=int, default=2000, help='number of 16KB files')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir=args.dir)
+    try:
+        source = os.path.join(root, 'source')
+        total = build_tree(source, args.size_mb, args.small_files)
+        runs = [('shutil.copytree', None)] + [(STRATEGIES[i], STRATEGIES[i:]) for i in range(len(STRATEGIES))]
+        for label, strategies in runs:
+            destination = os.path.join(root, 'copy')
+            os.sync()
+            started = time.perf_counter()
+            if strategies is None:
+                shutil.copytree(source, destination)
+                used = 'n/a'
+            else:
+                used = ', '.join(f'{name}={count}' for name, count in copy_tree(source, destination, strategies).items())
+            elapsed = time.perf_counter() - started
+            print(f'{label:<16} {elapsed:7.2f}s {total / elapsed / 1024 / 1024:9.1f} MB/s  ({used})')
+            shutil.rmtree(destination)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Compare name search latency with a LIKE scan and with the trigram index.
+
+Fills a scratch SQLite database with synthetic file paths spread over a few
+users, then times the same queries both ways: the ``ILIKE '%q%'`` scan search
+used to run, and the FTS5 query it runs now.
+
+    python -m benchmarks.search_index --rows 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from sqlalchemy import create_engine, text
+from app.utils.search import build_search_query, create_search_index
+
+QUERIES = ['report', 'invoice 2023', 'holiday', 'zzzznotfound', 'src main']
+
+def build_database(engine, rows, users):
+    """Create a file and folder table holding ``rows`` synthetic paths"""
+    rng = random.Random(0)
+    words = ['report', 'invoice', 'holiday', 'photo', 'draft', 'final', 'notes', 'backup',
+             'project', 'budget', 'src', 'main', 'test', 'readme', 'archive', 'scan']
+    words += [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 9))) for _ in range(5000)]
+    extensions = ['.txt', '.pdf', '.jpg', '.py', '.docx', '.csv', '.log']
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE file (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, '
+            'size INTEGER, owner_id INTEGER NOT NULL)'
+        ))
+        connection.execute(text(
+            'CREATE TABLE folder (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, owner_id INTEGER NOT NULL)'
+        ))
+        connection.execute(text('CREATE UNIQUE INDEX ix_file_owner_name ON file (owner_id, name)'))
+        batch = []
+        for i in range(rows):
+            depth = rng.randint(1, 4)
+            parts = [rng.choice(words) for _ in range(depth)]
+            name = '/'.join(parts) + f'-{i}' + rng.choice(extensions)
+            batch.append({'name': name, 'size': rng.randint(0, 1 << 24), 'owner_id': i % users + 1})
+            if len(batch) == 10000:
+                connection.execute(text('INSERT INTO file (name, size, owner_id) VALUES (:name, :size, :owner_id)'), batch)
+                batch = []
+        if batch:
+            connection.execute(text('INSERT INTO file (name, size, owner_id) VALUES (:name, :size, :owner_id)'), batch)
+
+def time_query(connection, statement, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        connection.execute(statement, params).fetchall()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000, help='file rows to generate')
+    parser.add_argument('--users', type=int, default=4, help='owners the rows are spread over')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per query; the median is reported')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        engine = create_engine(f"sqlite:///{os.path.join(root, 'search.db')}")
+        started = time.monotonic()
+        build_database(engine, args.rows, args.users)
+        print(f'{args.rows} rows generated in {time.monotonic() - started:.1f}s')
+
+        started = time.monotonic()
+        with engine.begin() as connection:
+            if not create_search_index(connection):
+                raise SystemExit('This SQLite build has no FTS5 trigram tokenizer')
+        print(f'search index built in {time.monotonic() - started:.1f}s')
+
+        scan = text(
+            'SELECT id FROM file WHERE owner_id = :owner_id AND name LIKE :pattern '
+            'UNION ALL SELECT id FROM folder WHERE owner_id = :owner_id AND name LIKE :pattern'
+        )
+        print(f"{'query':<16}{'LIKE scan':>12}{'index':>12}")
+        with engine.connect() as connection:
+            for query in QUERIES:
+                like = time_query(connection, scan, {'owner_id': 1, 'pattern': f'%{query}%'}, args.repeat)
+                indexed = time_query(connection, *build_search_query(1, query, limit=100), args.repeat)
+                print(f'{query:<16}{like * 1000:>10.1f}ms{indexed * 1000:>10.1f}ms')
+        engine.dispose()
+
+if __name__ == '__main__':
+    main()